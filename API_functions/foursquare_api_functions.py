@@ -1,21 +1,52 @@
-def get_tips_data(venue_id):
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+import http_cache
+
+FOURSQUARE_SEARCH_URL = 'https://api.foursquare.com/v2/venues/search'
+COFFEE_SHOP_CATEGORY = '4bf58dd8d48988d1e0931735'
+SEARCH_LIMIT = 50
+
+logger = logging.getLogger(__name__)
+
+def populate_tips_params(credentials):
+    '''
+    Takes in Foursquare credentials and outputs params that request up to 500 tips for a venue.
+    '''
+    tips_params = dict(
+        client_id=credentials['client_id'],
+        client_secret=credentials['client_secret'],
+        limit='500',
+        v='20180113' #Date of current version
+        )
+    return tips_params
+
+def get_tips_data(venue_id, credentials):
     '''
-    Takes in a venue id and performs a GET request to Foursquare's API to retrieve a max of 500 tips formatted
-    as a json object. Returns a list of strings of tips.
+    Takes in a venue id and Foursquare credentials and performs a GET request to Foursquare's API to retrieve
+    a max of 500 tips formatted as a json object. Returns a list of strings of tips. If the request fails the
+    list holds only the venue id, so failed venues can be found and retried.
     '''
     tips_list = []
-        tips_url = 'https://api.foursquare.com/v2/venues/{}/tips'.format(venue_id)
-        try:
-            tips_resp = requests.get(url=tips_url, params=tips_params)
-            tips_data = json.loads(tips_resp.text)
-            if tips_data['meta']['code'] == 403:
-                print('403 error - Exceeded rate limit')
-                print(tips_data)
-                return tips_list
-            for tip in tips_data['response']['tips']['items']:
-                tips_list.append(tip['text'])
-        except:
-            tips_list.append(venue_id)
+    tips_url = 'https://api.foursquare.com/v2/venues/{}/tips'.format(venue_id)
+    try:
+        tips_resp = http_cache.get(url=tips_url, params=populate_tips_params(credentials), timeout=30)
+        tips_data = json.loads(tips_resp.text)
+    except (requests.RequestException, ValueError, http_cache.CacheMiss) as e:
+        logger.warning('Could not get tips for venue %s: %s', venue_id, e)
+        tips_list.append(venue_id)
+        return tips_list
+    code = tips_data.get('meta', {}).get('code')
+    if code != 200:
+        logger.warning('Could not get tips for venue %s: error %s %s', venue_id, code, tips_data.get('meta'))
+        tips_list.append(venue_id)
+        return tips_list
+    for tip in tips_data['response']['tips']['items']:
+        tips_list.append(tip['text'])
     return tips_list
 
 def populate_search_params(lat, long):
@@ -43,7 +74,7 @@ def get_venue_data(longitude_group, latitude_group):
         for lat in latitude_group:
             search_params = populate_search_params(lat, long)
             try:
-                search_resp = requests.get(url=search_url, params=search_params)
+                search_resp = http_cache.get(url=search_url, params=search_params)
                 search_data = json.loads(search_resp.text)
                 if search_data['meta']['code'] == 403:
                     print('403 error - Exceeded rate limit')
@@ -72,3 +103,112 @@ def write_venue_info_to_file(search_data, filename):
         for item in venues:
             f.write("{}\n".format(item))
     print('Done!')
+
+def populate_cell_search_params(south, west, north, east, credentials):
+    '''
+    Takes in the bounds of a grid cell and Foursquare credentials and outputs search params that browse
+    for coffee shops inside exactly that cell.
+    '''
+    search_params = dict(
+        client_id=credentials['client_id'],
+        client_secret=credentials['client_secret'],
+        sw='{},{}'.format(south, west),
+        ne='{},{}'.format(north, east),
+        intent='browse',
+        limit=str(SEARCH_LIMIT),
+        categoryId=COFFEE_SHOP_CATEGORY,
+        v='20180113' #Date of current version
+        )
+    return search_params
+
+def search_cell(cell, credentials, session, search_url=FOURSQUARE_SEARCH_URL, max_retries=5, backoff=2.0):
+    '''
+    Takes in a (south, west, north, east) cell, credentials and a requests session and outputs the list of
+    venues Foursquare returns for it. Rate-limited requests are retried with exponential backoff; other
+    errors are raised.
+    '''
+    params = populate_cell_search_params(*cell, credentials)
+    for attempt in range(max_retries + 1):
+        search_resp = http_cache.get(search_url, params=params, session=session, timeout=30)
+        search_data = search_resp.json()
+        code = search_data['meta']['code']
+        if code == 200:
+            return search_data['response']['venues']
+        if code not in (403, 429, 500, 502, 503) or attempt == max_retries:
+            raise RuntimeError('Foursquare search failed for cell {}: {}'.format(cell, search_data['meta']))
+        time.sleep(backoff * 2 ** attempt)
+
+def split_cell(cell):
+    '''
+    Takes in a (south, west, north, east) cell and outputs its four quadrants.
+    '''
+    south, west, north, east = cell
+    mid_lat, mid_lng = (south + north) / 2, (west + east) / 2
+    return [(south, west, mid_lat, mid_lng), (south, mid_lng, mid_lat, east),
+            (mid_lat, west, north, mid_lng), (mid_lat, mid_lng, north, east)]
+
+def read_venues_file(filename):
+    '''
+    Takes in a newline-delimited JSON file written by discover_venues and outputs a list of venue dicts.
+    '''
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def discover_venues(bounds, credentials, filename, grid_size=20, max_workers=8, min_cell_size=0.0005,
+                    search_url=FOURSQUARE_SEARCH_URL):
+    '''
+    Takes in (south, west, north, east) bounds, Foursquare credentials and an output filename and finds
+    every coffee shop in the bounds. The area is split into a grid_size x grid_size grid whose cells are
+    searched on a pool of max_workers threads. A cell that returns the full 50-venue limit may be hiding
+    more venues, so it is split into quadrants and searched again, down to min_cell_size degrees.
+
+    Venues are deduplicated by id as results arrive and appended to filename as newline-delimited JSON.
+    Venues already in the file are skipped, so an interrupted run can be resumed. Outputs a dictionary of
+    counts and the list of cells that failed.
+    '''
+    south, west, north, east = bounds
+    lat_step, lng_step = (north - south) / grid_size, (east - west) / grid_size
+    cells = [(south + i * lat_step, west + j * lng_step, south + (i + 1) * lat_step, west + (j + 1) * lng_step)
+             for i in range(grid_size) for j in range(grid_size)]
+
+    seen_ids = set()
+    try:
+        seen_ids.update(venue['id'] for venue in read_venues_file(filename))
+    except FileNotFoundError:
+        pass
+    stats = {'cells_searched': 0, 'cells_split': 0, 'new_venues': 0, 'duplicates': 0,
+             'failed_cells': []}
+
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    with open(filename, 'a') as f, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(search_cell, cell, credentials, session, search_url): cell
+                   for cell in cells}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                cell = pending.pop(future)
+                stats['cells_searched'] += 1
+                try:
+                    venues = future.result()
+                except (RuntimeError, requests.RequestException, ValueError, http_cache.CacheMiss) as e:
+                    logger.warning('Search failed for cell %s: %s', cell, e)
+                    stats['failed_cells'].append(cell)
+                    continue
+                # Only the writer thread touches seen_ids and the file
+                for venue in venues:
+                    if venue['id'] in seen_ids:
+                        stats['duplicates'] += 1
+                        continue
+                    seen_ids.add(venue['id'])
+                    f.write(json.dumps(venue) + '\n')
+                    stats['new_venues'] += 1
+                f.flush()
+                if len(venues) >= SEARCH_LIMIT and cell[2] - cell[0] > min_cell_size:
+                    stats['cells_split'] += 1
+                    for sub_cell in split_cell(cell):
+                        pending[executor.submit(search_cell, sub_cell, credentials, session, search_url)] = sub_cell
+    session.close()
+    logger.info('Searched %(cells_searched)s cells (%(cells_split)s split), found %(new_venues)s new venues', stats)
+    return stats
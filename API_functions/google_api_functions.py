@@ -1,4 +1,5 @@
 import json, requests
+import http_cache
 from io import BytesIO
 import base64
 
@@ -21,7 +22,7 @@ def get_google_api_id(lat, lng, name, api_key):
     Takes in latitude, longitude, name, and Google API key and outputs Google's place id for location.
     '''
     search_url = populate_google_search_url(lat, lng, name, api_key)
-    search_resp = requests.get(url=search_url)
+    search_resp = http_cache.get(url=search_url)
     search_data = json.loads(search_resp.text)
     try:
         return search_data['results'][0]['place_id']
@@ -33,7 +34,7 @@ def get_google_api_photo_id(lat, lng, name, api_key):
     Takes in latitude, longitude, name, and Google API key and outputs Google's photo id for location.
     '''
     search_url = populate_google_search_url(lat, lng, name, api_key)
-    search_resp = requests.get(url=search_url)
+    search_resp = http_cache.get(url=search_url)
     search_data = json.loads(search_resp.text)
     try:
         return search_data['results'][0]['photos'][0]['photo_reference']
@@ -44,16 +45,25 @@ def get_google_photo(lat, lng, name, api_key):
     try:
         photoreference = get_google_api_photo_id(lat, lng, name, api_key)
         photo_url = populate_google_photos_url(photoreference, api_key)
-        photo_resp = requests.get(url=photo_url)
+        photo_resp = http_cache.get(url=photo_url)
         return photo_resp.content
     except:
         return None
 
 def get_google_photo_from_ref(photoreference, api_key):
     photo_url = populate_google_photos_url(photoreference, api_key)
-    photo_resp = requests.get(url=photo_url)
+    photo_resp = http_cache.get(url=photo_url)
     return base64.b64encode(photo_resp.content).encode()
 
+def save_google_photo(photoreference, api_key, filename, maxwidth=800):
+    '''
+    Takes in the photo reference id, Google API key and a file path and writes the photo there, e.g. website/static/shop_images/<shop_id>.jpg for the image store build step.
+    '''
+    photo_url = populate_google_photos_url(photoreference, api_key, maxwidth)
+    photo_resp = http_cache.get(url=photo_url)
+    with open(filename, 'wb') as f:
+        f.write(photo_resp.content)
+
 def populate_google_details_url(google_id, api_key):
     '''
     Takes in place id and Google api key, and outputs the applicable api url.
@@ -66,7 +76,7 @@ def get_google_id_reviews(google_id, api_key):
     Takes in place id and Google API key and outputs text reviews for locations.
     '''
     details_url = populate_google_details_url(google_id, api_key)
-    details_resp = requests.get(url=details_url)
+    details_resp = http_cache.get(url=details_url)
     details_data = json.loads(details_resp.text)
     reviews_list = []
     try:
@@ -81,7 +91,7 @@ def fill_address_with_google_ids(google_id, api_key):
     Takes in a google place id and Google API key and outputs address pulled from Google's API.
     '''
     details_url = populate_google_details_url(google_id, api_key)
-    details_resp = requests.get(url=details_url)
+    details_resp = http_cache.get(url=details_url)
     details_data = json.loads(details_resp.text)
     try:
         address = details_data['result']['formatted_address'].split(',')[0]
@@ -0,0 +1,205 @@
+'''
+On-disk HTTP response cache shared by the functions in API_functions.
+
+Responses are stored in SQLite, keyed by a hash of the request URL and
+parameters with API keys and credentials removed, so the same lookup made by
+different functions (or different runs, or different keys) is only sent
+once. Identical bodies are stored once, addressed by their own hash. Each
+endpoint has its own time-to-live, and offline mode replays the cache
+without touching the network.
+
+The cache lives at $API_CACHE_PATH (default ~/.cache/coffee_filter/api_cache.sqlite3)
+and offline mode is turned on with API_CACHE_OFFLINE=1 or configure(offline=True).
+'''
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+
+DAY = 24 * 3600
+
+# Parameters and headers that carry credentials rather than describe the request
+SECRET_PARAMS = {'key', 'client_id', 'client_secret', 'api_key', 'access_token', 'oauth_token'}
+
+# (URL pattern, seconds) checked in order; the first match sets an entry's time-to-live
+DEFAULT_TTLS = [
+    (r'maps\.googleapis\.com/maps/api/place/photo', 180 * DAY),
+    (r'/maps/api/place/details/', 30 * DAY),
+    (r'/maps/api/place/nearbysearch/', 30 * DAY),
+    (r'/v2/venues/search', 30 * DAY),
+    (r'/v2/venues/[^/]+/tips', 7 * DAY),
+    (r'/v3/businesses/search', 30 * DAY),
+    (r'/v3/businesses/[^/]+/reviews', 7 * DAY),
+    (r'/v3/businesses/', 30 * DAY),
+    (r'', DAY),
+]
+
+# Google reports these with HTTP 200, but they must not be replayed
+UNCACHEABLE_GOOGLE_STATUSES = {'OVER_QUERY_LIMIT', 'REQUEST_DENIED', 'UNKNOWN_ERROR', 'INVALID_REQUEST'}
+
+class CacheMiss(Exception):
+    '''
+    Raised in offline mode when a request is not in the cache.
+    '''
+
+class CachedResponse():
+    '''
+    The parts of a requests.Response the API functions use.
+    '''
+    def __init__(self, status_code, content, headers, from_cache):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+def normalize_request(url, params=None):
+    '''
+    Takes in a URL and optional params and outputs a canonical URL with the params merged in, sorted, and
+    credentials removed.
+    '''
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if params:
+        items = params.items() if hasattr(params, 'items') else params
+        query += [(str(key), str(value)) for key, value in items if value is not None]
+    query = sorted((key, value) for key, value in query if key not in SECRET_PARAMS)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ''))
+
+def default_cacheable(response):
+    '''
+    Takes in a response and outputs whether it is safe to replay: HTTP 200 and not a Google error status.
+    '''
+    if response.status_code != 200:
+        return False
+    if response.headers.get('Content-Type', '').startswith('application/json'):
+        try:
+            return response.json().get('status') not in UNCACHEABLE_GOOGLE_STATUSES
+        except (ValueError, AttributeError):
+            return False
+    return True
+
+class HTTPCache():
+    '''
+    SQLite-backed, content-addressed cache of GET responses.
+    '''
+    def __init__(self, path, offline=False, ttls=None):
+        self.path = path
+        self.offline = offline
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in (ttls or DEFAULT_TTLS)]
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0}
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS bodies (body_hash TEXT PRIMARY KEY, body BLOB)')
+            conn.execute('CREATE TABLE IF NOT EXISTS responses (request_hash TEXT PRIMARY KEY, url TEXT, '
+                         'status INTEGER, headers TEXT, body_hash TEXT, fetched_at REAL)')
+
+    def _connection(self):
+        # SQLite connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def ttl_for(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return DAY
+
+    def lookup(self, normalized_url):
+        '''
+        Takes in a normalized URL and outputs the cached CachedResponse, or None if missing or expired.
+        '''
+        request_hash = hashlib.sha256(normalized_url.encode()).hexdigest()
+        row = self._connection().execute(
+            'SELECT r.status, r.headers, r.fetched_at, b.body FROM responses r '
+            'JOIN bodies b ON r.body_hash = b.body_hash WHERE r.request_hash = ?',
+            (request_hash,)).fetchone()
+        if row is None:
+            return None
+        status, headers, fetched_at, body = row
+        if not self.offline and time.time() - fetched_at > self.ttl_for(normalized_url):
+            return None
+        return CachedResponse(status, bytes(body), json.loads(headers), from_cache=True)
+
+    def store(self, normalized_url, response):
+        '''
+        Takes in a normalized URL and a response and saves the response.
+        '''
+        body_hash = hashlib.sha256(response.content).hexdigest()
+        request_hash = hashlib.sha256(normalized_url.encode()).hexdigest()
+        headers = {'Content-Type': response.headers.get('Content-Type', '')}
+        with self._connection() as conn:
+            conn.execute('INSERT OR IGNORE INTO bodies VALUES (?, ?)', (body_hash, response.content))
+            conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                         (request_hash, normalized_url, response.status_code, json.dumps(headers),
+                          body_hash, time.time()))
+        self._count('stored')
+
+    def get(self, url, params=None, headers=None, session=None, cacheable=default_cacheable, **kwargs):
+        '''
+        Takes in the same arguments as requests.get (plus an optional session) and outputs a
+        CachedResponse, sending the request only when it is not cached or has expired. In offline mode
+        a miss raises CacheMiss.
+        '''
+        normalized_url = normalize_request(url, params)
+        cached = self.lookup(normalized_url)
+        if cached is not None:
+            self._count('hits')
+            return cached
+        self._count('misses')
+        if self.offline:
+            raise CacheMiss('Not cached: {}'.format(normalized_url))
+        response = (session or requests).get(url, params=params, headers=headers, **kwargs)
+        if cacheable(response):
+            self.store(normalized_url, response)
+        return CachedResponse(response.status_code, response.content, response.headers, from_cache=False)
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+def configure(path=None, offline=None, ttls=None):
+    '''
+    Takes in an optional cache path, offline flag and TTL list and replaces the shared cache used by get.
+    '''
+    global _default_cache
+    with _default_lock:
+        path = path or os.environ.get('API_CACHE_PATH',
+                                      os.path.expanduser('~/.cache/coffee_filter/api_cache.sqlite3'))
+        if offline is None:
+            offline = os.environ.get('API_CACHE_OFFLINE', '') not in ('', '0')
+        _default_cache = HTTPCache(path, offline, ttls)
+    return _default_cache
+
+def get_cache():
+    if _default_cache is None:
+        configure()
+    return _default_cache
+
+def get(url, params=None, headers=None, **kwargs):
+    '''
+    Drop-in replacement for requests.get that goes through the shared cache.
+    '''
+    return get_cache().get(url, params=params, headers=headers, **kwargs)
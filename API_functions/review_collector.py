@@ -0,0 +1,376 @@
+'''
+Concurrent review collector for Foursquare tips, Google Places reviews and
+Yelp reviews. Requests run on asyncio with a pooled HTTP session and a
+token-bucket rate limiter per provider, rate-limit and server errors are
+retried with exponential backoff, and every finished venue is appended to a
+checkpoint file so an interrupted crawl resumes where it stopped.
+
+Usage:
+    python review_collector.py --venues ../data/seattle_coffeeshops_foursquare_google_yelp_cleaned.csv
+        --checkpoint reviews_checkpoint.jsonl
+        [--foursquare-secrets ~/.secrets/foursquare_api.yaml]
+        [--google-secrets ~/.secrets/google_api.yaml]
+        [--yelp-secrets ~/.secrets/yelp_api.yaml]
+        [--base-url http://127.0.0.1:8089]
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import http_cache
+
+class RateLimited(Exception):
+    '''
+    Raised when a provider reports that its quota was exceeded.
+    '''
+
+class TransientError(Exception):
+    '''
+    Raised for responses worth retrying, such as server errors.
+    '''
+
+class TokenBucket():
+    '''
+    Async token bucket allowing `rate` requests per second on average with
+    bursts of up to `capacity` requests.
+    '''
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        '''
+        Takes in a number of seconds and drains the bucket so no request is released before then.
+        '''
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+class Provider():
+    '''
+    How to request and parse one API's reviews. Subclasses define the URL,
+    parameters, headers and response parsing; rate, burst and pool_size set
+    the default quota and connection pool.
+    '''
+    name = None
+    base_url = None
+    rate = 1.0
+    burst = 1
+    pool_size = 4
+
+    def __init__(self, credentials, base_url=None, rate=None, burst=None):
+        self.credentials = credentials
+        self.base_url = base_url or self.base_url
+        self.rate = rate or self.rate
+        self.burst = burst or self.burst
+
+    def request(self, item_id):
+        '''
+        Takes in an item id and outputs (url, params, headers) for its reviews.
+        '''
+        raise NotImplementedError
+
+    def parse(self, status_code, data):
+        '''
+        Takes in a response status and decoded JSON and outputs a list of review texts.
+        Raises RateLimited or TransientError when the request should be retried.
+        '''
+        raise NotImplementedError
+
+class FoursquareTips(Provider):
+    name = 'foursquare'
+    base_url = 'https://api.foursquare.com'
+    # 5,000 userless requests per hour
+    rate = 5000 / 3600
+    burst = 5
+
+    def request(self, item_id):
+        params = dict(client_id=self.credentials['client_id'],
+                      client_secret=self.credentials['client_secret'],
+                      limit=500,
+                      v='20180113')
+        return '{}/v2/venues/{}/tips'.format(self.base_url, item_id), params, {}
+
+    def parse(self, status_code, data):
+        code = data.get('meta', {}).get('code', status_code)
+        if code in (403, 429) and data.get('meta', {}).get('errorType') in (None, 'rate_limit_exceeded', 'quota_exceeded'):
+            raise RateLimited('Foursquare rate limit: {}'.format(data.get('meta')))
+        if code >= 500:
+            raise TransientError('Foursquare error {}'.format(code))
+        if code != 200:
+            raise ValueError('Foursquare error {}: {}'.format(code, data.get('meta')))
+        return [tip['text'] for tip in data['response']['tips']['items']]
+
+class GooglePlaceReviews(Provider):
+    name = 'google'
+    base_url = 'https://maps.googleapis.com'
+    # Places allows 100 requests per second; stay well under it
+    rate = 50
+    burst = 50
+    pool_size = 16
+
+    def request(self, item_id):
+        params = dict(placeid=item_id, language='english', key=self.credentials['key'])
+        return '{}/maps/api/place/details/json'.format(self.base_url), params, {}
+
+    def parse(self, status_code, data):
+        status = data.get('status')
+        if status == 'OVER_QUERY_LIMIT' or status_code == 429:
+            raise RateLimited('Google rate limit')
+        if status == 'UNKNOWN_ERROR' or status_code >= 500:
+            raise TransientError('Google error {}'.format(status or status_code))
+        if status not in ('OK', 'ZERO_RESULTS'):
+            raise ValueError('Google error {}: {}'.format(status, data.get('error_message')))
+        return [review['text'] for review in data.get('result', {}).get('reviews', [])]
+
+class YelpReviews(Provider):
+    name = 'yelp'
+    base_url = 'https://api.yelp.com'
+    # Yelp Fusion throttles above roughly 10 requests per second
+    rate = 5
+    burst = 10
+    pool_size = 8
+
+    def request(self, item_id):
+        headers = {'Authorization': 'Bearer {}'.format(self.credentials['api_key'])}
+        return ('{}/v3/businesses/{}/reviews'.format(self.base_url, item_id),
+                {'locale': 'en_US'}, headers)
+
+    def parse(self, status_code, data):
+        if status_code == 429:
+            raise RateLimited('Yelp rate limit: {}'.format(data.get('error')))
+        if status_code >= 500:
+            raise TransientError('Yelp error {}'.format(status_code))
+        if status_code != 200:
+            raise ValueError('Yelp error {}: {}'.format(status_code, data.get('error')))
+        return [review['text'] for review in data.get('reviews', [])]
+
+PROVIDERS = {provider.name: provider for provider in (FoursquareTips, GooglePlaceReviews, YelpReviews)}
+
+class Checkpoint():
+    '''
+    Append-only JSON lines file of finished (provider, item id) requests.
+    Successful results are skipped when a crawl is resumed; failures are retried.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.results = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by an interrupted write
+                        continue
+                    if 'reviews' in record:
+                        self.results[(record['provider'], record['id'])] = record['reviews']
+        self.file = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.file = open(path, 'a')
+
+    def done(self, provider, item_id):
+        return (provider, item_id) in self.results
+
+    def record(self, provider, item_id, reviews=None, error=None):
+        if reviews is not None:
+            self.results[(provider, item_id)] = reviews
+        if self.file:
+            record = {'provider': provider, 'id': item_id}
+            if error is None:
+                record['reviews'] = reviews
+            else:
+                record['error'] = error
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+class ReviewCollector():
+    '''
+    Fetches reviews for many (provider, item id) jobs concurrently while
+    keeping each provider under its rate limit.
+    '''
+    def __init__(self, credentials, checkpoint_path=None, base_urls=None,
+                 max_retries=6, backoff=1.0, max_backoff=120, rates=None):
+        '''
+        Takes in a dictionary of credentials per provider name, an optional checkpoint
+        path, optional base URLs per provider (e.g. a stub server), retry settings and
+        optional (rate, burst) overrides per provider.
+        '''
+        base_urls = base_urls or {}
+        rates = rates or {}
+        self.providers = {name: PROVIDERS[name](creds, base_urls.get(name), *rates.get(name, (None, None)))
+                          for name, creds in credentials.items()}
+        self.checkpoint_path = checkpoint_path
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = {'requests': 0, 'cached': 0, 'retries': 0, 'rate_limited': 0, 'failed': 0,
+                      'skipped': 0}
+
+    async def _fetch(self, provider, session, executor, bucket, item_id, checkpoint):
+        loop = asyncio.get_running_loop()
+        url, params, headers = provider.request(item_id)
+        cache = http_cache.get_cache()
+        # Cached responses don't count against the provider's quota
+        cached = cache.lookup(http_cache.normalize_request(url, params))
+        if cached is not None:
+            try:
+                reviews = provider.parse(cached.status_code, cached.json())
+                checkpoint.record(provider.name, item_id, reviews)
+                self.stats['cached'] += 1
+                return reviews
+            except (RateLimited, TransientError, ValueError, KeyError):
+                pass
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            self.stats['requests'] += 1
+            try:
+                response = await loop.run_in_executor(
+                    executor, lambda: cache.get(url, params=params, headers=headers, session=session,
+                                                timeout=30))
+                try:
+                    data = response.json()
+                except ValueError:
+                    raise TransientError('Invalid JSON with status {}'.format(response.status_code))
+                reviews = provider.parse(response.status_code, data)
+                checkpoint.record(provider.name, item_id, reviews)
+                return reviews
+            except http_cache.CacheMiss as e:
+                error = e
+                break
+            except (RateLimited, TransientError, requests.ConnectionError, requests.Timeout) as e:
+                if isinstance(e, RateLimited):
+                    self.stats['rate_limited'] += 1
+                if attempt == self.max_retries:
+                    error = e
+                    break
+                self.stats['retries'] += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                if isinstance(e, RateLimited):
+                    # Hold back every request to this provider, not just this one
+                    bucket.pause(delay)
+                await asyncio.sleep(delay)
+            except (ValueError, KeyError, requests.RequestException) as e:
+                error = e
+                break
+        self.stats['failed'] += 1
+        checkpoint.record(provider.name, item_id, error='{}: {}'.format(type(error).__name__, error))
+        return None
+
+    async def collect_async(self, jobs):
+        '''
+        Takes in an iterable of (provider name, item id) jobs and outputs a dictionary
+        mapping each job to its list of reviews (None if it failed).
+        '''
+        checkpoint = Checkpoint(self.checkpoint_path)
+        results = {}
+        sessions, executors, buckets, tasks = {}, {}, {}, []
+        try:
+            for name, provider in self.providers.items():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=provider.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                sessions[name] = session
+                executors[name] = ThreadPoolExecutor(max_workers=provider.pool_size)
+                buckets[name] = TokenBucket(provider.rate, provider.burst)
+            semaphores = {name: asyncio.Semaphore(provider.pool_size)
+                          for name, provider in self.providers.items()}
+
+            async def run(name, item_id):
+                async with semaphores[name]:
+                    results[(name, item_id)] = await self._fetch(
+                        self.providers[name], sessions[name], executors[name],
+                        buckets[name], item_id, checkpoint)
+
+            for name, item_id in jobs:
+                if checkpoint.done(name, item_id):
+                    self.stats['skipped'] += 1
+                    results[(name, item_id)] = checkpoint.results[(name, item_id)]
+                else:
+                    tasks.append(run(name, item_id))
+            await asyncio.gather(*tasks)
+        finally:
+            for session in sessions.values():
+                session.close()
+            for executor in executors.values():
+                executor.shutdown(wait=False)
+            checkpoint.close()
+        return results
+
+    def collect(self, jobs):
+        '''
+        Synchronous wrapper around collect_async.
+        '''
+        return asyncio.run(self.collect_async(jobs))
+
+def venue_jobs(df, providers=('foursquare', 'google', 'yelp')):
+    '''
+    Takes in the venue dataframe (columns id, google_ids, yelp_ids) and outputs
+    deduplicated (provider, item id) jobs, skipping missing ids.
+    '''
+    id_columns = {'foursquare': 'id', 'google': 'google_ids', 'yelp': 'yelp_ids'}
+    jobs = []
+    for name in providers:
+        for item_id in df[id_columns[name]].dropna().unique():
+            jobs.append((name, str(item_id)))
+    return jobs
+
+def main():
+    import pandas as pd
+    import yaml
+
+    parser = argparse.ArgumentParser(description='Collect reviews for every venue concurrently')
+    parser.add_argument('--venues', required=True)
+    parser.add_argument('--checkpoint', default='reviews_checkpoint.jsonl')
+    parser.add_argument('--foursquare-secrets')
+    parser.add_argument('--google-secrets')
+    parser.add_argument('--yelp-secrets')
+    parser.add_argument('--base-url', help='Send every provider to this host, e.g. the stub server')
+    args = parser.parse_args()
+
+    credentials = {}
+    for name, path in [('foursquare', args.foursquare_secrets),
+                       ('google', args.google_secrets),
+                       ('yelp', args.yelp_secrets)]:
+        if path:
+            with open(os.path.expanduser(path)) as f:
+                credentials[name] = yaml.safe_load(f)
+    if not credentials:
+        parser.error('Pass at least one of --foursquare-secrets, --google-secrets, --yelp-secrets')
+
+    base_urls = {name: args.base_url for name in credentials} if args.base_url else None
+    collector = ReviewCollector(credentials, args.checkpoint, base_urls)
+    jobs = venue_jobs(pd.read_csv(args.venues), list(credentials))
+    start = time.time()
+    results = collector.collect(jobs)
+    print('Collected {} of {} jobs in {:.1f}s: {}'.format(
+        sum(reviews is not None for reviews in results.values()), len(jobs),
+        time.time() - start, collector.stats))
+
+if __name__ == '__main__':
+    main()
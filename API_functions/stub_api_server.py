@@ -0,0 +1,154 @@
+'''
+Local stand-in for the Foursquare, Google Places and Yelp endpoints used by
+the review collector. Responses have the same shape as the real APIs, and the
+server can add latency and rate-limit responses so retry and backoff logic
+can be exercised offline.
+
+Usage: python stub_api_server.py [--port 8089] [--latency 0.05] [--rate-limit-every 10]
+'''
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+def fake_reviews(provider, item_id, count=3):
+    '''
+    Takes in a provider name and item id and outputs a deterministic list of review texts.
+    '''
+    seed = hashlib.md5('{}:{}'.format(provider, item_id).encode()).hexdigest()[:6]
+    return ['{} review {} for {} ({})'.format(provider, i, item_id, seed) for i in range(count)]
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    '''
+    Serves Foursquare tips and venue search, Google Places nearby search and
+    details, and Yelp business search, details and reviews.
+    '''
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            request_number = server.request_count
+            server.paths.append(self.path)
+        if server.latency:
+            time.sleep(server.latency)
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+        rate_limited = (server.rate_limit_every
+                        and request_number % server.rate_limit_every == 0)
+
+        if parts[:2] == ['v2', 'venues']:
+            if rate_limited:
+                return self._send(403, {'meta': {'code': 403, 'errorType': 'rate_limit_exceeded'},
+                                        'response': {}})
+            if parts[2:] == ['search']:
+                return self._send(200, {'meta': {'code': 200},
+                                        'response': {'venues': server.venues_in(params)}})
+            tips = [{'text': text} for text in fake_reviews('foursquare', parts[2])]
+            return self._send(200, {'meta': {'code': 200},
+                                    'response': {'tips': {'count': len(tips), 'items': tips}}})
+
+        if parts[:3] == ['maps', 'api', 'place']:
+            if rate_limited:
+                return self._send(200, {'status': 'OVER_QUERY_LIMIT', 'results': []})
+            if parts[3] == 'details':
+                place_id = params.get('placeid', '')
+                reviews = [{'text': text} for text in fake_reviews('google', place_id)]
+                return self._send(200, {'status': 'OK', 'result': {
+                    'place_id': place_id, 'reviews': reviews,
+                    'formatted_address': '{} Stub St, Seattle, WA'.format(len(place_id))}})
+            keyword = params.get('keyword', '')
+            return self._send(200, {'status': 'OK', 'results': [{
+                'place_id': 'g-' + hashlib.md5(keyword.encode()).hexdigest()[:10],
+                'photos': [{'photo_reference': 'p-' + keyword}]}]})
+
+        if parts[:2] == ['v3', 'businesses']:
+            if rate_limited:
+                return self._send(429, {'error': {'code': 'TOO_MANY_REQUESTS_PER_SECOND'}})
+            if parts[2:] == ['search']:
+                term = params.get('term', '')
+                return self._send(200, {'businesses': [
+                    {'id': 'y-' + hashlib.md5(term.encode()).hexdigest()[:10]}]})
+            if parts[3:] == ['reviews']:
+                reviews = [{'text': text} for text in fake_reviews('yelp', parts[2])]
+                return self._send(200, {'reviews': reviews, 'total': len(reviews)})
+            return self._send(200, {'id': parts[2], 'location': {'address1': '1 Stub Ave'}})
+
+        return self._send(404, {'error': 'unknown path {}'.format(url.path)})
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubAPIServer(ThreadingHTTPServer):
+    '''
+    Threaded HTTP server that counts requests for StubAPIHandler.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, rate_limit_every=0, venues=None):
+        super().__init__(address, StubAPIHandler)
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        # (venue id, lat, lng) tuples returned by Foursquare venue search
+        self.venues = venues or []
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.paths = []
+
+    def venues_in(self, params):
+        '''
+        Takes in Foursquare search params (sw/ne bounds or ll/radius) and outputs at most `limit` stub
+        venues in the searched area, nearest the area's center first like the real API.
+        '''
+        if 'sw' in params:
+            south, west = [float(value) for value in params['sw'].split(',')]
+            north, east = [float(value) for value in params['ne'].split(',')]
+        else:
+            lat, lng = [float(value) for value in params['ll'].split(',')]
+            radius = float(params.get('radius', 200)) / 111000
+            south, west, north, east = lat - radius, lng - radius, lat + radius, lng + radius
+        center = ((south + north) / 2, (west + east) / 2)
+        matches = sorted((abs(lat - center[0]) + abs(lng - center[1]), venue_id, lat, lng)
+                         for venue_id, lat, lng in self.venues
+                         if south <= lat < north and west <= lng < east)
+        return [{'id': venue_id, 'name': 'Stub venue {}'.format(venue_id),
+                 'location': {'lat': lat, 'lng': lng}}
+                for _, venue_id, lat, lng in matches[:int(params.get('limit', 50))]]
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+def start_stub_server(port=0, latency=0.0, rate_limit_every=0, venues=None):
+    '''
+    Starts a stub server on a background thread and outputs it. Its base_url
+    can be passed to the collector in place of each API's host.
+    '''
+    server = StubAPIServer(('127.0.0.1', port), latency, rate_limit_every, venues)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub Foursquare/Google/Yelp API server')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--rate-limit-every', type=int, default=0)
+    args = parser.parse_args()
+    server = StubAPIServer(('127.0.0.1', args.port), args.latency, args.rate_limit_every)
+    print('Stub APIs listening on {}'.format(server.base_url))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
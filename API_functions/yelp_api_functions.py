@@ -1,3 +1,6 @@
+import json
+import http_cache
+
 def yelp_search_params(lat, lng, name):
     search_params = dict(
         term=name,
@@ -14,8 +17,8 @@ def get_yelp_api_id(lat, lng, name, key):
     '''
     yelp_search_url = 'https://api.yelp.com/v3/businesses/search'
     search_params = yelp_search_params(lat, lng, name)
-    search_resp = requests.get(url=yelp_search_url, params=search_params,
-                               headers={'Authorization':'Bearer {}'.format(key)})
+    search_resp = http_cache.get(url=yelp_search_url, params=search_params,
+                                 headers={'Authorization':'Bearer {}'.format(key)})
     search_data = json.loads(search_resp.text)
     try:
         return search_data['businesses'][0]['id']
@@ -34,8 +37,8 @@ def get_yelp_id_reviews(yelp_id, api_key):
     Takes in Yelp id and Yelp API key and outputs text reviews for locations.
     '''
     yelp_reviews_url = populate_yelp_reviews_url(yelp_id)
-    reviews_resp = requests.get(url=yelp_reviews_url, params={'locale':'en_US'},
-                               headers={'Authorization':'Bearer {}'.format(api_key)})
+    reviews_resp = http_cache.get(url=yelp_reviews_url, params={'locale':'en_US'},
+                                 headers={'Authorization':'Bearer {}'.format(api_key)})
     reviews_data = json.loads(reviews_resp.text)
     #return reviews_data
     reviews_list = []
@@ -51,8 +54,8 @@ def fill_addresses_with_yelp_ids(yelp_id, api_key):
     Takes in Yelp id and Yelp API key and outputs location address.
     '''
     yelp_search_url = 'https://api.yelp.com/v3/businesses/{}'.format(yelp_id)
-    search_resp = requests.get(url=yelp_search_url,
-                               headers={'Authorization':'Bearer {}'.format(api_key)})
+    search_resp = http_cache.get(url=yelp_search_url,
+                                 headers={'Authorization':'Bearer {}'.format(api_key)})
     search_data = json.loads(search_resp.text)
     try:
         return search_data['location']['address1']
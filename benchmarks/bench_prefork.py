@@ -0,0 +1,152 @@
+'''
+Measures how /submit throughput scales with the number of website/serve.py
+workers. For each worker count it starts the server, drives it with closed
+loop load from several client processes (so the load generator isn't held
+to one core itself) and reports throughput, latency percentiles and memory.
+
+Memory is read from /proc/<pid>/smaps_rollup: Rss counts every page a
+process maps, Pss splits shared pages between the processes sharing them.
+Total Pss close to one process's Rss means the workers share the model
+rather than each holding a copy.
+
+Usage:
+    python benchmarks/bench_prefork.py [--workers 1,2,4,8] [--duration 20]
+
+Throughput can only grow while workers have cores to run on; pass a client
+and worker count that fit the machine (os.cpu_count() is printed).
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+from load_test import WEBSITE_DIR, generate_requests, run_load, summarize, wait_until_ready
+
+def memory_kb(pid):
+    '''
+    Returns a process's (Rss, Pss) in kB, or (0, 0) if it can't be read.
+    '''
+
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return 0, 0
+    return int(fields['Rss'].split()[0]), int(fields['Pss'].split()[0])
+
+def _client_process(args):
+    url, requests, concurrency, duration, timeout = args
+    return run_load(url, requests, concurrency, duration, timeout=timeout)
+
+def run_level(workers, requests, args):
+    '''
+    Starts serve.py with a number of workers and loads it.
+
+    Output:
+    -------
+    row: Dictionary - The summary row from load_test.summarize for all
+    requests plus workers, memory and restart counts
+    '''
+
+    url = 'http://127.0.0.1:{}'.format(args.port)
+    process = subprocess.Popen([sys.executable, 'serve.py', '--workers', str(workers),
+                                '--bind', '127.0.0.1:{}'.format(args.port)],
+                               cwd=WEBSITE_DIR, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(url, timeout=120, process=process)
+        #Wait until every worker has sent a heartbeat, so none is still starting
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            with urllib.request.urlopen(url + '/_workers') as response:
+                table = json.load(response)['workers']
+            if all(worker['healthy'] for worker in table):
+                break
+            time.sleep(0.5)
+
+        clients = args.clients or max(1, min(workers, os.cpu_count() or 1))
+        per_client = max(1, args.concurrency * workers // clients)
+        shares = [(url, requests[i::clients], per_client, args.duration, args.timeout)
+                  for i in range(clients)]
+        with multiprocessing.get_context('fork').Pool(clients) as pool:
+            outputs = pool.map(_client_process, shares)
+        results = [result for output, _ in outputs for result in output]
+        elapsed = max(elapsed for _, elapsed in outputs)
+
+        with urllib.request.urlopen(url + '/_workers') as response:
+            table = json.load(response)['workers']
+        pids = [process.pid] + [worker['pid'] for worker in table]
+        memory = [memory_kb(pid) for pid in pids]
+    finally:
+        process.terminate()
+        process.wait()
+
+    row = summarize(results, elapsed, args.warmup)['all']
+    row.update({'workers': workers, 'clients': clients * per_client,
+                'rss_mb': memory[0][0] / 1024,
+                'worker_rss_mb': sum(rss for rss, _ in memory[1:]) / 1024,
+                'total_pss_mb': sum(pss for _, pss in memory) / 1024,
+                'restarts': sum(worker['restarts'] for worker in table)})
+    return row
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', default=None,
+                        help='Comma separated worker counts (Default: 1, 2, 4, ... up to the '
+                        'number of cores)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Client connections per worker (Default: 8)')
+    parser.add_argument('--clients', type=int,
+                        help='Client processes (Default: one per worker, up to the cores)')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds per level (Default: 20)')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='Seconds excluded from each level (Default: 2)')
+    parser.add_argument('--unique-requests', type=int, default=20000)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--port', type=int, default=5057)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='Write the rows to this JSON file')
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    if args.workers:
+        levels = [int(n) for n in args.workers.split(',')]
+    else:
+        levels = [n for n in (1, 2, 4, 8, 16, 32, 64) if n < cores] + [cores]
+        levels = sorted(set(levels))
+
+    rng = np.random.default_rng(args.seed)
+    mapping_df = pd.read_csv(os.path.join(ROOT_DIR, 'data', 'mapping_df.csv'), index_col=0)
+    shops = pd.read_csv(os.path.join(ROOT_DIR, 'data', 'df_with_features.csv'), index_col=0)
+    requests = generate_requests(list(mapping_df.columns), shops['shop_id'].tolist(),
+                                 args.unique_requests, {'submit': 1.0}, rng)
+
+    print('{} cores; /submit closed loop for {:g} s per level\n'.format(cores, args.duration))
+    print('{:>7} {:>7} {:>9} {:>8} {:>9} {:>9} {:>7} {:>10} {:>12} {:>12}'.format(
+        'workers', 'clients', 'req/s', 'speedup', 'p50 ms', 'p99 ms', 'errors',
+        'parent MB', 'workers Rss', 'total Pss'))
+    rows = []
+    for workers in levels:
+        row = run_level(workers, requests, args)
+        rows.append(row)
+        print('{:>7} {:>7} {:>9.1f} {:>7.2f}x {:>9.2f} {:>9.2f} {:>7} {:>10.1f} {:>12.1f} {:>12.1f}'
+              .format(workers, row['clients'], row['throughput'],
+                      row['throughput'] / rows[0]['throughput'], row.get('p50_ms', float('nan')),
+                      row.get('p99_ms', float('nan')), row['errors'], row['rss_mb'],
+                      row['worker_rss_mb'], row['total_pss_mb']))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'cores': cores, 'duration': args.duration, 'rows': rows}, f,
+                      indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
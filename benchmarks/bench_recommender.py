@@ -0,0 +1,234 @@
+'''
+Benchmarks each stage of the recommender hot path on the real shops and on
+synthetic shop sets 10x-1000x larger, reporting p50/p95/p99 latency,
+throughput and peak traced memory per stage. Runs offline from the CSVs in
+data/.
+
+Synthetic sets tile copies of Seattle's shops side by side, so shop density
+and the shape of the data stay realistic while the covered area grows. Each
+copy's W rows are perturbed with lognormal noise.
+
+Usage:
+    python benchmarks/bench_recommender.py [--scales 1 10 100] [--save baseline.json]
+    python benchmarks/bench_recommender.py --compare baseline.json [--threshold 0.25]
+Comparison exits with status 1 if any stage's p50 or p95 regressed by more
+than the threshold.
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+from recommender_model import META_COLUMNS, RecommenderModel
+import coffee_shop_recommender_functions
+
+# Shop counts above which the row-wise pandas implementation is skipped
+LEGACY_MAX_SHOPS = 40000
+# Regressions smaller than this many milliseconds are treated as noise
+MIN_REGRESSION_MS = 0.05
+
+def synthetic_inputs(df, scale, rng, noise=0.3):
+    '''
+    Builds a recommender dataframe scale times the size of df.
+
+    Parameters:
+    -----------
+    df: Pandas DataFrame - The real recommender dataframe
+    scale: Int - Number of copies
+    rng: Numpy Generator
+    noise: Float - Sigma of the lognormal noise applied to copies' W rows
+
+    Output:
+    -------
+    scaled_df: Pandas DataFrame - Same columns as df, unique shop_ids
+    bounds: Tuple (south, west, north, east) - Area the shops cover
+    '''
+
+    south, north = df['lat'].min(), df['lat'].max()
+    west, east = df['lng'].min(), df['lng'].max()
+    if scale == 1:
+        return df, (south, west, north, east)
+    tiles = int(np.ceil(np.sqrt(scale)))
+    latent_columns = df.columns.drop(META_COLUMNS)
+    copies = []
+    for copy in range(scale):
+        row, col = divmod(copy, tiles)
+        shops = df.copy()
+        shops['lat'] = shops['lat'] + row * (north - south)
+        shops['lng'] = shops['lng'] + col * (east - west)
+        shops['shop_id'] = shops['shop_id'] + copy * (df['shop_id'].max() + 1)
+        if copy:
+            shops[latent_columns] = shops[latent_columns].to_numpy() * rng.lognormal(
+                0, noise, size=(len(shops), len(latent_columns)))
+        copies.append(shops)
+    scaled_df = pd.concat(copies, ignore_index=True)
+    rows = int(np.ceil(scale / tiles))
+    return scaled_df, (south, west, south + rows * (north - south), west + tiles * (east - west))
+
+def random_queries(features, bounds, n_queries, rng):
+    '''
+    Generates user queries with three distinct random features, weights from
+    1 to 100, a location inside bounds and a range of 0.5 to 5 miles.
+    '''
+
+    south, west, north, east = bounds
+    queries = []
+    for _ in range(n_queries):
+        names = rng.choice(features, 3, replace=False)
+        weights = rng.integers(1, 101, 3).astype(float)
+        queries.append(dict(f1=(weights[0], names[0]), f2=(weights[1], names[1]),
+                            f3=(weights[2], names[2]), lat=rng.uniform(south, north),
+                            lng=rng.uniform(west, east), r=rng.uniform(0.5, 5), n=3))
+    return queries
+
+def time_calls(fn, calls):
+    '''
+    Calls fn once per argument tuple and returns each call's latency in
+    seconds.
+    '''
+
+    latencies = np.empty(len(calls))
+    for i, args in enumerate(calls):
+        start = time.perf_counter()
+        fn(*args)
+        latencies[i] = time.perf_counter() - start
+    return latencies
+
+def peak_memory(fn, calls):
+    '''
+    Returns the peak traced allocation, in bytes, over a few calls of fn.
+    Run separately from timing since tracing slows allocations down.
+    '''
+
+    tracemalloc.start()
+    try:
+        for args in calls:
+            fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def summarize(latencies, memory):
+    return {'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p95_ms': float(np.percentile(latencies, 95) * 1000),
+            'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            'throughput': float(len(latencies) / latencies.sum()),
+            'peak_kb': memory / 1e3,
+            'calls': len(latencies)}
+
+def stage_calls(model, df, mapping_df, queries, legacy_queries):
+    '''
+    Lists each stage's function and the argument tuples to call it with.
+    Inputs of later stages are prepared up front so only the stage itself is
+    timed.
+    '''
+
+    data = model.data
+    filtered = [model._filter_by_lat_lng(q['lat'], q['lng'], q['r'], data) for q in queries]
+    plans = [data.compile_plan([q['f1'], q['f2'], q['f3']]) for q in queries]
+    stages = [
+        ('refresh', model.refresh, [(df, mapping_df)] * 3),
+        ('recommend', lambda q: model.recommend(**q), [(q,) for q in queries]),
+        ('map_features', model._map_features, [()] * len(queries)),
+        ('filter_by_lat_lng', model._filter_by_lat_lng,
+         [(q['lat'], q['lng'], q['r'], data) for q in queries]),
+        ('sort_features', model._sort_features,
+         [(plan, indices, distances, q['n'], data, q['r'])
+          for plan, (indices, distances), q in zip(plans, filtered, queries)]),
+        ('to_dict', lambda recs: recs.to_dict('records'),
+         [(model.recommend(**q),) for q in queries]),
+    ]
+    if legacy_queries:
+        #The legacy functions read data/mapping_df.csv relative to the repo
+        #root and expect a dataframe without shop_id
+        legacy_df = df.drop('shop_id', axis=1)
+        stages.append(('legacy_make_recommendations',
+                       coffee_shop_recommender_functions.make_recommendations,
+                       [(q['f1'], q['f2'], q['f3'], q['lat'], q['lng'], legacy_df, q['n'])
+                        for q in legacy_queries]))
+    return stages
+
+def run(scales, n_queries, n_legacy_queries, seed):
+    df = pd.read_csv(os.path.join(ROOT_DIR, 'data', 'df_with_features.csv'), index_col=0)
+    mapping_df = pd.read_csv(os.path.join(ROOT_DIR, 'data', 'mapping_df.csv'), index_col=0)
+    rng = np.random.default_rng(seed)
+    results = {}
+    print('{:>6} {:>8} {:<28} {:>9} {:>9} {:>9} {:>11} {:>10}'.format(
+        'scale', 'shops', 'stage', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'calls/s', 'peak KB'))
+    for scale in scales:
+        scaled_df, bounds = synthetic_inputs(df, scale, rng)
+        model = RecommenderModel(scaled_df, mapping_df)
+        queries = random_queries(list(mapping_df.columns), bounds, n_queries, rng)
+        legacy_queries = queries[:n_legacy_queries] if len(scaled_df) <= LEGACY_MAX_SHOPS else []
+        for stage, fn, calls in stage_calls(model, scaled_df, mapping_df, queries, legacy_queries):
+            time_calls(fn, calls[:3])
+            latencies = time_calls(fn, calls)
+            memory = peak_memory(fn, calls[:3])
+            summary = summarize(latencies, memory)
+            results['{}x/{}'.format(scale, stage)] = dict(summary, shops=len(scaled_df))
+            print('{:>6} {:>8} {:<28} {:>9.3f} {:>9.3f} {:>9.3f} {:>11.0f} {:>10.1f}'.format(
+                scale, len(scaled_df), stage, summary['p50_ms'], summary['p95_ms'],
+                summary['p99_ms'], summary['throughput'], summary['peak_kb']))
+    return results
+
+def compare(results, baseline, threshold):
+    '''
+    Prints each stage's change against a baseline and returns the stages
+    whose p50 or p95 latency grew by more than threshold.
+    '''
+
+    regressions = []
+    print('\n{:<36} {:>12} {:>12} {:>8}'.format('stage', 'base p50', 'new p50', 'change'))
+    for key, base in sorted(baseline.items()):
+        if key not in results:
+            continue
+        new = results[key]
+        flagged = [metric for metric in ('p50_ms', 'p95_ms')
+                   if new[metric] > base[metric] * (1 + threshold)
+                   and new[metric] - base[metric] > MIN_REGRESSION_MS]
+        print('{:<36} {:>12.3f} {:>12.3f} {:>+7.0%}{}'.format(
+            key, base['p50_ms'], new['p50_ms'], new['p50_ms'] / base['p50_ms'] - 1,
+            '  REGRESSION ({})'.format(', '.join(flagged)) if flagged else ''))
+        if flagged:
+            regressions.append(key)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--legacy-queries', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='Write the results to this JSON baseline')
+    parser.add_argument('--compare', help='Baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed fractional latency increase (Default: 0.25)')
+    args = parser.parse_args()
+
+    os.chdir(ROOT_DIR)
+    results = run(args.scales, args.queries, args.legacy_queries, args.seed)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                       'pandas': pd.__version__, 'machine': platform.machine(),
+                       'queries': args.queries, 'seed': args.seed,
+                       'results': results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n{} stage(s) regressed by more than {:.0%}'.format(
+                len(regressions), args.threshold))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+'''
+Measures recall and latency of IVFIndex against the brute-force reference
+for "shops like this one" queries. Beyond the real shops, larger sets are
+synthesized by perturbing real W rows, so they keep the clustered shape of
+the NMF latent space.
+
+Usage: python benchmarks/bench_similarity_index.py [--sizes 386 10000 100000] [--k 10]
+'''
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from recommender_model import META_COLUMNS
+from similarity_index import MIN_IVF_ROWS, IVFIndex, brute_force_similar, normalize_rows
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'data', 'df_with_features.csv')
+
+def synthetic_latent(W, n, rng, noise=1.0):
+    '''
+    Generates n latent vectors by scaling each coordinate of randomly chosen
+    real W rows by lognormal noise, keeping them non-negative.
+    '''
+
+    if n <= len(W):
+        return W[:n]
+    base = W[rng.integers(len(W), size=n)]
+    return base * rng.lognormal(0, noise, size=base.shape)
+
+def time_per_query(search, queries):
+    start = time.perf_counter()
+    for query in queries:
+        search(query)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[386, 10000, 100000])
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--probes', type=int, nargs='+')
+    args = parser.parse_args()
+
+    W = pd.read_csv(DATA_PATH, index_col=0).drop(META_COLUMNS, axis=1).to_numpy(dtype=float)
+    rng = np.random.default_rng(0)
+    print('{:>8} {:>6} {:>7} {:>10} {:>14} {:>12} {:>8}'.format(
+        'shops', 'lists', 'probes', 'recall@k', 'brute (us)', 'index (us)', 'speedup'))
+    for n in args.sizes:
+        vectors = normalize_rows(synthetic_latent(W, n, rng))
+        start = time.perf_counter()
+        index = IVFIndex(vectors)
+        build_s = time.perf_counter() - start
+        queries = vectors[rng.integers(n, size=args.queries)]
+        exact = [set(brute_force_similar(vectors, q, args.k)[0].tolist()) for q in queries]
+        brute_us = time_per_query(lambda q: brute_force_similar(vectors, q, args.k), queries)
+        n_lists = len(index.centroids)
+        probes = args.probes or sorted({1, index.n_probe // 2 or 1, index.n_probe,
+                                        min(2 * index.n_probe, n_lists), n_lists})
+        for n_probe in probes:
+            recall = np.mean([len(set(index.search(q, args.k, n_probe=n_probe)[0].tolist()) & truth)
+                              / len(truth) for q, truth in zip(queries, exact)])
+            index_us = time_per_query(lambda q: index.search(q, args.k, n_probe=n_probe), queries)
+            print('{:>8} {:>6} {:>7} {:>10.3f} {:>14.1f} {:>12.1f} {:>7.1f}x{}'.format(
+                n, n_lists, n_probe, recall, brute_us, index_us, brute_us / index_us,
+                ' (default)' if n_probe == index.n_probe else ''))
+        print('{:>8} index built in {:.2f} s{}'.format(
+            '', build_s, '' if n >= MIN_IVF_ROWS else '; RecommenderModel scans this size '
+            'brute force'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+'''
+Compares GridIndex radius queries against the full-scan ShopLocations filter
+on synthetic shop sets. Shops are spread at Seattle's density over an area
+that grows with the number of shops, so larger sets model expanding to more
+cities rather than packing more shops into one.
+
+Usage: python benchmarks/bench_spatial_index.py [--queries 200]
+'''
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from geo_functions import GridIndex, ShopLocations
+
+SEATTLE_CENTER = (47.6130285, -122.3420645)
+# Half-widths, in degrees, of the box holding the ~400 Seattle shops
+SEATTLE_HALF_WIDTHS = (0.12, 0.1)
+SEATTLE_SHOPS = 400
+
+def synthetic_shops(n, rng):
+    '''
+    Generates n shop coordinates at roughly Seattle's shop density.
+
+    Parameters:
+    -----------
+    n: Int - Number of shops
+    rng: Numpy Generator
+
+    Output:
+    -------
+    lats, lngs: Numpy Arrays - Shop coordinates in degrees
+    '''
+
+    scale = np.sqrt(n / SEATTLE_SHOPS)
+    lats = SEATTLE_CENTER[0] + rng.uniform(-1, 1, n) * SEATTLE_HALF_WIDTHS[0] * scale
+    lngs = SEATTLE_CENTER[1] + rng.uniform(-1, 1, n) * SEATTLE_HALF_WIDTHS[1] * scale
+    return np.clip(lats, -89, 89), lngs
+
+def time_queries(query, points, r):
+    start = time.perf_counter()
+    for lat, lng in points:
+        query(lat, lng, r)
+    return (time.perf_counter() - start) / len(points) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[400, 10000, 100000])
+    parser.add_argument('--radii', type=float, nargs='+', default=[1, 5, 20])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print('{:>8} {:>6} {:>10} {:>14} {:>14} {:>8}'.format(
+        'shops', 'r (mi)', 'matches', 'full scan (us)', 'grid (us)', 'speedup'))
+    for n in args.sizes:
+        lats, lngs = synthetic_shops(n, rng)
+        shop_locations = ShopLocations(lats, lngs)
+        start = time.perf_counter()
+        index = GridIndex.from_arrays(lats, lngs)
+        build_ms = (time.perf_counter() - start) * 1000
+        points = list(zip(*synthetic_shops(args.queries, rng)))
+        for r in args.radii:
+            #Both paths must agree before their timings mean anything
+            for lat, lng in points[:20]:
+                assert np.array_equal(shop_locations.within(lat, lng, r)[0],
+                                      index.query(lat, lng, r)[0])
+            matches = np.mean([len(index.query(lat, lng, r)[0]) for lat, lng in points])
+            scan_us = time_queries(shop_locations.within, points, r)
+            grid_us = time_queries(index.query, points, r)
+            print('{:>8} {:>6g} {:>10.1f} {:>14.1f} {:>14.1f} {:>7.1f}x'.format(
+                n, r, matches, scan_us, grid_us, scan_us / grid_us))
+        print('{:>8} index built in {:.1f} ms'.format('', build_ms))
+
+if __name__ == '__main__':
+    main()
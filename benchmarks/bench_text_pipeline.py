@@ -0,0 +1,69 @@
+'''
+Runs text_pipeline over the Seattle review corpus replayed several times as
+new shops, to check that throughput holds and memory stays flat as the
+corpus grows.
+
+Usage: python benchmarks/bench_text_pipeline.py [--scales 1 10 100] [--processes 4]
+'''
+import argparse
+import os
+import re
+import resource
+import sys
+import tempfile
+import time
+from functools import lru_cache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import text_pipeline
+
+REVIEWS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'data', 'seattle_coffeeshops_combine_reviews.csv')
+
+class SimplePreprocessor(text_pipeline.ReviewPreprocessor):
+    '''
+    Regex tokens and no lemmatization, for machines without the NLTK data.
+    '''
+    def __init__(self):
+        super().__init__(tokenizer=re.compile(r'\w+').findall)
+
+    def _lemmatizer(self):
+        return lru_cache(maxsize=self.cache_size)(str)
+
+def replayed_shops(path, scale):
+    #Streams the corpus scale times under new ids, never holding it in memory
+    for copy in range(scale):
+        for shop_id, reviews in text_pipeline.iter_review_csv(path):
+            yield '{}-{}'.format(copy, shop_id), reviews
+
+def peak_rss_mb():
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--simple', action='store_true',
+                        help='Skip NLTK tokenizing and lemmatizing')
+    args = parser.parse_args()
+
+    preprocessor = SimplePreprocessor() if args.simple else text_pipeline.ReviewPreprocessor()
+    n_reviews = sum(len(reviews) for _, reviews in text_pipeline.iter_review_csv(REVIEWS_PATH))
+    print('{:>6} {:>10} {:>9} {:>12} {:>16} {:>16}'.format(
+        'scale', 'reviews', 'time (s)', 'reviews/s', 'parent peak (MB)', 'worker peak (MB)'))
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as out:
+            start = time.perf_counter()
+            tfidf, _, _, shop_ids = text_pipeline.build_tfidf(
+                replayed_shops(REVIEWS_PATH, scale), os.path.join(out, 'tfidf'),
+                processes=args.processes, preprocessor=preprocessor)
+            elapsed = time.perf_counter() - start
+        parent, workers = peak_rss_mb()
+        print('{:>6} {:>10} {:>9.1f} {:>12.0f} {:>16.0f} {:>16.0f}'.format(
+            scale, n_reviews * scale, elapsed, n_reviews * scale / elapsed, parent, workers))
+        assert tfidf.shape[0] == len(shop_ids) == len(set(shop_ids))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+'''
+Offline evaluation of alternative recommendation engines against the
+reference RecommenderModel.recommend_features. Replays the same queries
+through each engine and reports, side by side, how often each returns the
+reference's shops (top-n overlap, exact matches, Kendall rank correlation
+over the shops both return, score differences) and its per-query latency.
+Runs from the CSVs in data/.
+
+Queries are synthetic by default: three features drawn with the popular
+ones more likely, slider weights from 1 to 100, locations inside Seattle's
+neighborhood polygons and ranges from the page's slider, with a quarter
+sent without a location like /submit. A share repeat an earlier query from
+a few hundred feet away, as users in the same area do, so caches see hits.
+Logged queries can be replayed instead from a JSON lines file of
+/api/v1/recommend bodies.
+
+Usage:
+    python benchmarks/eval_engines.py [--queries 5000] [--engines batch cache ...]
+    python benchmarks/eval_engines.py --query-log queries.jsonl --min-overlap 0.99
+    python benchmarks/eval_engines.py --engine mine=my_module:build_engine
+Exits with status 1 if an engine falls below --min-overlap or --min-exact,
+so it can gate a release.
+'''
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+from recommender_model import RecommenderModel
+from shapefiles import load_neighborhoods, sample_points
+
+# The /submit form's location and range when the browser sends no location
+DEFAULT_LAT, DEFAULT_LNG, DEFAULT_RANGE = 47.6130285, -122.3420645, 1
+RANGES = (0.5, 1, 2, 3, 5, 10, 20)
+# Repeated queries move up to this many degrees (about 300 feet) away
+REPEAT_JITTER = 0.001
+
+def synthetic_queries(features, n_queries, rng, n=3, feature_skew=1.0, no_location_share=0.25,
+                      repeat_share=0.3):
+    '''
+    Generates queries shaped like the /submit form's.
+
+    Parameters:
+    -----------
+    features: List of strings - Feature names (mapping_df's columns)
+    n_queries: Int - Number of queries
+    rng: Numpy Generator
+    n: Int - Recommendations per query
+    feature_skew: Float - Zipf exponent of feature popularity (0 is uniform)
+    no_location_share: Float - Share of queries without a location, which
+    use the form's downtown default
+    repeat_share: Float - Share of queries that repeat an earlier one from
+    a nearby location
+
+    Output:
+    -------
+    queries: List of dictionaries - recommend_features arguments
+    '''
+
+    popularity = 1 / np.arange(1, len(features) + 1) ** feature_skew
+    popularity = popularity[rng.permutation(len(features))]
+    popularity /= popularity.sum()
+    points = sample_points([polygon for _, _, polygon in load_neighborhoods(
+        os.path.join(ROOT_DIR, 'data', 'Neighborhoods', 'WGS84', 'Neighborhoods'))],
+        n_queries, rng)
+    queries = []
+    for i in range(n_queries):
+        if queries and rng.random() < repeat_share:
+            query = dict(queries[rng.integers(len(queries))])
+            if query['lat'] != DEFAULT_LAT:
+                query['lat'] += rng.uniform(-REPEAT_JITTER, REPEAT_JITTER)
+                query['lng'] += rng.uniform(-REPEAT_JITTER, REPEAT_JITTER)
+            queries.append(query)
+            continue
+        names = rng.choice(features, 3, replace=False, p=popularity)
+        weights = rng.integers(1, 101, 3).astype(float)
+        if rng.random() < no_location_share:
+            lat, lng, r = DEFAULT_LAT, DEFAULT_LNG, DEFAULT_RANGE
+        else:
+            lng, lat = points[i]
+            r = float(rng.choice(RANGES))
+        queries.append(dict(chosen_features=list(zip(weights.tolist(), names.tolist())),
+                            lat=float(lat), lng=float(lng), r=r, n=n))
+    return queries
+
+def read_query_log(path, n=3):
+    '''
+    Reads queries from a JSON lines file of /api/v1/recommend bodies:
+    {"features": [{"name": ..., "weight": ...}], "lat": ..., "lng": ...,
+    "range": ..., "n": ..., "distance_weight": ...}. Queries without lat
+    and lng get the form's downtown default.
+    '''
+
+    queries = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            body = json.loads(line)
+            query = dict(chosen_features=[(float(feature['weight']), feature['name'])
+                                          for feature in body['features']],
+                         lat=DEFAULT_LAT, lng=DEFAULT_LNG, r=DEFAULT_RANGE,
+                         n=int(body.get('n', n)))
+            if body.get('lat') is not None and body.get('lng') is not None:
+                query.update(lat=float(body['lat']), lng=float(body['lng']),
+                             r=float(body.get('range', 20)))
+            if body.get('distance_weight'):
+                query['distance_weight'] = float(body['distance_weight'])
+            queries.append(query)
+    return queries
+
+class Engine():
+    '''
+    Wraps anything with a recommend_features(chosen_features, lat, lng, r,
+    n, ...) method returning Recommendations, such as RecommenderModel or
+    RecommendationCache. Subclasses that answer all queries at once
+    override run.
+    '''
+    def __init__(self, model):
+        self.model = model
+
+    def recommend(self, query):
+        recs = self.model.recommend_features(**query)
+        return np.asarray(recs.shop_ids), np.asarray(recs.combined_weights)
+
+    def run(self, queries):
+        '''
+        Answers each query, timing it.
+
+        Output:
+        -------
+        results: List of (shop_ids, scores) Numpy Array pairs, ranked
+        latencies: Numpy Array - Seconds per query
+        '''
+
+        results = []
+        latencies = np.empty(len(queries))
+        for i, query in enumerate(queries):
+            start = time.perf_counter()
+            results.append(self.recommend(query))
+            latencies[i] = time.perf_counter() - start
+        return results, latencies
+
+class BatchEngine(Engine):
+    '''
+    RecommenderModel.recommend_batch over all queries at once. Latency is
+    the batch's time spread evenly over its queries.
+    '''
+    def run(self, queries):
+        data = self.model.data
+        k = max(len(query['chosen_features']) for query in queries)
+        #Pad to a rectangle with zero weights on the first feature
+        weights = np.zeros((len(queries), k))
+        names = np.full((len(queries), k), data.mapping_df.columns[0], dtype=object)
+        for i, query in enumerate(queries):
+            for j, (weight, name) in enumerate(query['chosen_features']):
+                weights[i, j], names[i, j] = weight, name
+        results = [None] * len(queries)
+        latencies = np.empty(len(queries))
+        #recommend_batch takes one n for all queries
+        for n in sorted(set(query['n'] for query in queries)):
+            rows = np.array([i for i, query in enumerate(queries) if query['n'] == n])
+            start = time.perf_counter()
+            positions, scores, _ = self.model.recommend_batch(
+                weights[rows], names[rows], [queries[i]['lat'] for i in rows],
+                [queries[i]['lng'] for i in rows], [queries[i]['r'] for i in rows], n=n,
+                distance_weights=[queries[i].get('distance_weight', 0.0) for i in rows])
+            latencies[rows] = (time.perf_counter() - start) / len(rows)
+            shop_ids = data.shop_metadata['shop_id']
+            for row, row_positions, row_scores in zip(rows, positions, scores):
+                found = row_positions >= 0
+                results[row] = (shop_ids[row_positions[found]], row_scores[found])
+        return results, latencies
+
+def build_engines(df, mapping_df, names, plugins):
+    '''
+    Builds the reference engine and the requested alternatives. Engines
+    whose data or dependencies are missing are skipped with a message.
+
+    Parameters:
+    -----------
+    df, mapping_df: Pandas DataFrames - Recommender inputs
+    names: List of strings - Built-in engines to compare (see ENGINES)
+    plugins: List of (name, "module:factory") pairs. factory(df,
+    mapping_df) returns an object with recommend_features, or an Engine
+
+    Output:
+    -------
+    engines: Dictionary - Engine name to Engine, reference first
+    cleanup: List of directories to delete after the run
+    '''
+
+    from recommendation_cache import RecommendationCache
+
+    reference = RecommenderModel(df, mapping_df)
+    cleanup = []
+
+    def artifact():
+        from model_artifact import export_artifact
+        path = tempfile.mkdtemp(prefix='eval_artifact_')
+        cleanup.append(path)
+        export_artifact(df, mapping_df, os.path.join(path, 'artifact'))
+        return Engine(RecommenderModel.from_artifact(os.path.join(path, 'artifact')))
+
+    def neighborhoods():
+        from neighborhood_index import load_neighborhood_index
+        index = load_neighborhood_index(os.path.join(ROOT_DIR, 'data', 'neighborhood_index'))
+        if index is None:
+            raise RuntimeError('no index in data/neighborhood_index; build it with '
+                               'python neighborhood_index.py')
+        return Engine(RecommenderModel(df, mapping_df, neighborhoods=index))
+
+    def cache(location_digits):
+        return lambda: Engine(RecommendationCache(RecommenderModel(df, mapping_df), maxsize=10 ** 6,
+                                                  ttl=None, location_digits=location_digits))
+
+    builders = {
+        'geopy': lambda: Engine(RecommenderModel(df, mapping_df, distance_engine='geopy')),
+        'batch': lambda: BatchEngine(RecommenderModel(df, mapping_df)),
+        'artifact': artifact,
+        'neighborhoods': neighborhoods,
+        'cache': cache(None),
+        'cache_d4': cache(4),
+        'cache_d3': cache(3),
+    }
+    engines = {'reference': Engine(reference)}
+    for name in names:
+        try:
+            engines[name] = builders[name]()
+        except Exception as e:
+            print('Skipping {}: {}'.format(name, e))
+    for name, target in plugins:
+        module_name, _, attribute = target.partition(':')
+        factory = getattr(importlib.import_module(module_name), attribute)
+        engine = factory(df, mapping_df)
+        engines[name] = engine if isinstance(engine, Engine) else Engine(engine)
+    return engines, cleanup
+
+ENGINES = ('geopy', 'batch', 'artifact', 'neighborhoods', 'cache', 'cache_d4', 'cache_d3')
+
+def kendall_tau(reference, candidate):
+    '''
+    Kendall rank correlation of the shops two rankings share, or NaN if
+    they share fewer than two.
+    '''
+
+    shared = [shop_id for shop_id in reference if shop_id in set(candidate)]
+    if len(shared) < 2:
+        return np.nan
+    ranks = {shop_id: i for i, shop_id in enumerate(candidate)}
+    order = np.array([ranks[shop_id] for shop_id in shared])
+    pairs = np.sign(order[None, :] - order[:, None])[np.triu_indices(len(order), 1)]
+    return float(pairs.mean())
+
+def compare(reference_results, results):
+    '''
+    Compares an engine's answers with the reference's, query by query.
+
+    Output:
+    -------
+    comparison: Pandas DataFrame - One row per query with overlap (share of
+    the reference's shops returned), exact (same shops in the same order),
+    tau (Kendall over shared shops) and score_error (largest absolute score
+    difference over shared shops)
+    '''
+
+    rows = []
+    for (ref_ids, ref_scores), (ids, scores) in zip(reference_results, results):
+        ref_list, candidate = ref_ids.tolist(), ids.tolist()
+        shared = set(ref_list) & set(candidate)
+        size = max(len(ref_list), len(candidate))
+        ref_score = dict(zip(ref_list, ref_scores.tolist()))
+        errors = [abs(ref_score[shop_id] - score)
+                  for shop_id, score in zip(candidate, scores.tolist()) if shop_id in shared]
+        rows.append({'overlap': len(shared) / size if size else 1.0,
+                     'exact': ref_list == candidate,
+                     'tau': kendall_tau(ref_list, candidate),
+                     'score_error': max(errors) if errors else 0.0})
+    return pd.DataFrame(rows)
+
+def summarize(comparison, latencies, reference_latencies):
+    return {'overlap': float(comparison['overlap'].mean()),
+            'exact': float(comparison['exact'].mean()),
+            'tau': float(comparison['tau'].mean()) if comparison['tau'].notna().any()
+                   else float('nan'),
+            'max_score_error': float(comparison['score_error'].max()),
+            'mean_ms': float(latencies.mean() * 1000),
+            'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p95_ms': float(np.percentile(latencies, 95) * 1000),
+            'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            #Means, so cache hits count even when most queries miss
+            'speedup': float(reference_latencies.mean() / max(latencies.mean(), 1e-12))}
+
+def print_worst(name, queries, comparison, reference_results, results, k):
+    worst = comparison.sort_values(['overlap', 'tau'], na_position='last').head(k)
+    worst = worst[~worst['exact']]
+    if not len(worst):
+        return
+    print('\nLeast similar queries for {}:'.format(name))
+    for i in worst.index:
+        query = queries[i]
+        print('  overlap {:.2f} at ({:.5f}, {:.5f}) r={:g} {}'.format(
+            comparison['overlap'][i], query['lat'], query['lng'], query['r'],
+            ', '.join('{}={:g}'.format(feature, weight)
+                      for weight, feature in query['chosen_features'])))
+        print('    reference {}  {} {}'.format(reference_results[i][0].tolist(), name,
+                                              results[i][0].tolist()))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--df', default=os.path.join(ROOT_DIR, 'data', 'df_with_features.csv'))
+    parser.add_argument('--mapping', default=os.path.join(ROOT_DIR, 'data', 'mapping_df.csv'))
+    parser.add_argument('--queries', type=int, default=5000,
+                        help='Synthetic queries to generate (Default: 5000)')
+    parser.add_argument('--query-log', help='JSON lines file of /api/v1/recommend bodies to '
+                        'replay instead')
+    parser.add_argument('--n', type=int, default=3, help='Recommendations per query (Default: 3)')
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=ENGINES)
+    parser.add_argument('--engine', action='append', default=[], metavar='NAME=MODULE:FACTORY',
+                        help='Also compare factory(df, mapping_df) from an importable module')
+    parser.add_argument('--min-overlap', type=float,
+                        help='Fail if an engine\'s mean top-n overlap is lower')
+    parser.add_argument('--min-exact', type=float,
+                        help='Fail if an engine\'s share of exact matches is lower')
+    parser.add_argument('--show-worst', type=int, default=0,
+                        help='Print this many least similar queries per engine')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='Write the summary to this JSON file')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.df, index_col=0)
+    mapping_df = pd.read_csv(args.mapping, index_col=0)
+    rng = np.random.default_rng(args.seed)
+    if args.query_log:
+        queries = read_query_log(args.query_log, args.n)
+    else:
+        queries = synthetic_queries(list(mapping_df.columns), args.queries, rng, args.n)
+    plugins = [tuple(spec.split('=', 1)) for spec in args.engine]
+
+    engines, cleanup = build_engines(df, mapping_df, args.engines, plugins)
+    try:
+        outputs = {}
+        for name, engine in engines.items():
+            #Warm caches of compiled plans and the like on a separate copy of
+            #the queries' features, so timed runs start from the same state
+            engine.run([dict(query, lat=DEFAULT_LAT, lng=DEFAULT_LNG, r=DEFAULT_RANGE)
+                        for query in queries[:20]])
+            #Caches start empty, so hits come only from repeated queries
+            if hasattr(engine.model, 'clear'):
+                engine.model.clear()
+            outputs[name] = engine.run(queries)
+    finally:
+        for path in cleanup:
+            shutil.rmtree(path, ignore_errors=True)
+
+    reference_results, reference_latencies = outputs['reference']
+    print('{} queries, {} shops, n={}\n'.format(len(queries), len(df), args.n))
+    print('{:<14} {:>8} {:>8} {:>8} {:>10} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'engine', 'overlap', 'exact', 'tau', 'score err', 'mean ms', 'p50 ms', 'p95 ms',
+        'p99 ms', 'speedup'))
+    summaries = {}
+    failures = []
+    for name, (results, latencies) in outputs.items():
+        comparison = compare(reference_results, results)
+        summary = summarize(comparison, latencies, reference_latencies)
+        summaries[name] = summary
+        print('{:<14} {:>8.4f} {:>8.4f} {:>8.4f} {:>10.1e} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} '
+              '{:>7.2f}x'.format(name, summary['overlap'], summary['exact'], summary['tau'],
+                                 summary['max_score_error'], summary['mean_ms'],
+                                 summary['p50_ms'], summary['p95_ms'], summary['p99_ms'],
+                                 summary['speedup']))
+        if args.min_overlap is not None and summary['overlap'] < args.min_overlap:
+            failures.append('{} overlap {:.4f} < {:g}'.format(name, summary['overlap'],
+                                                              args.min_overlap))
+        if args.min_exact is not None and summary['exact'] < args.min_exact:
+            failures.append('{} exact {:.4f} < {:g}'.format(name, summary['exact'],
+                                                            args.min_exact))
+        if args.show_worst and name != 'reference':
+            print_worst(name, queries, comparison, reference_results, results, args.show_worst)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'queries': len(queries), 'query_log': args.query_log, 'seed': args.seed,
+                       'n': args.n, 'engines': summaries}, f, indent=2, sort_keys=True)
+    if failures:
+        print('\n' + '\n'.join(failures))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+'''
+Load generator for the web app. Replays realistic /submit form posts and
+JSON API calls against a running server at a fixed concurrency (closed loop)
+or a fixed Poisson arrival rate (open loop), and reports throughput and
+latency percentiles per endpoint.
+
+Requests pick three distinct features from data/mapping_df.csv, with the
+more popular features chosen more often, slider weights from 1 to 100 and
+ranges from the page's 0.1 to 20 mile slider. Coordinates are drawn
+uniformly inside Seattle's neighborhood polygons (data/Neighborhoods/WGS84);
+a share of requests send none, as when a browser denies geolocation.
+
+In open loop mode latency is measured from each request's scheduled arrival,
+so time spent waiting for a free client counts against the server instead
+of being hidden (coordinated omission).
+
+Usage:
+    cd website && python app.py &
+    python benchmarks/load_test.py --concurrency 16 --duration 30
+    python benchmarks/load_test.py --rate 200 --mix submit=0.6,recommend=0.3,similar=0.1
+    python benchmarks/load_test.py --spawn "gunicorn -w 4 -b 127.0.0.1:5000 app:app"
+'''
+import argparse
+import http.client
+import itertools
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+from shapefiles import NEIGHBORHOODS_PATH, load_neighborhoods, sample_points
+
+WEBSITE_DIR = os.path.join(ROOT_DIR, 'website')
+ENDPOINTS = ('submit', 'recommend', 'similar')
+PERCENTILES = (50, 90, 95, 99)
+
+def generate_requests(features, shop_ids, n_requests, mix, rng, feature_skew=1.0,
+                      no_location_share=0.25):
+    '''
+    Builds request payloads in the shapes the site's pages and API clients
+    send.
+
+    Parameters:
+    -----------
+    features: List of strings - Feature names (mapping_df's columns)
+    shop_ids: List of ints - Shops that /api/v1/similar may be asked about
+    n_requests: Int - Number of requests
+    mix: Dictionary - Endpoint name to its share of requests
+    rng: Numpy Generator
+    feature_skew: Float - Zipf exponent of feature popularity (0 is uniform)
+    no_location_share: Float - Share of /submit requests without coordinates
+
+    Output:
+    -------
+    requests: List of (endpoint, method, path, body, headers) tuples
+    '''
+
+    hoods = [polygon for _, _, polygon in load_neighborhoods(os.path.join(ROOT_DIR, NEIGHBORHOODS_PATH))]
+    locations = sample_points(hoods, n_requests, rng)
+    popularity = 1 / np.arange(1, len(features) + 1) ** feature_skew
+    popularity = rng.permutation(popularity / popularity.sum())
+    names = list(mix)
+    shares = np.array([mix[name] for name in names], dtype=float)
+    endpoints = rng.choice(names, n_requests, p=shares / shares.sum())
+
+    requests = []
+    for endpoint, (lng, lat) in zip(endpoints, locations):
+        chosen = rng.choice(features, 3, replace=False, p=popularity)
+        weights = rng.integers(1, 101, 3)
+        #Slider steps are 0.1 miles; most people stay within a couple of miles
+        r = float(np.clip(np.round(rng.lognormal(0.3, 0.8), 1), 0.1, 20))
+        coord = '{:.6f},{:.6f}'.format(lat, lng)
+        if endpoint == 'submit':
+            form = {'feature{}'.format(i + 1): name for i, name in enumerate(chosen)}
+            form.update({'f{}_weight'.format(i + 1): str(w) for i, w in enumerate(weights)})
+            form['range'] = str(r)
+            form['coord'] = '' if rng.random() < no_location_share else coord
+            requests.append((endpoint, 'POST', '/submit', urllib.parse.urlencode(form),
+                             {'Content-Type': 'application/x-www-form-urlencoded'}))
+        elif endpoint == 'recommend':
+            body = {'features': [{'name': name, 'weight': int(w)}
+                                 for name, w in zip(chosen, weights)],
+                    'coord': coord, 'range': r, 'n': 3}
+            requests.append((endpoint, 'POST', '/api/v1/recommend', json.dumps(body),
+                             {'Content-Type': 'application/json'}))
+        elif endpoint == 'similar':
+            query = {'shop_id': int(rng.choice(shop_ids)), 'n': 3}
+            if rng.random() < 0.5:
+                query.update(coord=coord, range=r)
+            requests.append((endpoint, 'GET', '/api/v1/similar?' + urllib.parse.urlencode(query),
+                             None, {}))
+        else:
+            raise ValueError('Unknown endpoint {}'.format(endpoint))
+    return requests
+
+class Client():
+    '''
+    One simulated user: a keep-alive HTTP connection that reconnects after
+    errors.
+    '''
+    def __init__(self, host, port, timeout):
+        self.host, self.port, self.timeout = host, port, timeout
+        self.connection = None
+
+    def send(self, method, path, body, headers):
+        '''
+        Sends one request and reads the whole response. Returns the status
+        code, or None if the request failed.
+        '''
+
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            response.read()
+            if response.will_close:
+                self.close()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.close()
+            return None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+def run_load(url, requests, concurrency, duration, rate=None, timeout=30, rng=None):
+    '''
+    Replays requests (cycling through them) from concurrency client threads
+    until duration seconds have passed.
+
+    Parameters:
+    -----------
+    url: String - Server base URL, e.g. http://127.0.0.1:5000
+    requests: List - Payloads from generate_requests
+    concurrency: Int - Number of client threads
+    duration: Float - Seconds to generate load for
+    rate: Float - Open loop arrivals per second, or None to send each
+    client's next request as soon as its last one finishes
+    timeout: Float - Socket timeout per request in seconds
+    rng: Numpy Generator - For the open loop arrival schedule
+
+    Output:
+    -------
+    results: List of (endpoint, status, latency seconds, start offset)
+    tuples; status is None for failed requests
+    elapsed: Float - Seconds from the first to the last request finishing
+    '''
+
+    parsed = urllib.parse.urlsplit(url)
+    host, port = parsed.hostname, parsed.port or 80
+    schedule = None
+    if rate:
+        rng = rng or np.random.default_rng()
+        n_arrivals = int(rate * duration * 1.2) + 10
+        schedule = np.cumsum(rng.exponential(1 / rate, n_arrivals))
+        schedule = schedule[schedule < duration]
+    counter = itertools.count()
+    results = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def worker():
+        client = Client(host, port, timeout)
+        local = []
+        while True:
+            i = next(counter)
+            if schedule is not None:
+                if i >= len(schedule):
+                    break
+                scheduled = start + schedule[i]
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+                if scheduled >= deadline:
+                    break
+            endpoint, method, path, body, headers = requests[i % len(requests)]
+            status = client.send(method, path, body, headers)
+            local.append((endpoint, status, time.perf_counter() - scheduled, scheduled - start))
+        client.close()
+        with lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+def summarize(results, elapsed, warmup=0.0):
+    '''
+    Computes throughput, error counts and latency percentiles overall and per
+    endpoint, ignoring requests that started during the warmup seconds.
+    '''
+
+    rows = {}
+    kept = [result for result in results if result[3] >= warmup]
+    window = max(elapsed - warmup, 1e-9)
+    groups = [('all', kept)] + [(endpoint, [r for r in kept if r[0] == endpoint])
+                                for endpoint in ENDPOINTS]
+    for name, group in groups:
+        if not group:
+            continue
+        latencies = np.array([latency for _, status, latency, _ in group if status is not None])
+        statuses = pd.Series([str(status) for _, status, _, _ in group]).value_counts()
+        row = {'requests': len(group), 'throughput': len(group) / window,
+               'errors': int(sum(count for status, count in statuses.items()
+                                 if not status.startswith('2') and status != '304')),
+               'statuses': {status: int(count) for status, count in statuses.items()}}
+        if len(latencies):
+            row.update({'p{}_ms'.format(p): float(np.percentile(latencies, p) * 1000)
+                        for p in PERCENTILES})
+            row['max_ms'] = float(latencies.max() * 1000)
+            row['mean_ms'] = float(latencies.mean() * 1000)
+        rows[name] = row
+    return rows
+
+def print_summary(rows):
+    columns = ['p{}_ms'.format(p) for p in PERCENTILES] + ['max_ms']
+    print('{:<10} {:>9} {:>9} {:>7} '.format('endpoint', 'requests', 'req/s', 'errors') +
+          ' '.join('{:>9}'.format(column.replace('_ms', ' ms')) for column in columns))
+    for name, row in rows.items():
+        print('{:<10} {:>9} {:>9.1f} {:>7} '.format(name, row['requests'], row['throughput'],
+                                                   row['errors']) +
+              ' '.join('{:>9.2f}'.format(row.get(column, float('nan'))) for column in columns))
+    statuses = rows['all']['statuses'] if 'all' in rows else {}
+    print('status codes: ' + ', '.join('{} x{}'.format(status, count)
+                                       for status, count in sorted(statuses.items())))
+
+def wait_until_ready(url, timeout=60, process=None):
+    '''
+    Polls the health endpoint until the server answers, raising
+    RuntimeError if it doesn't within timeout seconds or its process exits.
+    '''
+
+    parsed = urllib.parse.urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError('Server exited with status {}'.format(process.returncode))
+        client = Client(parsed.hostname, parsed.port or 80, timeout=2)
+        status = client.send('GET', '/api/v1/health', None, {})
+        client.close()
+        if status == 200:
+            return
+        time.sleep(0.2)
+    raise RuntimeError('Server at {} not ready after {} seconds'.format(url, timeout))
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, share = part.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError('Unknown endpoint {} (choose from {})'.format(
+                name, ', '.join(ENDPOINTS)))
+        mix[name] = float(share or 1)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Client threads (Default: 8)')
+    parser.add_argument('--rate', type=float,
+                        help='Open loop arrival rate in requests per second')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds (Default: 20)')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='Seconds excluded from the report (Default: 2)')
+    parser.add_argument('--mix', type=parse_mix, default={'submit': 1.0},
+                        help='Endpoint shares, e.g. submit=0.7,recommend=0.2,similar=0.1')
+    parser.add_argument('--unique-requests', type=int, default=20000,
+                        help='Distinct payloads to cycle through (Default: 20000)')
+    parser.add_argument('--feature-skew', type=float, default=1.0)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--spawn', help='Command that starts the server from the website '
+                        'directory; it is stopped when the run ends')
+    parser.add_argument('--save', help='Write the summary to this JSON file')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    mapping_df = pd.read_csv(os.path.join(ROOT_DIR, 'data', 'mapping_df.csv'), index_col=0)
+    shops = pd.read_csv(os.path.join(ROOT_DIR, 'data', 'df_with_features.csv'), index_col=0)
+    requests = generate_requests(list(mapping_df.columns), shops['shop_id'].tolist(),
+                                 args.unique_requests, args.mix, rng, args.feature_skew)
+
+    process = None
+    if args.spawn:
+        process = subprocess.Popen(shlex.split(args.spawn), cwd=WEBSITE_DIR,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(args.url, process=process)
+        mode = ('open loop at {:g} req/s'.format(args.rate) if args.rate
+                else 'closed loop')
+        print('{} for {:g} s, {} clients, {} against {}'.format(
+            mode, args.duration, args.concurrency,
+            ', '.join('{}={:g}'.format(name, share) for name, share in args.mix.items()), args.url))
+        results, elapsed = run_load(args.url, requests, args.concurrency, args.duration,
+                                    args.rate, args.timeout, rng)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    rows = summarize(results, elapsed, args.warmup)
+    print_summary(rows)
+    if args.rate and 'all' in rows and rows['all']['throughput'] < 0.95 * args.rate:
+        print('Server kept up with only {:.0f} of {:g} req/s; latencies include queueing'
+              .format(rows['all']['throughput'], args.rate))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'url': args.url, 'concurrency': args.concurrency, 'rate': args.rate,
+                       'duration': args.duration, 'mix': args.mix, 'spawn': args.spawn,
+                       'results': rows}, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+Concurrency stress check for the web app's shared RecommenderModel. Fires
+randomized /submit requests from many threads at once (while another thread
+keeps refreshing the model with the same data) and asserts every response
+matches the one produced by running the same requests serially.
+
+Usage: python benchmarks/stress_concurrency.py [--requests 2000] [--threads 32]
+'''
+import argparse
+import os
+import re
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+WEBSITE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'website')
+# Each page gets a fresh feedback request id, and vote tokens signed with
+# it, which can't match across runs
+REQUEST_ID = re.compile(rb'"request_id": *"[0-9a-f]+"')
+VOTE_TOKEN = re.compile(rb'data-token="[0-9a-f]+"')
+
+def load_app():
+    '''
+    Imports website/app.py the way the dev server runs it, from inside the
+    website directory so its relative data paths resolve.
+    '''
+
+    os.chdir(WEBSITE_DIR)
+    sys.path.insert(0, WEBSITE_DIR)
+    import app
+    return app
+
+def random_forms(features, n_requests, rng):
+    '''
+    Generates /submit form payloads with random features, weights, ranges and
+    coordinates around Seattle. About a quarter omit coordinates to exercise
+    the default location path.
+
+    Parameters:
+    -----------
+    features: List of strings - Feature names to choose from
+    n_requests: Int - Number of payloads
+    rng: Numpy Generator
+
+    Output:
+    -------
+    forms: List of dictionaries
+    '''
+
+    forms = []
+    for _ in range(n_requests):
+        names = rng.choice(features, 3, replace=False)
+        form = {'feature{}'.format(i + 1): name for i, name in enumerate(names)}
+        for i in range(3):
+            form['f{}_weight'.format(i + 1)] = str(rng.integers(1, 11))
+        form['range'] = str(rng.choice([0.5, 1, 2, 5, 20]))
+        if rng.random() < 0.25:
+            form['coord'] = ''
+        else:
+            form['coord'] = '{},{}'.format(47.61 + rng.normal() * 0.05,
+                                           -122.33 + rng.normal() * 0.05)
+        forms.append(form)
+    return forms
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=32)
+    args = parser.parse_args()
+
+    app = load_app()
+    #Keep the synthetic impressions out of the real feedback log
+    app.feedback.path = tempfile.mkdtemp(prefix='stress_feedback_')
+    forms = random_forms(list(app.mapping_df.columns), args.requests,
+                         np.random.default_rng(0))
+
+    def submit(form):
+        with app.app.test_client() as client:
+            response = client.post('/submit', data=form)
+            assert response.status_code == 200, response.status_code
+            return VOTE_TOKEN.sub(b'data-token=""',
+                                  REQUEST_ID.sub(b'"request_id":""', response.data))
+
+    serial = [submit(form) for form in forms]
+
+    #Swap in freshly built (identical) model data while requests are in flight
+    stop = threading.Event()
+    def keep_refreshing():
+        while not stop.is_set():
+            app.model.refresh(app.df, app.mapping_df, app.precomputed)
+    refresher = threading.Thread(target=keep_refreshing)
+    refresher.start()
+    try:
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            parallel = list(executor.map(submit, forms))
+    finally:
+        stop.set()
+        refresher.join()
+
+    mismatches = [i for i, (a, b) in enumerate(zip(serial, parallel)) if a != b]
+    assert not mismatches, '{} of {} responses differ from serial execution, first at {}'.format(
+        len(mismatches), len(forms), mismatches[0])
+    print('{} concurrent /submit responses on {} threads match serial execution'
+          .format(len(forms), args.threads))
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import numpy as np
 import pandas as pd
-from geopy.distance import great_circle
+from geo_functions import ShopLocations
 
 def make_recommendations(f1, f2, f3, lat, lng, df, n=3):
     '''
@@ -68,7 +68,7 @@ def _sort_features(chosen_features, user_df):
     sorted_df = sorted_df.sort_values('combined_weights', ascending=False)
     return sorted_df
 
-def _filter_by_lat_lng(lat, lng, df, range=20):
+def _filter_by_lat_lng(lat, lng, df, range=20, engine='haversine'):
     '''
     Takes in a user's latitude and longitude and a dataframe including
     coffeeshop latitudes and longitudes and filters out coffeeshops that are
@@ -85,17 +85,17 @@ def _filter_by_lat_lng(lat, lng, df, range=20):
 
     range: Range, in miles, to restrict recommendations to (Default: 10)
 
+    engine: String - 'haversine' for the vectorized distance kernel or 'geopy'
+    for the per-row great_circle reference (Default: 'haversine')
+
     Output:
     -------
     distance_filtered_df: Pandas DataFrame - Pandas Dataframe only including
     coffeeshops that are within the specified range of the input latitude and
     longitude
     '''
-    current_location = (lat, lng)
-    df['distance_from_location'] = df.apply(lambda row: great_circle(current_location,
-                                                        (row['lat'],
-                                                         row['lng'])).miles,
-                                            axis=1)
+    shop_locations = ShopLocations(df['lat'], df['lng'])
+    df['distance_from_location'] = shop_locations.distances(lat, lng, engine)
     distance_filtered_df = df[df['distance_from_location'] < range]
     return distance_filtered_df
 
@@ -0,0 +1,545 @@
+'''
+User feedback on recommendations: an append-only event log written off the
+request thread, and a job that turns accumulated thumbs up/down into
+adjusted mapping_df weights without refitting NMF.
+
+The web app records an impression for each page of recommendations and a
+vote when a user reacts to one of the shops, each with the features and
+weights they asked for. Every shop on the page carries a token signing its
+request_id and shop_id, and the API only takes votes with a valid one.
+Events are JSON lines in daily files, one per process so workers never
+interleave writes:
+
+    data/feedback/events-20261018-12345.jsonl
+
+The reweight job reads the votes the active model version doesn't include
+yet, keeps one per shop of each logged impression, with the features of
+the impression rather than those the vote claims, and nudges each
+feature's mapping column towards the latent features of shops users liked
+for it (and away from those they disliked). The result is published as a
+candidate model registry version; it only goes live once an admin
+activates it. Votes count as applied only when a version built from them
+is active, so until then every run starts from the active version and
+includes them again, and activating any candidate loses none.
+
+    python feedback.py summary [--log data/feedback]
+    python feedback.py reweight [--log data/feedback]
+                                [--registry data/model_registry]
+'''
+import argparse
+import atexit
+import glob
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from similarity_index import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+EVENT_TYPES = ('impression', 'up', 'down')
+VOTES = {'up': 1.0, 'down': -1.0}
+# Records which events the active version includes and the offsets each
+# candidate the reweight job published was built to
+STATE_NAME = 'reweight_state.json'
+# Hex characters kept from each vote token's HMAC-SHA256
+TOKEN_LENGTH = 32
+
+def vote_token(secret, request_id, shop_id):
+    '''
+    Signs a shop shown on a page of recommendations, so a vote on it can be
+    checked without looking the impression up.
+
+    Parameters:
+    -----------
+    secret: Bytes - Key shared by every process serving the site
+    request_id: String - The page's request_id
+    shop_id: Int - A shop shown on the page
+
+    Output:
+    -------
+    token: String - Hex digest to send back with a vote
+    '''
+
+    message = '{}:{}'.format(request_id, int(shop_id)).encode()
+    return hmac.new(secret, message, hashlib.sha256).hexdigest()[:TOKEN_LENGTH]
+
+class RateLimiter():
+    '''
+    Allows each client at most limit events per window seconds. Clients are
+    forgotten once their window passes, so memory stays proportional to the
+    clients seen in the last window.
+    '''
+    def __init__(self, limit, window=60.0, max_clients=100000):
+        self.limit = limit
+        self.window = window
+        self.max_clients = max_clients
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def allow(self, client):
+        '''
+        Counts an event for a client and returns whether it is within the
+        limit. Refused events don't count.
+        '''
+
+        now = time.monotonic()
+        with self._lock:
+            if len(self._events) >= self.max_clients:
+                self._events = {key: times for key, times in self._events.items()
+                                if times[-1] > now - self.window}
+            times = self._events.setdefault(client, deque())
+            while times and times[0] <= now - self.window:
+                times.popleft()
+            if len(times) >= self.limit:
+                return False
+            times.append(now)
+            return True
+
+class FeedbackLog():
+    '''
+    Buffers feedback events in memory and appends them to the log from a
+    background thread. Recording an event is a deque append, so the request
+    thread never waits on serialization or disk. When the writer falls
+    behind by more than max_pending events, new events are dropped rather
+    than queued without bound.
+    '''
+    def __init__(self, path, flush_interval=1.0, max_pending=100000, metrics=None):
+        '''
+        Parameters:
+        -----------
+        path: String - Log directory, created on the first write
+        flush_interval: Float - Seconds between writes (Default: 1)
+        max_pending: Int - Events held before new ones are dropped
+        metrics: MetricsRegistry - Optional registry to count events in, as
+        feedback_events{type} and feedback_events_dropped
+
+        Output:
+        --------
+        None
+        '''
+
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending = deque()
+        self._events = self._dropped = None
+        if metrics is not None:
+            self._events = metrics.counter('feedback_events', 'Feedback events logged by type',
+                                           ('type',))
+            self._dropped = metrics.counter('feedback_events_dropped',
+                                            'Feedback events dropped because the writer fell behind')
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def record(self, event_type, shop_ids, chosen_features, request_id=None):
+        '''
+        Queues an event for the log.
+
+        Parameters:
+        -----------
+        event_type: String - One of EVENT_TYPES
+        shop_ids: List of ints - Shops shown (impression) or voted on
+        chosen_features: List of tuples (float, string) - The weights and
+        names of the features the user asked for
+        request_id: String - Ties votes to the impression they react to
+
+        Output:
+        -------
+        queued: Bool - False if the event was dropped
+        '''
+
+        if event_type not in EVENT_TYPES:
+            raise ValueError('event_type must be one of {}'.format(EVENT_TYPES))
+        if self._pid != os.getpid():
+            self._start_writer()
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            if self._dropped is not None:
+                self._dropped.inc()
+            return False
+        #Serialized by the writer, so only the tuple is built here
+        self._pending.append((time.time(), event_type, shop_ids, chosen_features, request_id))
+        if self._events is not None:
+            self._events.inc(event_type)
+        return True
+
+    def _start_writer(self):
+        #Started on first use, and again in a forked child, whose copy of the
+        #parent's thread isn't running
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pending = deque()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='feedback-log', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError:
+                #Keep the events and try again on the next interval
+                logger.exception('Feedback log write failed, retrying')
+
+    def flush(self):
+        '''
+        Writes every queued event to today's log file for this process.
+        '''
+
+        with self._write_lock:
+            if not self._pending:
+                return
+            #Take only what is queued now; appends continue during the write
+            batch = [self._pending.popleft() for _ in range(len(self._pending))]
+            lines = []
+            for ts, event_type, shop_ids, chosen_features, request_id in batch:
+                lines.append(json.dumps({
+                    'ts': round(ts, 3), 'type': event_type,
+                    'shop_ids': [int(shop_id) for shop_id in shop_ids],
+                    'features': [[name, float(weight)] for weight, name in chosen_features],
+                    'request_id': request_id}, separators=(',', ':')))
+            os.makedirs(self.path, exist_ok=True)
+            name = 'events-{}-{}.jsonl'.format(time.strftime('%Y%m%d', time.localtime(batch[-1][0])),
+                                               os.getpid())
+            try:
+                with open(os.path.join(self.path, name), 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+            except OSError:
+                self._pending.extendleft(reversed(batch))
+                raise
+
+    def close(self):
+        '''
+        Stops the writer thread and writes any queued events.
+        '''
+
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+            self._thread = None
+        try:
+            self.flush()
+        except OSError as e:
+            logger.error('Feedback log write failed, %d events lost: %s', len(self._pending), e)
+
+def read_events(path, offsets=None):
+    '''
+    Reads the events logged since the given file offsets. A last line still
+    being written is left for the next read.
+
+    Parameters:
+    -----------
+    path: String - Log directory
+    offsets: Dictionary - File name to the byte offset already read
+    (Default: read everything)
+
+    Output:
+    -------
+    events: List of dictionaries - In file order
+    offsets: Dictionary - Offsets to pass to the next read
+    '''
+
+    _, events, offsets = _read_log(path, offsets, False)
+    return events, offsets
+
+def split_events(path, offsets=None):
+    '''
+    Reads the whole log in one pass, split at the given file offsets.
+
+    Output:
+    -------
+    earlier: List of dictionaries - Events before the offsets
+    events: List of dictionaries - Events since the offsets
+    offsets: Dictionary - Offsets to pass to the next read
+    '''
+
+    return _read_log(path, offsets, True)
+
+def _read_log(path, offsets, read_earlier):
+    offsets = dict(offsets or {})
+    earlier = []
+    events = []
+    for file_path in sorted(glob.glob(os.path.join(path, 'events-*.jsonl'))):
+        name = os.path.basename(file_path)
+        start = offsets.get(name, 0)
+        with open(file_path, 'rb') as f:
+            if read_earlier:
+                earlier.extend(json.loads(line) for line in f.read(start).splitlines()
+                               if line.strip())
+            f.seek(start)
+            data = f.read()
+        complete = data.rfind(b'\n') + 1
+        for line in data[:complete].splitlines():
+            if line.strip():
+                events.append(json.loads(line))
+        offsets[name] = start + complete
+    return earlier, events, offsets
+
+def verified_votes(earlier, new_events):
+    '''
+    Picks the new votes to learn from. A vote counts only if its request_id
+    and shop_id match a logged impression, and only once per shop of an
+    impression: the latest new vote wins, and shops already voted on in an
+    earlier run are skipped. Each vote takes the features of its impression,
+    whatever the vote itself claims.
+
+    Parameters:
+    -----------
+    earlier: List of dictionaries - Events already applied, to find
+    impressions and earlier votes in
+    new_events: List of dictionaries - The events not yet applied
+
+    Output:
+    -------
+    votes: List of dictionaries - Vote events with a single shop_id each
+    '''
+
+    impressions = {event['request_id']: event for event in earlier + new_events
+                   if event['type'] == 'impression' and event.get('request_id')}
+    applied = {(event.get('request_id'), shop_id) for event in earlier
+               if event['type'] in VOTES for shop_id in event['shop_ids']}
+    votes = {}
+    for event in new_events:
+        impression = impressions.get(event.get('request_id'))
+        if event['type'] not in VOTES or impression is None:
+            continue
+        for shop_id in event['shop_ids']:
+            key = (event['request_id'], shop_id)
+            if shop_id in impression['shop_ids'] and key not in applied:
+                votes[key] = dict(event, shop_ids=[shop_id], features=impression['features'])
+    return list(votes.values())
+
+def summarize_feedback(events, feature_names):
+    '''
+    Counts impressions and votes for each feature. An event counts towards
+    every feature its user weighted.
+
+    Output:
+    -------
+    summary: Pandas DataFrame - impressions, up and down per feature, and
+    approval, (up - down) per shop impression
+    '''
+
+    counts = {name: {'impressions': 0, 'up': 0, 'down': 0} for name in feature_names}
+    for event in events:
+        amount = len(event['shop_ids']) if event['type'] == 'impression' else 1
+        column = 'impressions' if event['type'] == 'impression' else event['type']
+        for name, weight in event['features']:
+            if name in counts and weight:
+                counts[name][column] += amount
+    summary = pd.DataFrame.from_dict(counts, orient='index',
+                                     columns=['impressions', 'up', 'down'])
+    summary['approval'] = (summary['up'] - summary['down']) / summary['impressions'].where(
+        summary['impressions'] > 0)
+    return summary
+
+def reweight_mapping(df, mapping_df, events, learning_rate=0.1, prior_votes=20):
+    '''
+    Adjusts the mapping from NMF latent features to user features using
+    votes. A vote for a shop moves each feature the user weighted towards
+    (up) or away from (down) the shop's unit-length latent vector, centered
+    on the average shop, in proportion to the feature's share of the
+    request's weights. A negative weight ("not bustling") flips the
+    direction. Each feature's accumulated direction is averaged over its
+    votes plus prior_votes, so a handful of votes moves it little, and the
+    step is scaled by the length of the feature's mapping column. Votes
+    don't push a weight below zero; weights already negative are left as
+    they are unless votes raise them.
+
+    Parameters:
+    -----------
+    df: Pandas DataFrame - The primary recommender dataframe including the W
+    matrix from NMF
+    mapping_df: Pandas DataFrame - The (latent features x user features)
+    mapping to adjust
+    events: List of dictionaries - Logged events; only votes on known shops
+    and features are used
+    learning_rate: Float - Step size relative to each mapping column's
+    length (Default: 0.1)
+    prior_votes: Float - Votes' worth of inertia per feature (Default: 20)
+
+    Output:
+    -------
+    mapping_df: Pandas DataFrame - The adjusted mapping
+    report: Pandas DataFrame - Votes used and relative change per feature
+    '''
+
+    from recommender_model import META_COLUMNS
+
+    latent = normalize_rows(df.drop(META_COLUMNS, axis=1).to_numpy(dtype=float))
+    centered = latent - latent.mean(axis=0)
+    positions = {shop_id: i for i, shop_id in enumerate(df['shop_id'].tolist())}
+    feature_index = {name: i for i, name in enumerate(mapping_df.columns)}
+
+    signals = []
+    shops = []
+    for event in events:
+        vote = VOTES.get(event['type'])
+        if vote is None:
+            continue
+        total = sum(abs(weight) for _, weight in event['features'])
+        if total == 0:
+            continue
+        signal = np.zeros(len(feature_index))
+        for name, weight in event['features']:
+            if name in feature_index:
+                signal[feature_index[name]] += vote * weight / total
+        for shop_id in event['shop_ids']:
+            if shop_id in positions and signal.any():
+                signals.append(signal)
+                shops.append(positions[shop_id])
+
+    mapping = mapping_df.to_numpy(dtype=float)
+    votes = np.zeros(len(feature_index))
+    updated = mapping.copy()
+    if signals:
+        signals = np.array(signals)
+        votes = np.abs(signals).sum(axis=0)
+        #(latent features x user features) direction of the votes
+        directions = centered[shops].T @ signals / (votes + prior_votes)
+        scale = np.linalg.norm(mapping, axis=0)
+        updated = np.maximum(mapping + learning_rate * scale * directions,
+                             np.minimum(mapping, 0))
+        #A column pushed to all zeros would make the feature score undefined
+        emptied = updated.sum(axis=0) == 0
+        updated[:, emptied] = mapping[:, emptied]
+
+    change = np.linalg.norm(updated - mapping, axis=0) / np.maximum(
+        np.linalg.norm(mapping, axis=0), 1e-12)
+    report = pd.DataFrame({'votes': votes, 'change': change}, index=mapping_df.columns)
+    return pd.DataFrame(updated, index=mapping_df.index, columns=mapping_df.columns), report
+
+def load_state(path):
+    try:
+        with open(os.path.join(path, STATE_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'offsets': {}, 'versions': []}
+
+def follow_active(state, active):
+    '''
+    Sets the applied offsets to those a published version was built to, if
+    that version is the registry's active one. Activating a candidate
+    applies its votes; rolling back to an earlier reweight version
+    un-applies the votes it didn't include.
+
+    Parameters:
+    -----------
+    state: Dictionary - The reweight state, changed in place
+    active: String - The registry's active version
+
+    Output:
+    -------
+    changed: Bool - Whether the applied offsets moved
+    '''
+
+    for entry in state['versions']:
+        if entry['version'] == active and 'offsets' in entry:
+            changed = entry['offsets'] != state['offsets']
+            state['offsets'] = dict(entry['offsets'])
+            return changed
+    return False
+
+def save_state(path, state):
+    #Written next to the target and renamed, so a crash never leaves half a file
+    target = os.path.join(path, STATE_NAME)
+    with open(target + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(target + '.tmp', target)
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize feedback or re-weight the feature '
+                                     'mapping from it')
+    parser.add_argument('command', choices=['summary', 'reweight'])
+    parser.add_argument('--log', default='data/feedback', help='Feedback log directory')
+    parser.add_argument('--registry', default='data/model_registry')
+    parser.add_argument('--df', default='data/df_with_features.csv',
+                        help='Used when the registry has no versions yet')
+    parser.add_argument('--mapping', default='data/mapping_df.csv',
+                        help='Used when the registry has no versions yet')
+    parser.add_argument('--learning-rate', type=float, default=0.1)
+    parser.add_argument('--prior-votes', type=float, default=20)
+    parser.add_argument('--min-votes', type=int, default=10,
+                        help='Verified votes not in the active version needed before a '
+                        'version is published (Default: 10)')
+    parser.add_argument('--save-mapping', help='Also write the adjusted mapping to this CSV, '
+                        'e.g. so an NMF refit starts from it')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Report the changes without publishing them')
+    args = parser.parse_args()
+
+    from model_artifact import artifact_frame, load_artifact
+    from model_registry import publish_version, target_version
+
+    base = target_version(args.registry)
+    if base is not None:
+        #Build on the version being served, so runs compound instead of
+        #each starting over from the CSV mapping, and never on one that was
+        #rolled back or is still a candidate
+        mapping_df, precomputed = load_artifact(os.path.join(args.registry, base))
+        df = artifact_frame(precomputed)
+    else:
+        base = args.mapping
+        df = pd.read_csv(args.df, index_col=0)
+        mapping_df = pd.read_csv(args.mapping, index_col=0)
+
+    state = load_state(args.log)
+    if follow_active(state, base) and args.command == 'reweight' and not args.dry_run:
+        os.makedirs(args.log, exist_ok=True)
+        save_state(args.log, state)
+    if args.command == 'summary':
+        events, _ = read_events(args.log)
+        new_events, _ = read_events(args.log, state['offsets'])
+        print('{} events, {} not yet applied by reweight\n'.format(len(events), len(new_events)))
+        print(summarize_feedback(events, mapping_df.columns).round(3).to_string())
+        return
+
+    earlier, new_events, offsets = split_events(args.log, state['offsets'])
+    pending = [entry for entry in state['versions'] if entry.get('base') == base]
+    if pending and pending[-1].get('offsets') == offsets:
+        print('No votes since candidate {}, which is waiting to be activated'.format(
+            pending[-1]['version']))
+        return
+    votes = verified_votes(earlier, new_events)
+    n_votes = len(votes)
+    n_unverified = sum(event['type'] in VOTES for event in new_events) - n_votes
+    if n_votes < args.min_votes:
+        print('{} votes not in {} ({} ignored), waiting for {} before re-weighting'.format(
+            n_votes, base, n_unverified, args.min_votes))
+        return
+    mapping_df, report = reweight_mapping(df, mapping_df, votes, args.learning_rate,
+                                          args.prior_votes)
+    print('Re-weighted the mapping of {} from {} votes not in it ({} ignored)\n'.format(
+        base, n_votes, n_unverified))
+    print(report.round(4).to_string())
+    if args.dry_run:
+        return
+    if args.save_mapping:
+        mapping_df.to_csv(args.save_mapping)
+    version = publish_version(df, mapping_df, args.registry, activate=False)
+    #The votes are applied once this version is activated (see follow_active)
+    state['versions'] = (state['versions'] + [{'version': version, 'base': base,
+                                               'votes': n_votes, 'offsets': offsets}])[-20:]
+    os.makedirs(args.log, exist_ok=True)
+    save_state(args.log, state)
+    print('\nPublished candidate model version {}; activate it with POST /admin/model '
+          'action=activate version={}'.format(version, version))
+
+if __name__ == '__main__':
+    main()
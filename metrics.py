@@ -0,0 +1,340 @@
+'''
+Low-overhead latency metrics in the Prometheus text format, plus a sampled
+cProfile hook for capturing slow requests.
+
+RecommenderModel times its stages when given a MetricsRegistry, and the web
+app adds request timings and serves REGISTRY.render() at /metrics. Worker
+processes of one server can each take a snapshot of their registry, and
+merge_snapshots adds them up into one exposition.
+'''
+import cProfile
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+
+# Histogram bucket upper bounds in seconds, from 50 microseconds to 5 seconds
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                                               .replace('"', '\\"')
+                                                               .replace('\n', '\\n'))
+                          for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _histogram_lines(name, label_names, buckets, series):
+    lines = []
+    for labels, (counts, total, count) in sorted(series.items()):
+        cumulative = 0
+        for bound, bucket_count in zip(tuple(buckets) + (float('inf'),), counts):
+            cumulative += bucket_count
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(label_names, labels,
+                                     [('le', _format_value(float(bound)))]),
+                cumulative))
+        label_text = _format_labels(label_names, labels)
+        lines.append('{}_sum{} {}'.format(name, label_text, _format_value(total)))
+        lines.append('{}_count{} {}'.format(name, label_text, count))
+    return lines
+
+def _value_lines(name, label_names, series):
+    return ['{}{} {}'.format(name, _format_labels(label_names, labels), _format_value(value))
+            for labels, value in sorted(series.items())]
+
+class Histogram():
+    '''
+    Cumulative histogram of observed values, one series per combination of
+    label values.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        '''
+        Records one value, e.g. a duration in seconds, for the given label
+        values.
+        '''
+
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def series(self):
+        with self._lock:
+            return {labels: (list(counts), total, count)
+                    for labels, (counts, total, count) in self._series.items()}
+
+    def samples(self):
+        return _histogram_lines(self.name, self.label_names, self.buckets, self.series())
+
+class Counter():
+    '''
+    Monotonically increasing count, one series per combination of label
+    values.
+    '''
+    kind = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def series(self):
+        with self._lock:
+            return dict(self._series)
+
+    def samples(self):
+        return _value_lines(self.name, self.label_names, self.series())
+
+class Gauge():
+    '''
+    Value read from a callback when metrics are rendered, e.g. a cache size.
+    The callback returns a number, or a dictionary of label value tuples to
+    numbers.
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, callback, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.callback = callback
+
+    def series(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return values
+
+    def samples(self):
+        return _value_lines(self.name, self.label_names, self.series())
+
+class StageTimer():
+    '''
+    Times consecutive stages of one operation: each mark records the time
+    since the previous mark (or since the timer was created) under that
+    stage's name.
+    '''
+    def __init__(self, histogram, *label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.started = self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.histogram.observe(now - self.last, *(self.label_values + (stage,)))
+        self.last = now
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+class _NullTimer():
+    #Stands in for StageTimer when metrics are off, so timing costs one call
+    def mark(self, stage):
+        pass
+
+    def elapsed(self):
+        return 0.0
+
+NULL_TIMER = _NullTimer()
+
+class MetricsRegistry():
+    '''
+    Named collection of metrics rendered together for a /metrics endpoint.
+    Asking for an existing name returns the registered metric.
+    '''
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError('{} is already registered as a {}'.format(name, metric.kind))
+            return metric
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, label_names, buckets)
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter, name, documentation, label_names)
+
+    def gauge(self, name, documentation, callback, label_names=()):
+        return self._register(Gauge, name, documentation, callback, label_names)
+
+    def stage_timer(self, name, documentation, label_names, *label_values):
+        '''
+        Returns a StageTimer over a histogram labelled by label_names plus
+        "stage".
+        '''
+
+        histogram = self.histogram(name, documentation, tuple(label_names) + ('stage',))
+        return StageTimer(histogram, *label_values)
+
+    def render(self):
+        '''
+        Returns every metric in the Prometheus text exposition format.
+        '''
+
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for name, metric in metrics:
+            lines.append('# HELP {} {}'.format(name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        '''
+        Returns the current value of every metric as a JSON serializable
+        dictionary, for merge_snapshots.
+        '''
+
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return {name: {'kind': metric.kind, 'documentation': metric.documentation,
+                       'label_names': list(metric.label_names),
+                       'buckets': list(getattr(metric, 'buckets', ())),
+                       'series': [[list(labels), value]
+                                  for labels, value in metric.series().items()]}
+                for name, metric in metrics}
+
+REGISTRY = MetricsRegistry()
+
+def merge_snapshots(snapshots):
+    '''
+    Adds up MetricsRegistry snapshots, e.g. one per worker process, and
+    returns them in the Prometheus text exposition format. Counts, sums and
+    gauges are summed per label combination.
+
+    Parameters:
+    -----------
+    snapshots: List of dictionaries - Outputs of MetricsRegistry.snapshot
+
+    Output:
+    -------
+    text: String - The combined metrics
+    '''
+
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            entry = merged.setdefault(name, dict(metric, series={}))
+            for labels, value in metric['series']:
+                labels = tuple(labels)
+                if metric['kind'] == 'histogram':
+                    counts, total, count = entry['series'].get(
+                        labels, ([0] * (len(metric['buckets']) + 1), 0.0, 0))
+                    entry['series'][labels] = ([a + b for a, b in zip(counts, value[0])],
+                                               total + value[1], count + value[2])
+                else:
+                    entry['series'][labels] = entry['series'].get(labels, 0) + value
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append('# HELP {} {}'.format(name, metric['documentation']))
+        lines.append('# TYPE {} {}'.format(name, metric['kind']))
+        if metric['kind'] == 'histogram':
+            lines.extend(_histogram_lines(name, metric['label_names'], metric['buckets'],
+                                          metric['series']))
+        else:
+            lines.extend(_value_lines(name, metric['label_names'], metric['series']))
+    return '\n'.join(lines) + '\n'
+
+class SampledProfiler():
+    '''
+    Runs cProfile on a random sample of requests and keeps the output of
+    those slower than a threshold. With a sample rate of 0 (the default)
+    starting costs one comparison.
+    '''
+    def __init__(self, sample_rate=0.0, slow_seconds=0.5, directory='profiles'):
+        '''
+        Parameters:
+        -----------
+        sample_rate: Float - Fraction of requests to profile (Default: 0, off)
+        slow_seconds: Float - Only keep profiles of requests at least this
+        slow (Default: 0.5)
+        directory: String - Where .prof files are written (Default: profiles)
+
+        Output:
+        --------
+        None
+        '''
+
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.directory = directory
+        self.saved = 0
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        '''
+        Configures a profiler from PROFILE_SAMPLE_RATE, PROFILE_SLOW_SECONDS
+        and PROFILE_DIR.
+        '''
+
+        return cls(float(environ.get('PROFILE_SAMPLE_RATE', 0)),
+                   float(environ.get('PROFILE_SLOW_SECONDS', 0.5)),
+                   environ.get('PROFILE_DIR', 'profiles'))
+
+    def start(self):
+        '''
+        Returns a running profiler for a sampled request, or None.
+        '''
+
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            #Another profiler is already running on this thread
+            return None
+        return profile
+
+    def finish(self, profile, duration, name):
+        '''
+        Stops a profiler from start and saves its stats if the request was
+        slow. Returns the file written, or None.
+        '''
+
+        profile.disable()
+        if duration < self.slow_seconds:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}-{}-{:.0f}ms.prof'.format(
+            time.strftime('%Y%m%dT%H%M%S'), name, duration * 1000))
+        profile.dump_stats(path)
+        self.saved += 1
+        return path
@@ -0,0 +1,259 @@
+'''
+Exports the recommender's data to a versioned binary artifact and loads it
+back with memory-mapped arrays, so the web app starts without parsing CSVs
+and every worker process shares the same pages of the operating system's
+file cache.
+
+An artifact is a directory holding a manifest.json and one .npy file per
+array. Usage:
+
+    python model_artifact.py [--df data/df_with_features.csv]
+                             [--mapping data/mapping_df.csv]
+                             [--out data/model_artifact]
+'''
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from recommender_model import META_COLUMNS, ModelData
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+# Arrays written to every artifact, keyed by file name without .npy
+ARTIFACT_ARRAYS = ['index', 'W', 'mapping', 'feature_matrix',
+                   'feature_columns'] + META_COLUMNS
+
+def export_artifact(df, mapping_df, path):
+    '''
+    Writes the shop metadata, NMF W matrix, mapping matrix and precomputed
+    feature matrix to an artifact directory. The directory is written next
+    to path and renamed into place, so readers never see a partial artifact.
+
+    Parameters:
+    -----------
+    df: Pandas DataFrame - The primary recommender dataframe including the W
+    matrix from NMF
+    mapping_df: Pandas DataFrame - The dataframe mapping user features to
+    NMF model's latent features
+    path: String - Artifact directory to create, or an empty directory or
+    earlier artifact to replace. Any other existing path raises ValueError.
+
+    Output:
+    -------
+    manifest: Dictionary - The artifact's manifest
+    '''
+
+    if not _is_replaceable(path):
+        raise ValueError('{} exists and is not a model artifact; refusing to replace it'
+                         .format(path))
+    latent_columns = [col for col in df.columns if col not in META_COLUMNS]
+    feature_matrix = ModelData.build_feature_matrix(df, mapping_df)
+    arrays = {'index': df.index.to_numpy(),
+              'W': df[latent_columns].to_numpy(dtype=float),
+              'mapping': mapping_df.to_numpy(dtype=float),
+              'feature_matrix': feature_matrix,
+              'feature_columns': np.ascontiguousarray(feature_matrix.T),
+              'lat': df['lat'].to_numpy(dtype=float),
+              'lng': df['lng'].to_numpy(dtype=float),
+              'shop_id': df['shop_id'].to_numpy(dtype=np.int64),
+              #Fixed-width unicode so the strings can be memory-mapped too
+              'name': np.array(df['name'].astype(str).tolist()),
+              'address': np.array(df['address'].fillna('').astype(str).tolist())}
+
+    manifest = {'version': ARTIFACT_VERSION,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'n_shops': len(df),
+                'latent_columns': latent_columns,
+                #JSON keeps integer labels as integers
+                'mapping_index': [i if isinstance(i, (int, float)) else str(i)
+                                  for i in mapping_df.index.tolist()],
+                'mapping_columns': list(mapping_df.columns),
+                'arrays': {name: {'dtype': arrays[name].dtype.str,
+                                  'shape': list(arrays[name].shape)}
+                           for name in ARTIFACT_ARRAYS}}
+
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix='.tmp_artifact_', dir=parent)
+    os.chmod(tmp_path, 0o755)
+    for name in ARTIFACT_ARRAYS:
+        np.save(os.path.join(tmp_path, name + '.npy'), arrays[name],
+                allow_pickle=False)
+    with open(os.path.join(tmp_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return manifest
+
+def _is_replaceable(path):
+    #Only an empty directory or one holding an earlier artifact's manifest is
+    #replaced, never whatever else the output path points at
+    if not os.path.lexists(path):
+        return True
+    if os.path.islink(path) or not os.path.isdir(path):
+        return False
+    if not os.listdir(path):
+        return True
+    try:
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return isinstance(manifest, dict) and 'mapping_columns' in manifest
+
+def read_manifest(path):
+    '''
+    Reads and validates an artifact's manifest.
+
+    Parameters:
+    -----------
+    path: String - Artifact directory
+
+    Output:
+    -------
+    manifest: Dictionary
+    '''
+
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != ARTIFACT_VERSION:
+        raise ValueError('Artifact {} has version {}, expected {}'.format(
+            path, manifest.get('version'), ARTIFACT_VERSION))
+    missing = set(ARTIFACT_ARRAYS) - set(manifest.get('arrays', {}))
+    if missing:
+        raise ValueError('Artifact {} is missing arrays {}'.format(
+            path, sorted(missing)))
+    return manifest
+
+def load_artifact(path, mmap_mode='r'):
+    '''
+    Loads an artifact written by export_artifact, checking every array's
+    dtype and shape against the manifest. The arrays are passed on as they
+    are mapped; ModelData uses them directly, and artifact_frame builds the
+    shop dataframe only for callers that need one.
+
+    Parameters:
+    -----------
+    path: String - Artifact directory
+    mmap_mode: String - Passed to np.load; 'r' memory-maps the arrays
+    read-only, None reads them into memory (Default: 'r')
+
+    Output:
+    -------
+    mapping_df: Pandas DataFrame - The mapping matrix
+    precomputed: Dictionary - Read-only arrays for ModelData, plus the
+    artifact's manifest under 'manifest'
+    '''
+
+    manifest = read_manifest(path)
+    n_shops = manifest['n_shops']
+    n_latent = len(manifest['latent_columns'])
+    n_features = len(manifest['mapping_columns'])
+    expected_shapes = {'index': [n_shops], 'W': [n_shops, n_latent],
+                       'mapping': [n_latent, n_features],
+                       'feature_matrix': [n_shops, n_features],
+                       'feature_columns': [n_features, n_shops]}
+
+    arrays = {}
+    for name in ARTIFACT_ARRAYS:
+        array = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode,
+                        allow_pickle=False)
+        spec = manifest['arrays'][name]
+        shape = expected_shapes.get(name, [n_shops])
+        if (array.dtype.str != spec['dtype'] or list(array.shape) != spec['shape']
+                or list(array.shape) != shape):
+            raise ValueError('Artifact array {} has dtype {} and shape {}, expected {} and {}'
+                             .format(name, array.dtype.str, list(array.shape),
+                                     spec['dtype'], shape))
+        array.flags.writeable = False
+        arrays[name] = array
+    arrays['manifest'] = manifest
+
+    #The mapping is tiny, so it's the one array copied into a dataframe
+    mapping_df = pd.DataFrame(np.array(arrays['mapping']),
+                              index=pd.Index(manifest['mapping_index']),
+                              columns=manifest['mapping_columns'])
+    return mapping_df, arrays
+
+def artifact_frame(precomputed):
+    '''
+    Builds the primary recommender dataframe, shop metadata followed by the
+    W matrix, from loaded artifact arrays. This copies every array, so it's
+    only for code that works on dataframes, not for serving.
+
+    Parameters:
+    -----------
+    precomputed: Dictionary - Output of load_artifact
+
+    Output:
+    -------
+    df: Pandas DataFrame - The primary recommender dataframe including the W
+    matrix from NMF
+    '''
+
+    #Same column order as df_with_features.csv
+    df = pd.DataFrame({col: np.asarray(precomputed[col])
+                       for col in ['lat', 'lng', 'name', 'address', 'shop_id']},
+                      index=np.asarray(precomputed['index']))
+    latent = pd.DataFrame(np.asarray(precomputed['W']), index=df.index,
+                          columns=precomputed['manifest']['latent_columns'])
+    return pd.concat([df, latent], axis=1)
+
+def load_model_inputs(artifact_path, df_path, mapping_path):
+    '''
+    Loads the recommender's inputs from an artifact, falling back to the CSV
+    files when the artifact is missing or fails validation.
+
+    Parameters:
+    -----------
+    artifact_path: String - Artifact directory
+    df_path: String - Path to df_with_features.csv
+    mapping_path: String - Path to mapping_df.csv
+
+    Output:
+    -------
+    df: Pandas DataFrame or None - The primary recommender dataframe, None
+    when loaded from the artifact
+    mapping_df: Pandas DataFrame
+    precomputed: Dictionary or None - Arrays for ModelData, None when loaded
+    from CSV
+    '''
+
+    try:
+        mapping_df, precomputed = load_artifact(artifact_path)
+        return None, mapping_df, precomputed
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning('Could not load model artifact %s (%s), reading CSVs instead',
+                       artifact_path, e)
+    df = pd.read_csv(df_path, index_col=0)
+    mapping_df = pd.read_csv(mapping_path, index_col=0)
+    return df, mapping_df, None
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the recommender data '
+                                                 'to a binary artifact')
+    parser.add_argument('--df', default='data/df_with_features.csv')
+    parser.add_argument('--mapping', default='data/mapping_df.csv')
+    parser.add_argument('--out', default='data/model_artifact')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.df, index_col=0)
+    mapping_df = pd.read_csv(args.mapping, index_col=0)
+    manifest = export_artifact(df, mapping_df, args.out)
+    print('Wrote artifact version {} with {} shops to {}'.format(
+        manifest['version'], manifest['n_shops'], args.out))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,495 @@
+'''
+Versioned model artifacts with hot reload. Each published version is a model
+artifact (see model_artifact.py) in its own subdirectory of the registry,
+named after the time it was published:
+
+    data/model_registry/20261018T174500/manifest.json, ...
+
+Which version should be live is recorded in the registry's state.json,
+along with the version before it, the versions that were rejected and the
+candidates published for an admin to activate.
+Publishing, activating and rolling back all update that file, so every
+process serving from the registry, and every process started later,
+follows the same decision.
+
+ModelRegistry watches the registry from a background thread. When the
+active version changes it loads it, warms it and runs smoke queries against
+it, then swaps it into the running RecommenderModel in one assignment, so
+requests in flight finish on the data they started with. The previous
+version is kept in memory for an instant rollback.
+
+Publish the current CSVs as a new version with:
+
+    python model_registry.py publish [--df data/df_with_features.csv]
+                                     [--mapping data/mapping_df.csv]
+                                     [--registry data/model_registry]
+    python model_registry.py list [--registry data/model_registry]
+'''
+import argparse
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from model_artifact import MANIFEST_NAME, export_artifact, read_manifest
+from recommender_model import RecommenderModel
+
+logger = logging.getLogger(__name__)
+
+# Versions kept on disk by publish_version, newest first. The active and
+# previous versions are always kept on top of these.
+KEEP_VERSIONS = 5
+
+STATE_NAME = 'state.json'
+STATE_LOCK_NAME = '.state.lock'
+
+# Default version names: publish time, plus -N when several are published
+# in the same second
+VERSION_PATTERN = re.compile(r'^(\d{8}T\d{6})(?:-(\d+))?$')
+
+def _version_key(path, name):
+    #Names are compared as a time and a number, so ...-10 sorts after ...-2;
+    #custom names fall back to the time their manifest was written
+    match = VERSION_PATTERN.match(name)
+    if match:
+        return match.group(1), int(match.group(2) or 0), name
+    try:
+        created = read_manifest(os.path.join(path, name)).get('created', '')
+    except (OSError, ValueError):
+        created = ''
+    return created.replace('-', '').replace(':', ''), 0, name
+
+def list_versions(path):
+    '''
+    Returns the names of the complete versions in a registry, oldest first.
+    Directories still being written (dot-prefixed temporaries) and ones
+    without a manifest are skipped.
+    '''
+
+    if not os.path.isdir(path):
+        return []
+    names = [name for name in os.listdir(path)
+             if not name.startswith('.')
+             and os.path.exists(os.path.join(path, name, MANIFEST_NAME))]
+    return sorted(names, key=lambda name: _version_key(path, name))
+
+def read_state(path):
+    '''
+    Reads a registry's state: the 'active' and 'previous' version names
+    (None when not set), the 'rejected' versions with the reason and the
+    'candidates' published without being activated.
+    '''
+
+    try:
+        with open(os.path.join(path, STATE_NAME)) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    return {'active': state.get('active'), 'previous': state.get('previous'),
+            'rejected': dict(state.get('rejected') or {}),
+            'candidates': list(state.get('candidates') or [])}
+
+def update_state(path, update):
+    '''
+    Applies update(state) to a registry's state and writes it back. Other
+    processes updating the same registry wait on a file lock, and the file
+    is replaced in one rename, so readers never see a partial write.
+
+    Parameters:
+    -----------
+    path: String - Registry directory
+    update: Callable - Takes the state dictionary and modifies it in place
+
+    Output:
+    -------
+    state: Dictionary - The state written
+    '''
+
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, STATE_LOCK_NAME), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = read_state(path)
+        update(state)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_state_', dir=path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, os.path.join(path, STATE_NAME))
+    return state
+
+def target_version(path, versions=None, state=None):
+    '''
+    Returns the version a registry says should be live: the active version
+    in its state, or, for registries without one, the newest version that
+    wasn't rejected and isn't a candidate. None if there is none.
+    '''
+
+    versions = list_versions(path) if versions is None else versions
+    state = read_state(path) if state is None else state
+    if state['active'] in versions and state['active'] not in state['rejected']:
+        return state['active']
+    usable = [name for name in versions
+              if name not in state['rejected'] and name not in state['candidates']]
+    return usable[-1] if usable else None
+
+def publish_version(df, mapping_df, path, version=None, keep=KEEP_VERSIONS, activate=True):
+    '''
+    Exports a new artifact version to a registry, makes it the active
+    version, so running web apps pick it up, and deletes the oldest versions
+    beyond keep. With activate=False the version is only a candidate: the
+    active version stays live until an admin activates the new one.
+
+    Parameters:
+    -----------
+    df: Pandas DataFrame - The primary recommender dataframe including the W
+    matrix from NMF
+    mapping_df: Pandas DataFrame - The dataframe mapping user features to
+    NMF model's latent features
+    path: String - Registry directory
+    version: String - Version name (Default: the current time, e.g.
+    20261018T174500)
+    keep: Int - Number of versions to keep besides the active and previous
+    ones, or None to keep all
+    activate: Bool - Whether to make the new version active (Default: True)
+
+    Output:
+    -------
+    version: String - The published version's name
+    '''
+
+    if version is None:
+        version = time.strftime('%Y%m%dT%H%M%S')
+        existing = set(list_versions(path))
+        suffix = 1
+        base = version
+        while version in existing:
+            version = '{}-{}'.format(base, suffix)
+            suffix += 1
+
+    if not activate:
+        #Recorded before the export, so no reader takes it for the newest
+        #version to serve in between
+        def add_candidate(state):
+            state['candidates'] = sorted(set(state['candidates']) | {version})
+        update_state(path, add_candidate)
+    export_artifact(df, mapping_df, os.path.join(path, version))
+
+    def make_active(state):
+        active = target_version(path, [name for name in list_versions(path) if name != version],
+                                state)
+        state['previous'], state['active'] = active, version
+        state['rejected'].pop(version, None)
+        state['candidates'] = [name for name in state['candidates'] if name != version]
+
+    state = update_state(path, make_active) if activate else read_state(path)
+    if keep is not None:
+        protected = {state['active'], state['previous'], version}
+        removed = [old for old in list_versions(path)[:-keep] if old not in protected]
+        for old in removed:
+            shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+        if set(removed) & set(state['candidates']):
+            def forget(state):
+                state['candidates'] = [name for name in state['candidates']
+                                       if name not in removed]
+            update_state(path, forget)
+    return version
+
+class ModelVersion():
+    '''
+    A loaded version: its ModelData and when and how fast it was loaded.
+    '''
+    def __init__(self, name, data, load_seconds):
+        self.name = name
+        self.data = data
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+
+    def describe(self):
+        return {'version': self.name,
+                'loaded_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.loaded_at)),
+                'load_seconds': round(self.load_seconds, 3),
+                'shops': len(self.data.shop_locations),
+                'features': len(self.data.feature_index)}
+
+class ModelRegistry():
+    '''
+    Keeps a RecommenderModel on the version a registry directory says is
+    active. Loading, warming and smoke testing happen off the request path;
+    only the final swap touches the live model. Activations, rollbacks and
+    rejections are written to the registry's state, so they apply to every
+    process serving from it.
+    '''
+    def __init__(self, model, path, version='initial', poll_interval=10.0,
+                 smoke_queries=None, metrics=None):
+        '''
+        Parameters:
+        -----------
+        model: RecommenderModel - The live model, already holding the
+        version it was built with
+        path: String - Registry directory to watch
+        version: String - Name of the model's current version (Default:
+        'initial', e.g. when it was built from the CSVs)
+        poll_interval: Float - Seconds between checks for new versions
+        smoke_queries: List of dictionaries - recommend_features arguments
+        that must each return at least one recommendation before a version
+        is activated (Default: one query per feature, from downtown)
+        metrics: MetricsRegistry - Optional registry to count reloads in, as
+        model_reloads{outcome}
+
+        Output:
+        --------
+        None
+        '''
+
+        self.model = model
+        self.path = path
+        self.poll_interval = poll_interval
+        self.smoke_queries = smoke_queries
+        self.active = ModelVersion(version, model.data, 0.0)
+        self.previous = None
+        self.last_checked = None
+        self._reloads = None
+        if metrics is not None:
+            self._reloads = metrics.counter('model_reloads', 'Model version loads by outcome',
+                                            ('outcome',))
+        self._lock = threading.Lock()
+        #Serializes loads, so the watcher and an admin request don't load the
+        #same version twice
+        self._reload_lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _count(self, outcome):
+        if self._reloads is not None:
+            self._reloads.inc(outcome)
+
+    def start(self):
+        '''
+        Starts watching the registry from a daemon thread. Returns self.
+        '''
+
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name='model-registry',
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _watch(self):
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                #Keep watching; a broken version is recorded by check
+                logger.exception('Model registry check failed: %s', e)
+            self._stop.wait(self.poll_interval)
+
+    def check(self):
+        '''
+        Swaps in the registry's active version if it isn't the one being
+        served. Returns the newly served version's name, or None if nothing
+        changed.
+        '''
+
+        with self._reload_lock:
+            self.last_checked = time.time()
+            target = target_version(self.path)
+            if target is None or target == self.active.name:
+                return None
+            return target if self._swap_in(target) else None
+
+    def load(self, version):
+        '''
+        Loads, warms and smoke tests a version without activating it.
+
+        Parameters:
+        -----------
+        version: String - Version name in the registry
+
+        Output:
+        -------
+        loaded: ModelVersion
+        '''
+
+        start = time.perf_counter()
+        path = os.path.join(self.path, version)
+        read_manifest(path)
+        candidate = RecommenderModel.from_artifact(path, self.model.distance_engine,
+                                                   neighborhoods=self.model.neighborhoods)
+        data = candidate.data
+        data.warm(self.model.data)
+        self.smoke_test(candidate)
+        return ModelVersion(version, data, time.perf_counter() - start)
+
+    def smoke_test(self, candidate):
+        '''
+        Runs the smoke queries against a candidate model, raising ValueError
+        if any returns no recommendations or non-finite scores.
+        '''
+
+        queries = self.smoke_queries
+        if queries is None:
+            queries = [dict(chosen_features=[(1.0, name)], lat=47.6130285, lng=-122.3420645,
+                            r=2, n=3) for name in candidate.data.mapping_df.columns]
+        for query in queries:
+            recs = candidate.recommend_features(**query)
+            if len(recs) == 0:
+                raise ValueError('Smoke query {} returned no recommendations'.format(query))
+            if not np.all(np.isfinite(recs.combined_weights)):
+                raise ValueError('Smoke query {} returned non-finite scores'.format(query))
+        shop_id = int(candidate.data.shop_metadata['shop_id'][0])
+        candidate.similar_shops(shop_id, n=1)
+
+    def _swap_in(self, version):
+        #Loads a version and makes it live in this process. A version that
+        #fails to load is rejected in the registry, and if it was the active
+        #one, the registry goes back to the version before it.
+        with self._reload_lock:
+            if self.previous is not None and self.previous.name == version:
+                loaded = self.previous
+            else:
+                try:
+                    loaded = self.load(version)
+                except Exception as e:
+                    logger.error('Model version %s rejected: %s', version, e)
+                    self._reject(version, str(e))
+                    self._count('failed')
+                    return False
+            with self._lock:
+                self.model.swap_data(loaded.data)
+                self.previous, self.active = self.active, loaded
+        self._count('activated')
+        logger.info('Activated model version %s in %.2f s', version, loaded.load_seconds)
+        return True
+
+    def _reject(self, version, reason):
+        def reject(state):
+            state['rejected'][version] = reason
+            if state['active'] == version:
+                state['active'], state['previous'] = state['previous'], None
+        update_state(self.path, reject)
+
+    def activate(self, version):
+        '''
+        Makes a version the registry's active version and swaps it in, so
+        every process serving from the registry moves to it. A version that
+        fails to load is rejected and the registry goes back to the version
+        that was active.
+
+        Parameters:
+        -----------
+        version: String - Version name in the registry
+
+        Output:
+        -------
+        activated: Bool - Whether the version is now active
+        '''
+
+        with self._reload_lock:
+            def make_active(state):
+                active = target_version(self.path, state=state)
+                if active != version:
+                    state['previous'], state['active'] = active, version
+                state['rejected'].pop(version, None)
+                state['candidates'] = [name for name in state['candidates'] if name != version]
+            update_state(self.path, make_active)
+            if version == self.active.name:
+                return True
+            return self._swap_in(version)
+
+    def rollback(self):
+        '''
+        Makes the registry's previous version active again and swaps it in.
+        The version rolled back from is rejected, so no process loads it
+        again unless it is activated explicitly.
+
+        Output:
+        -------
+        version: String - The now active version's name, or None if there is
+        no previous version
+        '''
+
+        with self._reload_lock:
+            state = read_state(self.path)
+            target = state['previous']
+            if target is None and self.previous is not None:
+                target = self.previous.name
+            if target is None or target not in list_versions(self.path):
+                return None
+            rolled_back = target_version(self.path, state=state) or self.active.name
+
+            def roll_back(state):
+                state['rejected'][rolled_back] = 'rolled back'
+                state['rejected'].pop(target, None)
+                state['active'], state['previous'] = target, None
+            update_state(self.path, roll_back)
+            if target != self.active.name and not self._swap_in(target):
+                return None
+            with self._lock:
+                if self.previous is not None and self.previous.name == rolled_back:
+                    self.previous = None
+        self._count('rolled_back')
+        return self.active.name
+
+    def status(self):
+        '''
+        Describes the active and previous versions and the registry's state.
+        '''
+
+        state = read_state(self.path)
+        with self._lock:
+            return {'active': self.active.describe(),
+                    'previous': self.previous.describe() if self.previous else None,
+                    'available': list_versions(self.path),
+                    'registry_active': target_version(self.path, state=state),
+                    'rejected': state['rejected'],
+                    'candidates': state['candidates'],
+                    'watching': self._thread is not None,
+                    'last_checked': (time.strftime('%Y-%m-%dT%H:%M:%S',
+                                                   time.localtime(self.last_checked))
+                                     if self.last_checked else None)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Publish or list model registry versions')
+    parser.add_argument('command', choices=['publish', 'list'])
+    parser.add_argument('--df', default='data/df_with_features.csv')
+    parser.add_argument('--mapping', default='data/mapping_df.csv')
+    parser.add_argument('--registry', default='data/model_registry')
+    parser.add_argument('--version', help='Version name (Default: the current time)')
+    parser.add_argument('--keep', type=int, default=KEEP_VERSIONS)
+    args = parser.parse_args()
+
+    if args.command == 'publish':
+        df = pd.read_csv(args.df, index_col=0)
+        mapping_df = pd.read_csv(args.mapping, index_col=0)
+        version = publish_version(df, mapping_df, args.registry, args.version, args.keep)
+        print('Published version {} with {} shops to {}'.format(version, len(df), args.registry))
+    else:
+        state = read_state(args.registry)
+        active = target_version(args.registry, state=state)
+        for version in list_versions(args.registry):
+            manifest = read_manifest(os.path.join(args.registry, version))
+            notes = ['active'] if version == active else []
+            if version in state['candidates']:
+                notes.append('candidate')
+            if version in state['rejected']:
+                notes.append('rejected: {}'.format(state['rejected'][version]))
+            print('{}  {} shops, created {}{}'.format(
+                version, manifest['n_shops'], manifest['created'],
+                '  ({})'.format('; '.join(notes)) if notes else ''))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,509 @@
+'''
+Neighborhood-aware candidate lists for the recommender, precomputed from the
+Seattle shapefiles in data/Neighborhoods and data/Shorelines.
+
+The build step lays a grid of cells (about 0.17 x 0.12 miles) over the city
+and stores, for each cell and a few common radii, every shop that could be
+within that radius of some point in the cell. It also assigns each shop, and
+each point of a finer raster, to a neighborhood, and records which shops can
+be reached in a straight line from each cell without crossing water. A radius
+query then measures distances to its cell's candidates only, and the "my
+neighborhood" and "don't cross water" filters are array lookups with no
+polygon math at request time.
+
+The index is a directory holding a manifest.json and one .npy file per
+array, like the model artifact. Build with (scipy required):
+
+    python neighborhood_index.py [--df data/df_with_features.csv]
+                                 [--out data/neighborhood_index]
+'''
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from geo_functions import haversine_miles
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+# Grid cell size in degrees, and raster points per cell side for the
+# neighborhood and water rasters (about 30 x 45 feet each)
+CELL_SIZE = 0.0025
+RASTER_CELLS = 20
+# Radii, in miles, that candidate lists are precomputed for. Larger queries
+# fall back to the model's GridIndex.
+RADII = (0.5, 1, 2, 3, 5)
+# Water within this many miles of either end of a path is ignored, so shops
+# on piers and users on the waterfront aren't cut off
+ENDPOINT_TOLERANCE_MILES = 0.06
+# Locations this close to a neighborhood, e.g. on a pier or beach, count as
+# part of it
+SNAP_MILES = 0.1
+# Shoreline features that can't be crossed on foot
+WATER_FEATURE = 'waterbody'
+# Upper bound on cell x shop entries held in memory at once while building
+MAX_BLOCK_ENTRIES = 2 ** 21
+
+ARRAYS = ['shop_id', 'shop_neighborhood', 'location_neighborhood', 'dry_bits']
+
+def _cell_miles(lat, size):
+    #Height and width in miles of a size x size degree cell at latitude lat
+    lat_rad = np.radians(lat)
+    height = haversine_miles(lat - size / 2, 0.0, np.radians([lat + size / 2]),
+                             np.radians([0.0]), np.cos([np.radians(lat + size / 2)]))[0]
+    width = haversine_miles(lat, 0.0, np.array([lat_rad]), np.radians([size]),
+                            np.array([np.cos(lat_rad)]))[0]
+    return height, width
+
+def neighborhood_raster(hoods, west, south, raster_size, shape):
+    '''
+    Labels each raster point with the neighborhood containing it. Points
+    within SNAP_MILES of a neighborhood take the nearest one's label; the
+    rest of the water is -1.
+
+    Parameters:
+    -----------
+    hoods: List of (name, district, Polygon) tuples from load_neighborhoods
+    west, south: Floats - Raster's lower left corner in degrees
+    raster_size: Float - Raster spacing in degrees
+    shape: Tuple (rows, columns) - Raster size
+
+    Output:
+    -------
+    labels: Numpy Array - (rows x columns) int16 neighborhood positions
+    '''
+
+    from scipy.ndimage import distance_transform_edt
+    from shapefiles import rasterize
+
+    labels = np.full(shape, -1, dtype=np.int16)
+    for i, (_, _, polygon) in enumerate(hoods):
+        labels[rasterize(polygon, west, south, raster_size, shape) & (labels < 0)] = i
+    height, width = _cell_miles(south + shape[0] * raster_size / 2, raster_size)
+    distances, (rows, cols) = distance_transform_edt(labels < 0, sampling=(height, width),
+                                                     return_indices=True)
+    snap = (labels < 0) & (distances <= SNAP_MILES)
+    labels[snap] = labels[rows[snap], cols[snap]]
+    return labels
+
+def water_raster(shorelines, west, south, raster_size, shape):
+    '''
+    Marks the raster points that fall inside a shoreline water body.
+
+    Parameters:
+    -----------
+    shorelines: List of (record, parts) pairs from read_shapefile
+    west, south: Floats - Raster's lower left corner in degrees
+    raster_size: Float - Raster spacing in degrees
+    shape: Tuple (rows, columns) - Raster size
+
+    Output:
+    -------
+    water: Numpy Array - (rows x columns) boolean mask
+    '''
+
+    from shapefiles import Polygon, rasterize
+
+    water = np.zeros(shape, dtype=bool)
+    for record, parts in shorelines:
+        if parts and record['FEATURE'] == WATER_FEATURE:
+            water |= rasterize(Polygon(parts), west, south, raster_size, shape)
+    return water
+
+def dry_paths(origins, targets, water, cell_miles, tolerance=ENDPOINT_TOLERANCE_MILES):
+    '''
+    Tests which straight paths stay out of the water, marching along each
+    path in steps as long as its distance to the nearest water allows.
+
+    Parameters:
+    -----------
+    origins, targets: Numpy Arrays - (paths x 2) end points in fractional
+    raster coordinates (row, column)
+    water: Numpy Array - Boolean water raster
+    cell_miles: Tuple (height, width) - Raster spacing in miles
+    tolerance: Float - Miles at either end of a path where water is ignored
+
+    Output:
+    -------
+    dry: Numpy Array - True for paths that don't cross water
+    '''
+
+    from scipy.ndimage import distance_transform_edt
+
+    #Miles from each raster point to the nearest water point, less the
+    #distance a path can travel within one raster cell
+    clearance = distance_transform_edt(~water, sampling=cell_miles) - np.hypot(*cell_miles)
+    min_step = min(cell_miles) / 2
+    scale = np.array(cell_miles)
+    delta = targets - origins
+    length = np.hypot(*(delta * scale).T)
+    with np.errstate(divide='ignore'):
+        t = np.where(length > 0, tolerance / length, np.inf)
+    end = 1 - t
+    dry = np.ones(len(origins), dtype=bool)
+    active = np.flatnonzero(t < end)
+    n_rows, n_cols = water.shape
+    while len(active):
+        points = origins[active] + t[active, None] * delta[active]
+        rows = np.clip(points[:, 0].astype(int), 0, n_rows - 1)
+        cols = np.clip(points[:, 1].astype(int), 0, n_cols - 1)
+        wet = water[rows, cols]
+        dry[active[wet]] = False
+        t[active] += np.maximum(clearance[rows, cols], min_step) / length[active]
+        active = active[~wet & (t[active] < end[active])]
+    return dry
+
+def _is_replaceable(path):
+    #Only an empty directory or one holding an earlier index's manifest is
+    #replaced, never whatever else the output path points at
+    if not os.path.lexists(path):
+        return True
+    if os.path.islink(path) or not os.path.isdir(path):
+        return False
+    if not os.listdir(path):
+        return True
+    try:
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return isinstance(manifest, dict) and 'radii' in manifest
+
+def build_neighborhood_index(df, path, neighborhoods_path=None, shorelines_path=None,
+                             cell_size=CELL_SIZE, radii=RADII):
+    '''
+    Builds the candidate lists, neighborhood assignments and water paths for
+    a set of shops and writes them to an index directory. The directory is
+    written next to path and renamed into place.
+
+    Parameters:
+    -----------
+    df: Pandas DataFrame - The recommender dataframe (lat, lng and shop_id
+    are used), in the row order the model is built with
+    path: String - Index directory to create, or an empty directory or
+    earlier index to replace. Any other existing path raises ValueError.
+    neighborhoods_path: String - Neighborhood shapefile without extension
+    shorelines_path: String - Shoreline shapefile without extension
+    cell_size: Float - Grid cell size in degrees
+    radii: Tuple of floats - Radii in miles to precompute candidates for
+
+    Output:
+    -------
+    manifest: Dictionary - The index's manifest
+    '''
+
+    from shapefiles import (NEIGHBORHOODS_PATH, SHORELINES_PATH, load_neighborhoods,
+                            read_shapefile)
+
+    if not _is_replaceable(path):
+        raise ValueError('{} exists and is not a neighborhood index; refusing to replace it'
+                         .format(path))
+    hoods = load_neighborhoods(neighborhoods_path or NEIGHBORHOODS_PATH)
+    shorelines = read_shapefile(shorelines_path or SHORELINES_PATH)
+    lats = df['lat'].to_numpy(dtype=float)
+    lngs = df['lng'].to_numpy(dtype=float)
+
+    #Grid over the neighborhoods and every shop, with a cell of margin
+    points = np.concatenate([np.concatenate(polygon.parts) for _, _, polygon in hoods])
+    west = np.floor(min(points[:, 0].min(), lngs.min()) / cell_size - 1) * cell_size
+    south = np.floor(min(points[:, 1].min(), lats.min()) / cell_size - 1) * cell_size
+    n_cols = int(np.ceil(max(points[:, 0].max(), lngs.max()) / cell_size + 1) - west / cell_size)
+    n_rows = int(np.ceil(max(points[:, 1].max(), lats.max()) / cell_size + 1) - south / cell_size)
+    raster_size = cell_size / RASTER_CELLS
+    raster_shape = (n_rows * RASTER_CELLS, n_cols * RASTER_CELLS)
+    raster_miles = _cell_miles(south + n_rows * cell_size / 2, raster_size)
+
+    labels = neighborhood_raster(hoods, west, south, raster_size, raster_shape)
+    shop_rows = (lats - south) / raster_size
+    shop_cols = (lngs - west) / raster_size
+    shop_neighborhood = np.full(len(df), -1, dtype=np.int16)
+    for i, (_, _, polygon) in enumerate(hoods):
+        shop_neighborhood[(shop_neighborhood < 0) & polygon.contains(lngs, lats)] = i
+    unassigned = shop_neighborhood < 0
+    shop_neighborhood[unassigned] = labels[shop_rows[unassigned].astype(int),
+                                           shop_cols[unassigned].astype(int)]
+
+    #Candidates: shops within r of the cell center plus its half diagonal,
+    #so no shop within r of any point in the cell is missed
+    center_lats = south + (np.arange(n_rows) + 0.5) * cell_size
+    center_lngs = west + (np.arange(n_cols) + 0.5) * cell_size
+    half_diagonal = np.array([haversine_miles(lat, 0.0, np.radians([lat + cell_size / 2]),
+                                              np.radians([cell_size / 2]),
+                                              np.cos(np.radians([lat + cell_size / 2])))[0]
+                              for lat in center_lats]) + 1e-6
+    lat_rad, lng_rad = np.radians(lats), np.radians(lngs)
+    cos_lat = np.cos(lat_rad)
+    dtype = np.min_scalar_type(max(len(df) - 1, 0))
+    candidates = [[] for _ in radii]
+    rows_per_block = max(1, MAX_BLOCK_ENTRIES // max(1, n_cols * len(df)))
+    for start in range(0, n_rows, rows_per_block):
+        block_rows = np.arange(start, min(start + rows_per_block, n_rows))
+        grid_lats = np.repeat(center_lats[block_rows], n_cols)[:, None]
+        grid_lngs = np.tile(center_lngs, len(block_rows))[:, None]
+        distances = haversine_miles(grid_lats, grid_lngs, lat_rad, lng_rad, cos_lat)
+        reach = distances - np.repeat(half_diagonal[block_rows], n_cols)[:, None]
+        for lists, r in zip(candidates, radii):
+            lists.extend(np.flatnonzero(row < r).astype(dtype) for row in reach)
+
+    #Water paths run from each cell's center, or its land point nearest the
+    #center if the center is in the water, to every shop
+    from scipy.ndimage import distance_transform_edt
+    water = water_raster(shorelines, west, south, raster_size, raster_shape)
+    _, (land_rows, land_cols) = distance_transform_edt(water, sampling=raster_miles,
+                                                       return_indices=True)
+    centers = (np.arange(n_rows) * RASTER_CELLS + RASTER_CELLS // 2)[:, None], \
+              (np.arange(n_cols) * RASTER_CELLS + RASTER_CELLS // 2)[None, :]
+    origin_rows = land_rows[centers].astype(float)
+    origin_cols = land_cols[centers].astype(float)
+    #Keep the center when the nearest land is in another cell
+    elsewhere = ((origin_rows // RASTER_CELLS != np.arange(n_rows)[:, None]) |
+                 (origin_cols // RASTER_CELLS != np.arange(n_cols)[None, :]))
+    origin_rows[elsewhere] = np.broadcast_to(centers[0], elsewhere.shape)[elsewhere]
+    origin_cols[elsewhere] = np.broadcast_to(centers[1], elsewhere.shape)[elsewhere]
+    origins = np.column_stack((origin_rows.ravel() + 0.5, origin_cols.ravel() + 0.5))
+    targets = np.column_stack((shop_rows, shop_cols))
+    n_cells = n_rows * n_cols
+    dry = np.zeros((n_cells, len(df)), dtype=bool)
+    cells_per_block = max(1, MAX_BLOCK_ENTRIES // max(1, len(df)))
+    for start in range(0, n_cells, cells_per_block):
+        block = np.arange(start, min(start + cells_per_block, n_cells))
+        dry[block] = dry_paths(np.repeat(origins[block], len(df), axis=0),
+                               np.tile(targets, (len(block), 1)), water,
+                               raster_miles).reshape(len(block), len(df))
+
+    arrays = {'shop_id': df['shop_id'].to_numpy(dtype=np.int64),
+              'shop_neighborhood': shop_neighborhood,
+              'location_neighborhood': labels,
+              'dry_bits': np.packbits(dry, axis=1)}
+    for i, lists in enumerate(candidates):
+        arrays['offsets_{}'.format(i)] = np.concatenate(
+            [[0], np.cumsum([len(positions) for positions in lists])]).astype(np.int64)
+        arrays['positions_{}'.format(i)] = (np.concatenate(lists) if lists
+                                            else np.array([], dtype=dtype))
+    manifest = {'version': INDEX_VERSION,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'n_shops': len(df),
+                'west': float(west), 'south': float(south),
+                'cell_size': cell_size, 'shape': [n_rows, n_cols],
+                'raster_cells': RASTER_CELLS,
+                'radii': [float(r) for r in radii],
+                'neighborhoods': [name for name, _, _ in hoods],
+                'districts': [district for _, district, _ in hoods],
+                'arrays': {name: {'dtype': array.dtype.str, 'shape': list(array.shape)}
+                           for name, array in arrays.items()}}
+
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix='.tmp_neighborhoods_', dir=parent)
+    os.chmod(tmp_path, 0o755)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), array, allow_pickle=False)
+    with open(os.path.join(tmp_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return manifest
+
+class NeighborhoodIndex():
+    '''
+    Read-only view of an index written by build_neighborhood_index.
+    Positions refer to rows of the dataframe the index was built from.
+    '''
+    def __init__(self, manifest, arrays):
+        '''
+        Parameters:
+        -----------
+        manifest: Dictionary - The index's manifest
+        arrays: Dictionary - Arrays named in the manifest
+
+        Output:
+        --------
+        None
+        '''
+
+        self.manifest = manifest
+        self.west = manifest['west']
+        self.south = manifest['south']
+        self.cell_size = manifest['cell_size']
+        self.n_rows, self.n_cols = manifest['shape']
+        self.raster_size = self.cell_size / manifest['raster_cells']
+        self.radii = manifest['radii']
+        self.neighborhoods = manifest['neighborhoods']
+        self.districts = manifest['districts']
+        self.shop_id = arrays['shop_id']
+        self.shop_neighborhood = arrays['shop_neighborhood']
+        self.location_neighborhood = arrays['location_neighborhood']
+        self.dry_bits = arrays['dry_bits']
+        self.candidate_lists = [(arrays['offsets_{}'.format(i)], arrays['positions_{}'.format(i)])
+                                for i in range(len(self.radii))]
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        Loads an index, checking every array against the manifest.
+
+        Parameters:
+        -----------
+        path: String - Index directory
+        mmap_mode: String - Passed to np.load (Default: 'r', memory-mapped)
+
+        Output:
+        -------
+        index: NeighborhoodIndex
+        '''
+
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != INDEX_VERSION:
+            raise ValueError('Neighborhood index {} has version {}, expected {}'.format(
+                path, manifest.get('version'), INDEX_VERSION))
+        expected = ARRAYS + ['{}_{}'.format(kind, i) for i in range(len(manifest['radii']))
+                             for kind in ('offsets', 'positions')]
+        arrays = {}
+        for name in expected:
+            spec = manifest['arrays'].get(name)
+            if spec is None:
+                raise ValueError('Neighborhood index {} is missing array {}'.format(path, name))
+            array = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode,
+                            allow_pickle=False)
+            if array.dtype.str != spec['dtype'] or list(array.shape) != spec['shape']:
+                raise ValueError('Neighborhood index array {} has dtype {} and shape {}, '
+                                 'expected {} and {}'.format(name, array.dtype.str,
+                                                             list(array.shape), spec['dtype'],
+                                                             spec['shape']))
+            array.flags.writeable = False
+            arrays[name] = array
+        return cls(manifest, arrays)
+
+    def matches(self, shop_ids):
+        '''
+        Whether the index was built for these shops, in this order.
+        '''
+
+        return np.array_equal(self.shop_id, np.asarray(shop_ids))
+
+    def cell(self, lat, lng):
+        '''
+        Returns the grid cell containing (lat, lng), or None outside the grid.
+        '''
+
+        row = int(np.floor((float(lat) - self.south) / self.cell_size))
+        col = int(np.floor((float(lng) - self.west) / self.cell_size))
+        if not (0 <= row < self.n_rows and 0 <= col < self.n_cols):
+            return None
+        return row * self.n_cols + col
+
+    def neighborhood_id(self, lat, lng):
+        '''
+        Returns the position in self.neighborhoods of the neighborhood
+        containing (lat, lng), or -1 for water and places outside the city.
+        '''
+
+        row = int(np.floor((float(lat) - self.south) / self.raster_size))
+        col = int(np.floor((float(lng) - self.west) / self.raster_size))
+        n_rows, n_cols = self.location_neighborhood.shape
+        if not (0 <= row < n_rows and 0 <= col < n_cols):
+            return -1
+        return int(self.location_neighborhood[row, col])
+
+    def neighborhood(self, lat, lng):
+        '''
+        Returns the name of the neighborhood containing (lat, lng), or None.
+        '''
+
+        i = self.neighborhood_id(lat, lng)
+        return self.neighborhoods[i] if i >= 0 else None
+
+    def candidates(self, cell, r):
+        '''
+        Returns the ascending row positions of every shop that may be within
+        r miles of a point in the cell, from the smallest precomputed radius
+        of at least r, or None if r is larger than every precomputed radius.
+        '''
+
+        for radius, (offsets, positions) in zip(self.radii, self.candidate_lists):
+            if r <= radius:
+                return np.asarray(positions[offsets[cell]:offsets[cell + 1]], dtype=int)
+        return None
+
+    def dry(self, cell, positions):
+        '''
+        Returns, for each shop position, whether the straight path from the
+        cell to the shop stays out of the water.
+        '''
+
+        bits = self.dry_bits[cell]
+        return ((bits[positions >> 3] >> (7 - (positions & 7))) & 1).astype(bool)
+
+    def filter(self, lat, lng, positions, same_neighborhood=False, avoid_water=False):
+        '''
+        Applies the neighborhood and water filters to shop positions.
+
+        Parameters:
+        -----------
+        lat, lng: Floats - User's location
+        positions: Numpy Array - Row positions of candidate shops
+        same_neighborhood: Bool - Keep only shops in the user's neighborhood
+        avoid_water: Bool - Keep only shops reachable without crossing water
+
+        Output:
+        -------
+        keep: Numpy Array - Boolean mask over positions
+        '''
+
+        keep = np.ones(len(positions), dtype=bool)
+        if same_neighborhood:
+            keep &= self.shop_neighborhood[positions] == self.neighborhood_id(lat, lng)
+            if self.neighborhood_id(lat, lng) < 0:
+                keep[:] = False
+        if avoid_water:
+            cell = self.cell(lat, lng)
+            if cell is None:
+                raise ValueError('({}, {}) is outside the neighborhood index'.format(lat, lng))
+            keep &= self.dry(cell, positions)
+        return keep
+
+def load_neighborhood_index(path):
+    '''
+    Loads a neighborhood index, or returns None (with a warning) when it is
+    missing or fails validation, so the recommender runs without it.
+    '''
+
+    try:
+        return NeighborhoodIndex.load(path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning('Could not load neighborhood index %s (%s), neighborhood filters are off',
+                       path, e)
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the neighborhood-aware candidate '
+                                                 'index from the Seattle shapefiles')
+    parser.add_argument('--df', default='data/df_with_features.csv')
+    parser.add_argument('--out', default='data/neighborhood_index')
+    parser.add_argument('--cell-size', type=float, default=CELL_SIZE)
+    parser.add_argument('--radii', type=float, nargs='+', default=list(RADII))
+    args = parser.parse_args()
+
+    start = time.time()
+    df = pd.read_csv(args.df, index_col=0)
+    manifest = build_neighborhood_index(df, args.out, cell_size=args.cell_size,
+                                        radii=sorted(args.radii))
+    n_rows, n_cols = manifest['shape']
+    print('Indexed {} shops in {} neighborhoods on a {} x {} grid in {:.1f} s, written to {}'
+          .format(manifest['n_shops'], len(manifest['neighborhoods']), n_rows, n_cols,
+                  time.time() - start, args.out))
+
+if __name__ == '__main__':
+    main()
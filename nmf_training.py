@@ -0,0 +1,497 @@
+'''
+Fits the Tf-Idf + NMF latent features behind df_with_features.csv and keeps
+them up to date as reviews arrive.
+
+A full refit reproduces notebooks/modeling.ipynb: a 500-feature Tf-Idf over
+each shop's combined reviews followed by a 40-component NMF. The fitted
+vocabulary, idf weights and H matrix are saved, so new or updated shops can
+later be projected onto the existing latent features by solving only for
+their W rows with non-negative least squares. Refits are aligned to the
+previous model's components, or to the existing df_with_features.csv
+columns when there is no saved model yet, so the user-facing mapping_df
+keeps its meaning.
+
+Usage:
+    python nmf_training.py refit [--reviews data/data_not_starbucks.csv] [--pipeline]
+    python nmf_training.py update --reviews new_reviews.csv
+With --pipeline, refit tokenizes through text_pipeline's process pool and
+spills term counts to disk, for corpora too large to vectorize in memory.
+Both write data/df_with_features.csv (and, with --artifact, a model artifact
+that a running web app can swap in).
+'''
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment, nnls
+from sklearn.decomposition import NMF
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS, TfidfVectorizer
+
+from recommender_model import META_COLUMNS
+
+N_COMPONENTS = 40
+MAX_FEATURES = 500
+MIN_REVIEW_WORDS = 20
+STOPWORDS = list(ENGLISH_STOP_WORDS) + ['coffee', 'shop', 'coffeeshop', 'starbucks',
+                                        'wa', 'seattle', 'cafe', 'caffee']
+
+class LemmaTokenizer(object):
+    def __init__(self):
+        from nltk.stem import WordNetLemmatizer
+        self.wnl = WordNetLemmatizer()
+    def __call__(self, doc):
+        from nltk import word_tokenize
+        return [self.wnl.lemmatize(t) for t in word_tokenize(doc)]
+
+def prepare_reviews(reviews_df, excluded_df=None):
+    '''
+    Takes in review data in the format of data_not_starbucks.csv and outputs
+    the shops to model, with columns renamed to match df_with_features.
+
+    Parameters:
+    -----------
+    reviews_df: Pandas DataFrame - One row per shop with location.lat,
+    location.lng, name, final_address, shop_id, combined_reviews and
+    num_review_words columns
+    excluded_df: Pandas DataFrame - Optional rows of names.csv (row ids into
+    the filtered shops) to drop as not really coffee shops
+
+    Output:
+    -------
+    shops_df: Pandas DataFrame - lat, lng, name, address, shop_id and
+    combined_reviews for each shop with at least MIN_REVIEW_WORDS words
+    '''
+
+    shops_df = reviews_df[reviews_df['num_review_words'] >= MIN_REVIEW_WORDS].reset_index(drop=True)
+    shops_df = shops_df.rename(columns={'location.lat': 'lat', 'location.lng': 'lng',
+                                        'final_address': 'address'})
+    shops_df = shops_df[META_COLUMNS + ['combined_reviews']]
+    if excluded_df is not None:
+        shops_df = shops_df.drop(excluded_df['id'].values, axis=0)
+    return shops_df
+
+def excluded_shop_ids(reviews_df, excluded_df):
+    '''
+    Resolves names.csv rows, which are row ids into the shops prepared from
+    the full review data, to shop_ids, so the same shops can be dropped from
+    any other review file.
+
+    Parameters:
+    -----------
+    reviews_df: Pandas DataFrame - The full review data names.csv refers to
+    excluded_df: Pandas DataFrame - Rows of names.csv
+
+    Output:
+    -------
+    shop_ids: Set - shop_ids of the excluded shops
+    '''
+
+    shops_df = prepare_reviews(reviews_df)
+    return set(shops_df.loc[excluded_df['id'].values, 'shop_id'].tolist())
+
+def match_columns(previous, current):
+    '''
+    Pairs the rows of two matrices by cosine similarity with the Hungarian
+    algorithm.
+
+    Parameters:
+    -----------
+    previous: Numpy Array - Rows whose order to follow
+    current: Numpy Array - Rows to reorder, over the same columns
+
+    Output:
+    -------
+    order: Numpy Array - order[i] is the row of current that matches row i
+    of previous
+    similarity: Numpy Array - Cosine similarity of each matched pair
+    '''
+
+    current = current / np.maximum(np.linalg.norm(current, axis=1, keepdims=True), 1e-12)
+    previous = previous / np.maximum(np.linalg.norm(previous, axis=1, keepdims=True), 1e-12)
+    similarity = previous.dot(current.T)
+    previous_rows, order = linear_sum_assignment(-similarity)
+    return order, similarity[previous_rows, order]
+
+class FeatureModel():
+    '''
+    Fitted Tf-Idf vocabulary and NMF H matrix. Projects shops' review text
+    onto the latent features.
+    '''
+    def __init__(self, vocabulary, idf, H, tokenizer=None, fitted_at=None):
+        '''
+        Parameters:
+        -----------
+        vocabulary: List of strings - Tf-Idf terms, in column order
+        idf: Numpy Array - Inverse document frequency of each term
+        H: Numpy Array - (components x terms) NMF components
+        tokenizer: Callable - Splits a document into terms. Saved models
+        remember whether it was a LemmaTokenizer or a
+        text_pipeline.ReviewPreprocessor (Default: LemmaTokenizer)
+        fitted_at: String - When the model was fit
+
+        Output:
+        --------
+        None
+        '''
+
+        self.vocabulary = list(vocabulary)
+        self.H = np.asarray(H, dtype=float)
+        self.fitted_at = fitted_at or time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.vectorizer = self._make_vectorizer(tokenizer, vocabulary=self.vocabulary)
+        self.vectorizer.idf_ = np.asarray(idf, dtype=float)
+
+    @staticmethod
+    def _make_vectorizer(tokenizer, **kwargs):
+        return TfidfVectorizer(strip_accents='unicode',
+                               tokenizer=tokenizer or LemmaTokenizer(),
+                               token_pattern=None,
+                               stop_words=STOPWORDS,
+                               **kwargs)
+
+    @classmethod
+    def fit(cls, documents, n_components=N_COMPONENTS, max_features=MAX_FEATURES,
+            tokenizer=None, random_state=None):
+        '''
+        Fits the Tf-Idf and NMF models from scratch.
+
+        Parameters:
+        -----------
+        documents: List of strings - Combined reviews for each shop
+        n_components: Int - Number of latent features (Default: 40)
+        max_features: Int - Tf-Idf vocabulary size (Default: 500)
+        tokenizer: Callable - Splits a document into terms
+        random_state: Int - Seed for NMF initialization
+
+        Output:
+        -------
+        model: FeatureModel
+        W: Numpy Array - (shops x components) latent features of documents
+        '''
+
+        vectorizer = cls._make_vectorizer(tokenizer, max_features=max_features)
+        tfidf = vectorizer.fit_transform(documents)
+        return cls.fit_tfidf(tfidf, vectorizer.get_feature_names_out(), vectorizer.idf_,
+                             n_components, tokenizer, random_state)
+
+    @classmethod
+    def fit_tfidf(cls, tfidf, vocabulary, idf, n_components=N_COMPONENTS,
+                  tokenizer=None, random_state=None):
+        '''
+        Fits the NMF model on an existing Tf-Idf matrix, such as the output
+        of text_pipeline.build_tfidf.
+
+        Parameters:
+        -----------
+        tfidf: Scipy Sparse Matrix - (shops x terms) Tf-Idf values
+        vocabulary: List of strings - Terms in column order
+        idf: Numpy Array - Inverse document frequency of each term
+        n_components: Int - Number of latent features (Default: 40)
+        tokenizer: Callable - Splits a document into terms, used by project
+        random_state: Int - Seed for NMF initialization
+
+        Output:
+        -------
+        model: FeatureModel
+        W: Numpy Array - (shops x components) latent features
+        '''
+
+        nmf = NMF(n_components=n_components, init='nndsvda', max_iter=1000,
+                  random_state=random_state)
+        W = nmf.fit_transform(tfidf)
+        return cls(vocabulary, idf, nmf.components_, tokenizer), W
+
+    def project(self, documents):
+        '''
+        Solves for the latent features of new or updated shops against the
+        fixed H matrix, one non-negative least squares problem per shop.
+
+        Parameters:
+        -----------
+        documents: List of strings - Combined reviews for each shop
+
+        Output:
+        -------
+        W: Numpy Array - (shops x components) latent features
+        '''
+
+        tfidf = self.vectorizer.transform(documents)
+        H_T = self.H.T
+        W = np.zeros((tfidf.shape[0], self.H.shape[0]))
+        for i in range(tfidf.shape[0]):
+            W[i], _ = nnls(H_T, tfidf[i].toarray().ravel())
+        return W
+
+    def alignment(self, previous):
+        '''
+        Matches this model's components to a previous model's so refits keep
+        the meaning of each feature column. Components are compared by cosine
+        similarity over the terms both vocabularies share and paired with the
+        Hungarian algorithm.
+
+        Parameters:
+        -----------
+        previous: FeatureModel - The model whose component order to follow
+
+        Output:
+        -------
+        order: Numpy Array - order[i] is the component of this model that
+        matches the previous model's component i
+        similarity: Numpy Array - Cosine similarity of each matched pair
+        '''
+
+        previous_columns = {term: i for i, term in enumerate(previous.vocabulary)}
+        shared = [(i, previous_columns[term]) for i, term in enumerate(self.vocabulary)
+                  if term in previous_columns]
+        return match_columns(previous.H[:, [j for _, j in shared]],
+                             self.H[:, [i for i, _ in shared]])
+
+    def reorder(self, order):
+        '''
+        Permutes the components in place to the given order.
+        '''
+
+        self.H = self.H[order]
+
+    def save(self, path):
+        '''
+        Writes the vocabulary, idf weights and H matrix to a directory.
+        '''
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'H.npy'), self.H)
+        np.save(os.path.join(path, 'idf.npy'), self.vectorizer.idf_)
+        with open(os.path.join(path, 'model.json'), 'w') as f:
+            json.dump({'vocabulary': self.vocabulary, 'fitted_at': self.fitted_at,
+                       'n_components': self.H.shape[0],
+                       'tokenizer': type(self.vectorizer.tokenizer).__name__}, f, indent=2)
+
+    @classmethod
+    def load(cls, path, tokenizer=None):
+        '''
+        Reads a model written by save. Unless a tokenizer is given, new
+        documents are tokenized the way the model was fit.
+        '''
+
+        with open(os.path.join(path, 'model.json')) as f:
+            manifest = json.load(f)
+        tokenizer_name = manifest.get('tokenizer', 'LemmaTokenizer')
+        if tokenizer is None and tokenizer_name == 'ReviewPreprocessor':
+            from text_pipeline import ReviewPreprocessor
+            tokenizer = ReviewPreprocessor()
+        elif tokenizer is None and tokenizer_name != 'LemmaTokenizer':
+            raise ValueError('Model in {} was fit with a {}; pass it as the tokenizer'.format(
+                path, tokenizer_name))
+        return cls(manifest['vocabulary'], np.load(os.path.join(path, 'idf.npy')),
+                   np.load(os.path.join(path, 'H.npy')), tokenizer, manifest['fitted_at'])
+
+def features_df(shops_df, W):
+    '''
+    Combines shop metadata and latent features in the df_with_features
+    layout.
+    '''
+
+    columns = ['feature{}'.format(n) for n in range(W.shape[1])]
+    return pd.concat([shops_df[['lat', 'lng', 'name', 'address', 'shop_id']],
+                      pd.DataFrame(W, index=shops_df.index, columns=columns)], axis=1)
+
+def feature_alignment(W, shop_ids, previous_df):
+    '''
+    Matches newly fitted components to the latent feature columns of an
+    existing df_with_features, for a first refit that has no saved model to
+    align to. Columns are compared over the shops both have.
+
+    Parameters:
+    -----------
+    W: Numpy Array - (shops x components) new latent features
+    shop_ids: Array-like - shop_id of each row of W
+    previous_df: Pandas DataFrame - The existing df_with_features
+
+    Output:
+    -------
+    order, similarity: Numpy Arrays - See FeatureModel.alignment
+    '''
+
+    previous_W = previous_df.drop(META_COLUMNS, axis=1)
+    if previous_W.shape[1] != W.shape[1]:
+        raise ValueError('Existing features have {} columns, the new model {}'.format(
+            previous_W.shape[1], W.shape[1]))
+    positions = pd.Series(np.arange(len(W)), index=pd.Index(shop_ids))
+    shared = previous_df['shop_id'].isin(positions.index).to_numpy()
+    if not shared.any():
+        raise ValueError('Existing features share no shops with the new model')
+    rows = positions[previous_df['shop_id'][shared]].to_numpy()
+    return match_columns(previous_W.to_numpy(dtype=float)[shared].T, W[rows].T)
+
+def refit(shops_df, previous=None, tokenizer=None, random_state=None, previous_df=None,
+          tfidf_path=None, processes=None):
+    '''
+    Fits a new model over every shop, aligned to the previous model if given,
+    or else to the columns of the existing features if given.
+
+    Parameters:
+    -----------
+    shops_df: Pandas DataFrame - Output of prepare_reviews
+    previous: FeatureModel - Model whose feature order to keep
+    tokenizer: Callable - Splits a document into terms
+    random_state: Int - Seed for NMF initialization
+    previous_df: Pandas DataFrame - Existing df_with_features whose column
+    order to keep when there is no previous model
+    tfidf_path: String - If given, build the Tf-Idf matrix with
+    text_pipeline.build_tfidf in this directory instead of in memory. The
+    tokenizer must then be a ReviewPreprocessor (Default: ReviewPreprocessor)
+    processes: Int - text_pipeline worker processes (Default: one per CPU)
+
+    Output:
+    -------
+    model: FeatureModel
+    df_with_features: Pandas DataFrame
+    similarity: Numpy Array or None - Match quality of each aligned feature
+    '''
+
+    documents = shops_df['combined_reviews'].tolist()
+    if tfidf_path is None:
+        model, W = FeatureModel.fit(documents, tokenizer=tokenizer, random_state=random_state)
+    else:
+        from text_pipeline import ReviewPreprocessor, build_tfidf
+        tokenizer = tokenizer or ReviewPreprocessor()
+        tfidf, vocabulary, idf, _ = build_tfidf(
+            zip(shops_df['shop_id'], ([document] for document in documents)), tfidf_path,
+            processes=processes, preprocessor=tokenizer)
+        model, W = FeatureModel.fit_tfidf(tfidf, vocabulary, idf, tokenizer=tokenizer,
+                                          random_state=random_state)
+    similarity = None
+    if previous is not None:
+        order, similarity = model.alignment(previous)
+    elif previous_df is not None:
+        order, similarity = feature_alignment(W, shops_df['shop_id'], previous_df)
+    if similarity is not None:
+        model.reorder(order)
+        W = W[:, order]
+    return model, features_df(shops_df, W), similarity
+
+def update(model, df_with_features, shops_df):
+    '''
+    Projects new or updated shops onto the existing features without
+    refitting. Shops whose shop_id is already present are replaced; the rest
+    are appended.
+
+    Parameters:
+    -----------
+    model: FeatureModel - The fitted model
+    df_with_features: Pandas DataFrame - Current recommender dataframe
+    shops_df: Pandas DataFrame - Output of prepare_reviews for the changed
+    shops
+
+    Output:
+    -------
+    df_with_features: Pandas DataFrame - Updated copy
+    '''
+
+    updated = features_df(shops_df, model.project(shops_df['combined_reviews'].tolist()))
+    existing = df_with_features.reset_index().set_index('shop_id')
+    index_name = existing.columns[0]
+    replaced = updated['shop_id'].isin(existing.index)
+    for _, row in updated[replaced].iterrows():
+        existing.loc[row['shop_id'], updated.columns.drop('shop_id')] = row.drop('shop_id').values
+    appended = updated[~replaced].reset_index(drop=True)
+    appended.index = np.arange(len(appended)) + existing[index_name].max() + 1
+    result = existing.reset_index().set_index(index_name)[df_with_features.columns]
+    result.index.name = df_with_features.index.name
+    return pd.concat([result, appended[df_with_features.columns]])
+
+def publish(df_with_features, mapping_df, csv_path=None, artifact_path=None, model=None,
+            registry_path=None):
+    '''
+    Makes new features available: writes the CSV and/or a model artifact,
+    publishes a registry version for running web apps to pick up, and
+    hot-swaps them into a RecommenderModel in this process if one is given.
+    '''
+
+    if csv_path:
+        df_with_features.to_csv(csv_path)
+    if artifact_path:
+        from model_artifact import export_artifact
+        export_artifact(df_with_features, mapping_df, artifact_path)
+    if registry_path:
+        from model_registry import publish_version
+        print('Published model version {}'.format(
+            publish_version(df_with_features, mapping_df, registry_path)))
+    if model is not None:
+        model.refresh(df_with_features, mapping_df)
+
+def main():
+    parser = argparse.ArgumentParser(description='Refit or incrementally update the NMF features')
+    parser.add_argument('mode', choices=['refit', 'update'])
+    parser.add_argument('--reviews', default='data/data_not_starbucks.csv')
+    parser.add_argument('--excluded', default='data/names.csv',
+                        help='names.csv rows to drop')
+    parser.add_argument('--base-reviews', default='data/data_not_starbucks.csv',
+                        help='Review data the names.csv row ids refer to, used on update')
+    parser.add_argument('--model-dir', default='data/nmf_model')
+    parser.add_argument('--features', default='data/df_with_features.csv')
+    parser.add_argument('--mapping', default='data/mapping_df.csv')
+    parser.add_argument('--artifact', help='Also export a model artifact here')
+    parser.add_argument('--registry', help='Also publish a version to this model registry, '
+                        'e.g. data/model_registry')
+    parser.add_argument('--random-state', type=int, default=0)
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Refit with the streaming text_pipeline Tf-Idf')
+    parser.add_argument('--tfidf-dir', default='data/tfidf',
+                        help='Where --pipeline writes the Tf-Idf matrix')
+    parser.add_argument('--processes', type=int,
+                        help='text_pipeline worker processes (Default: one per CPU)')
+    parser.add_argument('--force', action='store_true',
+                        help='Refit even when there is nothing to align the new features to, '
+                        'which invalidates mapping_df')
+    args = parser.parse_args()
+
+    reviews_df = pd.read_csv(args.reviews, index_col=0)
+    mapping_df = pd.read_csv(args.mapping, index_col=0)
+    has_model = os.path.exists(os.path.join(args.model_dir, 'model.json'))
+    excluded_df = None
+    if args.excluded and os.path.exists(args.excluded):
+        excluded_df = pd.read_csv(args.excluded, skipinitialspace=True)
+
+    if args.mode == 'refit':
+        shops_df = prepare_reviews(reviews_df, excluded_df)
+        previous = FeatureModel.load(args.model_dir) if has_model else None
+        previous_df = None
+        if previous is None and os.path.exists(args.features):
+            previous_df = pd.read_csv(args.features, index_col=0)
+        if previous is None and previous_df is None and not args.force:
+            parser.error('Nothing to align the new features to, so mapping_df would no longer '
+                         'match them; pass --force to refit anyway')
+        model, df_with_features, similarity = refit(shops_df, previous,
+                                                    random_state=args.random_state,
+                                                    previous_df=previous_df,
+                                                    tfidf_path=args.tfidf_dir if args.pipeline
+                                                    else None,
+                                                    processes=args.processes)
+        if similarity is not None:
+            print('Aligned to {} features, mean similarity {:.2f}, lowest {:.2f} (feature{})'
+                  .format('previous' if previous is not None else 'existing',
+                          similarity.mean(), similarity.min(), similarity.argmin()))
+            print('Features below 0.5 similarity may need their mapping_df rows reviewed')
+        else:
+            print('No previous features to align to; rebuild mapping_df for the new features')
+    else:
+        if not has_model:
+            parser.error('No fitted model in {}; run refit first'.format(args.model_dir))
+        model = FeatureModel.load(args.model_dir)
+        shops_df = prepare_reviews(reviews_df)
+        if excluded_df is not None:
+            excluded = excluded_shop_ids(pd.read_csv(args.base_reviews, index_col=0), excluded_df)
+            shops_df = shops_df[~shops_df['shop_id'].isin(excluded)]
+        df_with_features = update(model, pd.read_csv(args.features, index_col=0), shops_df)
+        print('Projected {} shops onto the existing features'.format(len(shops_df)))
+
+    model.save(args.model_dir)
+    publish(df_with_features, mapping_df, args.features, args.artifact,
+            registry_path=args.registry)
+    print('Wrote {} shops to {}'.format(len(df_with_features), args.features))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import OrderedDict
+
+class RecommendationCache():
+    '''
+    Bounded LRU cache with a time-to-live in front of
+    RecommenderModel.recommend. Requests are keyed on their normalized
+    feature weights, n, r, the neighborhood options and their location, so
+    a repeated request is a dictionary lookup returning the same ranked
+    Recommendations the model gave the first time. Entries are dropped when
+    the model's data is refreshed or shops are closed or reopened.
+
+    Locations are exact by default. With location_digits they are rounded
+    to that many decimal places and the model is asked about the rounded
+    point, so nearby users share entries at the cost of distances and the
+    range cutoff being measured from up to half a step away (4 digits:
+    about 6 meters north-south, 4 meters east-west in Seattle).
+    '''
+    def __init__(self, model, maxsize=4096, ttl=600, location_digits=None):
+        '''
+        Parameters:
+        -----------
+        model: RecommenderModel - The model to cache recommendations from
+        maxsize: Int - Maximum number of cached results (Default: 4096)
+        ttl: Float - Seconds a cached result stays valid, or None for no
+        expiry (Default: 600)
+        location_digits: Int - Decimal places locations are rounded to, or
+        None to key on exact coordinates (Default: None)
+
+        Output:
+        --------
+        None
+        '''
+
+        self.model = model
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.location_digits = location_digits
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._data = model.data
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        '''
+        Returns the cache counters as a dictionary.
+        '''
+
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
+
+    def clear(self):
+        '''
+        Drops every cached result.
+        '''
+
+        with self._lock:
+            self._entries.clear()
+            self._data = self.model.data
+
+    def make_key(self, chosen_features, lat, lng, r, n, distance_weight=0.0,
+                 same_neighborhood=False, avoid_water=False):
+        '''
+        Builds the cache key for a request. Weights are normalized by their
+        absolute sum, as RecommenderModel.compile_plan does, so requests
+        that only differ in scale share an entry.
+
+        Parameters:
+        -----------
+        chosen_features: List of tuples (float, string) - The importance of a
+        specific feature for a user and the name of that feature
+        lat, lng: Floats - User's latitude and longitude
+        r: Float - Max distance in miles
+        n: Int - Number of recommendations
+        distance_weight: Float - Importance of being close to the user
+        same_neighborhood, avoid_water: Bools - Neighborhood filters
+
+        Output:
+        -------
+        key: Tuple - Hashable cache key
+        lat, lng: Floats - The location to ask the model about
+        '''
+
+        normalizing_weight = (sum([abs(float(item[0])) for item in chosen_features])
+                              + abs(float(distance_weight)))
+        if normalizing_weight == 0:
+            raise ValueError('At least one weight must be nonzero')
+        weights = {}
+        for weight, name in chosen_features:
+            weights[name] = weights.get(name, 0.0) + float(weight) / normalizing_weight
+        features = tuple(sorted((name, round(weight, 9))
+                                for name, weight in weights.items()))
+        distance_weight = round(float(distance_weight) / normalizing_weight, 9)
+        lat, lng = float(lat), float(lng)
+        if self.location_digits is not None:
+            lat, lng = round(lat, self.location_digits), round(lng, self.location_digits)
+        return ((features, distance_weight, lat, lng, float(r), int(n),
+                 bool(same_neighborhood), bool(avoid_water)), lat, lng)
+
+    def recommend(self, f1, f2, f3, lat, lng, r=20, n=3):
+        '''
+        Same interface as RecommenderModel.recommend, answered from the cache
+        when possible.
+        '''
+
+        return self.recommend_features([f1, f2, f3], lat, lng, r, n)
+
+    def recommend_features(self, chosen_features, lat, lng, r=20, n=3,
+                           distance_weight=0.0, same_neighborhood=False,
+                           avoid_water=False):
+        '''
+        Same interface as RecommenderModel.recommend_features, answered from
+        the cache when possible. Cached Recommendations are shared between
+        requests, so their arrays are read-only.
+        '''
+
+        key, lat, lng = self.make_key(chosen_features, lat, lng, r, n, distance_weight,
+                                      same_neighborhood, avoid_water)
+        now = time.monotonic()
+        with self._lock:
+            #The model was refreshed, so every cached entry is stale
+            if self.model.data is not self._data:
+                self._entries.clear()
+                self._data = self.model.data
+            data = self._data
+            version = data.spatial_index.version
+            entry = self._entries.get(key)
+            if entry is not None:
+                #Shops closed or reopened since the entry was filled
+                if entry[1] != version:
+                    del self._entries[key]
+                    entry = None
+                elif self.ttl is None or now - entry[0] < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+                else:
+                    del self._entries[key]
+                    self.expirations += 1
+                    entry = None
+            self.misses += 1
+
+        recs = self.model.recommend_features(chosen_features, lat, lng, r, n, distance_weight,
+                                             same_neighborhood, avoid_water)
+        for values in list(recs.shops.values()) + [recs.distance_from_location,
+                                                   recs.combined_weights]:
+            values.flags.writeable = False
+        with self._lock:
+            #Don't cache results from data replaced in the meantime
+            if data is self._data and self.model.data is data:
+                self._entries[key] = (now, version, recs)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return recs
@@ -0,0 +1,281 @@
+'''
+Minimal reader for the ESRI shapefiles in data/Neighborhoods and
+data/Shorelines, so polygons can be used without GDAL or pyshp. Only the
+parts of the format those files use are supported: polygon (and polyline)
+geometry in the .shp file and the attribute table in the .dbf file.
+
+Coordinates are kept in the file's order, which for the WGS84 copies is
+(longitude, latitude).
+'''
+import os
+import struct
+
+import numpy as np
+
+NULL_SHAPE = 0
+POLYLINE = 3
+POLYGON = 5
+
+NEIGHBORHOODS_PATH = os.path.join('data', 'Neighborhoods', 'WGS84', 'Neighborhoods')
+SHORELINES_PATH = os.path.join('data', 'Shorelines', 'WGS84', 'Shorelines')
+# S_HOOD given to the water and unincorporated areas in the neighborhood file
+NO_NEIGHBORHOOD = 'OOO'
+
+def read_dbf(path):
+    '''
+    Reads a dBase III attribute table.
+
+    Parameters:
+    -----------
+    path: String - Path to the .dbf file
+
+    Output:
+    -------
+    records: List of dictionaries - One per shape, mapping field names to
+    strings (C fields), numbers (N and F fields) or None for blank numbers
+    '''
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    n_records, header_length, record_length = struct.unpack('<IHH', data[4:12])
+    fields = []
+    for start in range(32, header_length - 1, 32):
+        descriptor = data[start:start + 32]
+        name = descriptor[:11].split(b'\0')[0].decode('ascii')
+        fields.append((name, chr(descriptor[11]), descriptor[16], descriptor[17]))
+
+    records = []
+    for i in range(n_records):
+        #Each record starts with a deletion flag byte
+        offset = header_length + i * record_length + 1
+        record = {}
+        for name, kind, length, decimals in fields:
+            raw = data[offset:offset + length].decode('latin-1').strip()
+            offset += length
+            if kind in 'NF':
+                if not raw:
+                    record[name] = None
+                elif kind == 'N' and decimals == 0:
+                    record[name] = int(raw)
+                else:
+                    record[name] = float(raw)
+            else:
+                record[name] = raw
+        records.append(record)
+    return records
+
+def read_shp(path):
+    '''
+    Reads polygon or polyline geometry.
+
+    Parameters:
+    -----------
+    path: String - Path to the .shp file
+
+    Output:
+    -------
+    shapes: List - One list of parts per shape, each part an (n x 2) Numpy
+    Array of (x, y) points. Null shapes have no parts.
+    '''
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    file_length = struct.unpack('>i', data[24:28])[0] * 2
+    shapes = []
+    offset = 100
+    while offset < file_length:
+        content_length = struct.unpack('>i', data[offset + 4:offset + 8])[0] * 2
+        content = offset + 8
+        shape_type = struct.unpack('<i', data[content:content + 4])[0]
+        if shape_type == NULL_SHAPE:
+            shapes.append([])
+        elif shape_type in (POLYGON, POLYLINE):
+            n_parts, n_points = struct.unpack('<ii', data[content + 36:content + 44])
+            starts = np.frombuffer(data, '<i4', n_parts, content + 44)
+            points = np.frombuffer(data, '<f8', 2 * n_points,
+                                   content + 44 + 4 * n_parts).reshape(n_points, 2)
+            ends = np.append(starts[1:], n_points)
+            shapes.append([points[start:end].copy() for start, end in zip(starts, ends)])
+        else:
+            raise ValueError('Unsupported shape type {} in {}'.format(shape_type, path))
+        offset = content + content_length
+    return shapes
+
+def read_shapefile(path):
+    '''
+    Takes in a shapefile path without extension and outputs a list of
+    (record, parts) pairs from its .dbf and .shp files.
+    '''
+
+    return list(zip(read_dbf(path + '.dbf'), read_shp(path + '.shp')))
+
+def _points_in_ring(x, y, ring):
+    #Even-odd ray casting: count the ring edges crossed by a ray heading +x
+    inside = np.zeros(len(x), dtype=bool)
+    x1, y1 = ring[:-1, 0], ring[:-1, 1]
+    x2, y2 = ring[1:, 0], ring[1:, 1]
+    for ax, ay, bx, by in zip(x1, y1, x2, y2):
+        crosses = (ay > y) != (by > y)
+        if not crosses.any():
+            continue
+        at_x = ax + (y - ay) * (bx - ax) / np.where(by != ay, by - ay, 1)
+        inside ^= crosses & (x < at_x)
+    return inside
+
+class Polygon():
+    '''
+    Polygon made of one or more rings. Holes are rings nested inside another
+    ring, so the even-odd rule across all rings handles them.
+    '''
+    def __init__(self, parts):
+        '''
+        Parameters:
+        -----------
+        parts: List of Numpy Arrays - Closed (n x 2) rings of (x, y) points
+
+        Output:
+        --------
+        None
+        '''
+
+        self.parts = [np.asarray(part, dtype=float) for part in parts]
+        points = np.concatenate(self.parts) if self.parts else np.zeros((0, 2))
+        self.bbox = (tuple(points.min(axis=0)) + tuple(points.max(axis=0))
+                     if len(points) else (np.inf, np.inf, -np.inf, -np.inf))
+
+    def area(self):
+        '''
+        Returns the polygon's area in squared coordinate units (holes
+        subtracted), using the shoelace formula.
+        '''
+
+        #Outer rings and holes wind in opposite directions, so signed areas
+        #of holes cancel out the area they cover
+        return abs(sum(0.5 * np.dot(part[:-1, 0], part[1:, 1]) -
+                       0.5 * np.dot(part[1:, 0], part[:-1, 1]) for part in self.parts))
+
+    def contains(self, x, y):
+        '''
+        Tests which points fall inside the polygon.
+
+        Parameters:
+        -----------
+        x: Numpy Array or Float - Point x coordinates (longitude)
+        y: Numpy Array or Float - Point y coordinates (latitude)
+
+        Output:
+        -------
+        inside: Numpy Array of bools, or a bool for scalar input
+        '''
+
+        scalar = np.ndim(x) == 0
+        x, y = np.atleast_1d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(y, dtype=float))
+        west, south, east, north = self.bbox
+        inside = np.zeros(len(x), dtype=bool)
+        candidates = np.flatnonzero((x >= west) & (x <= east) & (y >= south) & (y <= north))
+        if len(candidates):
+            hits = np.zeros(len(candidates), dtype=bool)
+            for part in self.parts:
+                hits ^= _points_in_ring(x[candidates], y[candidates], part)
+            inside[candidates] = hits
+        return bool(inside[0]) if scalar else inside
+
+def rasterize(polygon, west, south, cell_size, shape):
+    '''
+    Marks the cells of a regular grid whose centers fall inside a polygon,
+    one scanline per grid row, so the cost grows with the polygon's
+    perimeter rather than its area.
+
+    Parameters:
+    -----------
+    polygon: Polygon
+    west, south: Floats - x and y of the grid's lower left corner
+    cell_size: Float - Width and height of a cell
+    shape: Tuple (rows, columns) - Grid size; row 0 is the southernmost
+
+    Output:
+    -------
+    inside: Numpy Array - (rows x columns) boolean mask
+    '''
+
+    n_rows, n_cols = shape
+    inside = np.zeros(shape, dtype=bool)
+    xs, rows = [], []
+    for part in polygon.parts:
+        ax, ay, bx, by = part[:-1, 0], part[:-1, 1], part[1:, 0], part[1:, 1]
+        #An edge crosses the rows whose center y is in [min y, max y)
+        first = np.ceil((np.minimum(ay, by) - south) / cell_size - 0.5).astype(int)
+        last = np.ceil((np.maximum(ay, by) - south) / cell_size - 0.5).astype(int)
+        first, last = np.clip(first, 0, n_rows), np.clip(last, 0, n_rows)
+        spans = last - first
+        edges = np.repeat(np.arange(len(ax)), spans)
+        if not len(edges):
+            continue
+        edge_rows = first[edges] + np.arange(len(edges)) - np.repeat(np.cumsum(spans) - spans, spans)
+        y = south + (edge_rows + 0.5) * cell_size
+        ax_, ay_, bx_, by_ = ax[edges], ay[edges], bx[edges], by[edges]
+        xs.append(ax_ + (y - ay_) * (bx_ - ax_) / (by_ - ay_))
+        rows.append(edge_rows)
+    if not xs:
+        return inside
+    xs, rows = np.concatenate(xs), np.concatenate(rows)
+    #Even-odd rule: a cell is inside if an odd number of crossings lie east of
+    #its center, i.e. it is among the first k columns of an odd number of them
+    first_outside = np.clip(np.ceil((xs - west) / cell_size - 0.5).astype(int), 0, n_cols)
+    crossings = np.zeros((n_rows, n_cols + 1), dtype=np.int32)
+    np.add.at(crossings, (rows, first_outside), 1)
+    east_of = np.cumsum(crossings[:, ::-1], axis=1)[:, ::-1]
+    inside[:] = (east_of[:, 1:] % 2).astype(bool)
+    return inside
+
+def load_neighborhoods(path=NEIGHBORHOODS_PATH):
+    '''
+    Loads Seattle's neighborhood polygons, leaving out the water and
+    unincorporated areas.
+
+    Parameters:
+    -----------
+    path: String - Neighborhood shapefile path without extension
+
+    Output:
+    -------
+    neighborhoods: List of (name, district, Polygon) tuples, where district
+    is the broader area (L_HOOD) or '' if there is none
+    '''
+
+    return [(record['S_HOOD'], record['L_HOOD'], Polygon(parts))
+            for record, parts in read_shapefile(path)
+            if parts and record['S_HOOD'] != NO_NEIGHBORHOOD]
+
+def sample_points(polygons, n, rng):
+    '''
+    Draws points uniformly over the area covered by a list of polygons, by
+    rejection sampling from their combined bounding box.
+
+    Parameters:
+    -----------
+    polygons: List of Polygons
+    n: Int - Number of points
+    rng: Numpy Generator
+
+    Output:
+    -------
+    points: Numpy Array - (n x 2) array of (x, y) points
+    '''
+
+    west = min(p.bbox[0] for p in polygons)
+    south = min(p.bbox[1] for p in polygons)
+    east = max(p.bbox[2] for p in polygons)
+    north = max(p.bbox[3] for p in polygons)
+    found = []
+    remaining = n
+    while remaining > 0:
+        batch = max(2 * remaining, 256)
+        x, y = rng.uniform(west, east, batch), rng.uniform(south, north, batch)
+        inside = np.zeros(batch, dtype=bool)
+        for polygon in polygons:
+            inside |= polygon.contains(x, y)
+        points = np.column_stack((x, y))[inside][:remaining]
+        found.append(points)
+        remaining -= len(points)
+    return np.concatenate(found) if found else np.zeros((0, 2))
@@ -0,0 +1,187 @@
+'''
+Approximate nearest neighbour search over shops' NMF latent features, used
+for "shops like this one" recommendations. Similarity is the cosine between
+W rows, computed as a dot product of L2-normalized vectors.
+'''
+import numpy as np
+
+# Below this many rows a brute-force scan beats probing an IVFIndex (see
+# benchmarks/bench_similarity_index.py), so no index is built
+MIN_IVF_ROWS = 4000
+
+def normalize_rows(vectors):
+    '''
+    Takes in a matrix and outputs a float copy with each row scaled to unit
+    length. All-zero rows stay zero.
+    '''
+
+    vectors = np.array(vectors, dtype=float)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.where(norms > 0, norms, 1)
+    return vectors
+
+def _top_k(similarities, positions, k):
+    #Highest similarity first, ties broken by ascending position
+    k = max(0, min(int(k), len(similarities)))
+    if k == 0:
+        return positions[:0], similarities[:0]
+    if k < len(similarities):
+        #Keep everything tied with the kth best so ties break on position
+        threshold = np.partition(similarities, len(similarities) - k)[len(similarities) - k]
+        keep = similarities >= threshold
+        similarities, positions = similarities[keep], positions[keep]
+    order = np.lexsort((positions, -similarities))[:k]
+    return positions[order], similarities[order]
+
+def brute_force_similar(vectors, query, k, candidates=None):
+    '''
+    Exact reference search: scores every candidate against the query.
+
+    Parameters:
+    -----------
+    vectors: Numpy Array - (shops x latent features) L2-normalized rows
+    query: Numpy Array - L2-normalized query vector
+    k: Int - Number of neighbours to return
+    candidates: Numpy Array - Optional row positions to restrict the search to
+
+    Output:
+    -------
+    positions: Numpy Array - Row positions of the k most similar shops
+    similarities: Numpy Array - Cosine similarity of each, descending
+    '''
+
+    if candidates is None:
+        return _top_k(vectors.dot(query), np.arange(len(vectors)), k)
+    candidates = np.asarray(candidates, dtype=int)
+    return _top_k(vectors[candidates].dot(query), candidates, k)
+
+def spherical_kmeans(vectors, n_clusters, n_iter=25, seed=0):
+    '''
+    Clusters unit vectors by cosine similarity.
+
+    Parameters:
+    -----------
+    vectors: Numpy Array - (shops x latent features) L2-normalized rows
+    n_clusters: Int - Number of clusters
+    n_iter: Int - Maximum number of assignment/update rounds
+    seed: Int - Seed for choosing the initial centroids
+
+    Output:
+    -------
+    centroids: Numpy Array - (clusters x latent features) unit centroids
+    assignments: Numpy Array - Cluster of each row
+    '''
+
+    rng = np.random.default_rng(seed)
+    #k-means++ style seeding: favour rows far from the centroids chosen so far
+    centroids = [vectors[rng.integers(len(vectors))]]
+    closest = 1 - vectors.dot(centroids[0])
+    for _ in range(1, n_clusters):
+        weights = np.clip(closest, 0, None)
+        total = weights.sum()
+        choice = rng.choice(len(vectors), p=weights / total) if total > 0 else rng.integers(len(vectors))
+        centroids.append(vectors[choice])
+        closest = np.minimum(closest, 1 - vectors.dot(vectors[choice]))
+    centroids = np.array(centroids)
+
+    assignments = None
+    for _ in range(n_iter):
+        similarities = vectors.dot(centroids.T)
+        new_assignments = similarities.argmax(axis=1)
+        if assignments is not None and np.array_equal(new_assignments, assignments):
+            break
+        assignments = new_assignments
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = np.bincount(assignments, minlength=n_clusters) == 0
+        #Re-seed empty clusters on the worst fitting rows
+        sums[empty] = vectors[np.argsort(similarities.max(axis=1))[:empty.sum()]]
+        centroids = normalize_rows(sums)
+    return centroids, assignments
+
+class IVFIndex():
+    '''
+    Inverted file index: rows are clustered once, and a query only scores the
+    rows in the n_probe clusters whose centroids are most similar to it.
+    '''
+    def __init__(self, vectors, n_lists=None, n_probe=None, seed=0):
+        '''
+        Parameters:
+        -----------
+        vectors: Numpy Array - (shops x latent features) L2-normalized rows
+        n_lists: Int - Number of clusters (Default: about sqrt(shops))
+        n_probe: Int - Clusters scanned per query (Default: about
+        sqrt(n_lists), so a query scores about shops ** 0.75 rows)
+        seed: Int - Seed for clustering
+
+        Output:
+        --------
+        None
+        '''
+
+        n_rows = len(vectors)
+        if n_lists is None:
+            n_lists = int(np.sqrt(n_rows))
+        n_lists = max(1, min(n_lists, n_rows))
+        self.n_probe = min(n_probe or int(np.ceil(np.sqrt(n_lists))), n_lists)
+        self.centroids, assignments = spherical_kmeans(vectors, n_lists, seed=seed)
+        #Rows stored contiguously by cluster so each probe is one slice
+        self.positions = np.argsort(assignments, kind='stable')
+        self.vectors = np.ascontiguousarray(vectors[self.positions])
+        self.offsets = np.searchsorted(assignments[self.positions], np.arange(n_lists + 1))
+        #Cluster and contiguous row of each position, so candidate lists are
+        #grouped by cluster without scanning the clusters
+        self.assignments = assignments
+        self.rows = np.empty(n_rows, dtype=int)
+        self.rows[self.positions] = np.arange(n_rows)
+        self.vectors_by_position = vectors
+        self.n_rows = n_rows
+        for array in (self.centroids, self.positions, self.vectors, self.offsets,
+                      self.assignments, self.rows):
+            array.flags.writeable = False
+
+    def __len__(self):
+        return self.n_rows
+
+    def search(self, query, k, candidates=None, n_probe=None):
+        '''
+        Finds approximately the k rows most similar to query. Clusters are
+        scanned in order of centroid similarity until n_probe have been
+        scanned and at least k rows found, so a restrictive candidate filter
+        widens the search instead of returning too few rows.
+
+        Parameters:
+        -----------
+        query: Numpy Array - L2-normalized query vector
+        k: Int - Number of neighbours to return
+        candidates: Numpy Array - Optional distinct row positions to restrict
+        the search to
+        n_probe: Int - Clusters to scan (Default: the index's n_probe)
+
+        Output:
+        -------
+        positions: Numpy Array - Row positions of the most similar rows
+        similarities: Numpy Array - Cosine similarity of each, descending
+        '''
+
+        n_probe = n_probe or self.n_probe
+        order = np.argsort(-self.centroids.dot(query), kind='stable')
+        if candidates is not None:
+            #Scoring a short candidate list directly beats probing for it
+            if len(candidates) * len(self.centroids) <= self.n_rows * n_probe:
+                return brute_force_similar(self.vectors_by_position, query, k, candidates)
+            #Work in proportion to the candidates, not the whole index
+            positions = np.asarray(candidates, dtype=int)
+            clusters = self.assignments[positions]
+            sizes = np.bincount(clusters, minlength=len(self.centroids))[order]
+            n_scan = max(n_probe, np.searchsorted(np.cumsum(sizes), k) + 1)
+            scanned = np.zeros(len(self.centroids), dtype=bool)
+            scanned[order[:n_scan]] = True
+            positions = positions[scanned[clusters]]
+            return _top_k(self.vectors[self.rows[positions]].dot(query), positions, k)
+        sizes = self.offsets[order + 1] - self.offsets[order]
+        #Probe at least n_probe clusters, and more until k rows are covered
+        n_scan = max(n_probe, np.searchsorted(np.cumsum(sizes), k) + 1)
+        rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1])
+                               for c in order[:n_scan]])
+        return _top_k(self.vectors[rows].dot(query), self.positions[rows], k)
@@ -0,0 +1,378 @@
+'''
+Streams review text into a sparse Tf-Idf matrix without holding the corpus in
+memory.
+
+Each shop's reviews are cleaned, tokenized, stripped of stopwords and
+lemmatized in a pool of worker processes. Every worker memoizes its lemmas, so
+each distinct word goes through WordNet once. The parent process only keeps
+running term statistics. It spills each shop's raw term counts to
+chunk files on disk, and once the corpus is done it selects the max_features
+most frequent terms, then streams the chunks back to build the Tf-Idf
+matrix. The output matches what TfidfVectorizer(max_features=500) would
+produce over the same tokens, so nmf_training.FeatureModel.fit_tfidf can fit
+NMF on it directly.
+
+Usage:
+    python text_pipeline.py --reviews data/seattle_coffeeshops_combine_reviews.csv --out data/tfidf
+'''
+import argparse
+import ast
+import glob
+import json
+import os
+import shutil
+import string
+import tempfile
+from collections import Counter
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import strip_accents_unicode
+
+from nmf_training import MAX_FEATURES, STOPWORDS
+
+REVIEW_COLUMNS = ['tips', 'google_reviews', 'yelp_reviews']
+TRANSLATOR = str.maketrans('', '', string.punctuation)
+# Written last by TfidfWriter.finalize; marks a directory as its output
+VOCABULARY_NAME = 'vocabulary.json'
+
+def clean_review(text):
+    '''
+    Takes in a review and outputs it lowercased with punctuation and line
+    breaks removed, as in data_generation_notebook.
+    '''
+    return text.translate(TRANSLATOR).lower().replace('\n', ' ')
+
+def _word_tokenize(text):
+    from nltk import word_tokenize
+    return word_tokenize(text)
+
+class ReviewPreprocessor():
+    '''
+    Clean -> tokenize -> stopwords -> memoized lemmatize for one document.
+    Cleaning is clean_review, so text is normalized the same way whether it
+    comes through build_tfidf or FeatureModel.project. Stopwords
+    are dropped before lemmatizing, to save lookups, and again afterwards,
+    because WordNet turns words like "was" into "wa". Instances can also be
+    passed as the tokenizer of nmf_training.FeatureModel, so shops projected
+    later are tokenized the same way.
+    '''
+    def __init__(self, stopwords=STOPWORDS, tokenizer=None, cache_size=2**18):
+        '''
+        Parameters:
+        -----------
+        stopwords: List of strings - Terms to drop
+        tokenizer: Callable - Splits a document into tokens
+        (Default: nltk word_tokenize)
+        cache_size: Int - Number of lemmas to memoize
+
+        Output:
+        --------
+        None
+        '''
+
+        self.stopwords = frozenset(stopwords)
+        self.tokenizer = tokenizer or _word_tokenize
+        self.cache_size = cache_size
+        self.lemmatize = None
+
+    def _lemmatizer(self):
+        #Built on first use so instances stay cheap to pickle
+        from nltk.stem import WordNetLemmatizer
+        return lru_cache(maxsize=self.cache_size)(WordNetLemmatizer().lemmatize)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['lemmatize'] = None
+        return state
+
+    def counts(self, text):
+        '''
+        Takes in a document and outputs a Counter of its lemmatized terms.
+        '''
+
+        if self.lemmatize is None:
+            self.lemmatize = self._lemmatizer()
+        tokens = Counter(t for t in self.tokenizer(strip_accents_unicode(clean_review(text)))
+                         if t not in self.stopwords)
+        terms = Counter()
+        for token, count in tokens.items():
+            lemma = self.lemmatize(token)
+            if lemma not in self.stopwords:
+                terms[lemma] += count
+        return terms
+
+    def __call__(self, text):
+        return list(self.counts(text).elements())
+
+def iter_review_csv(path, id_column=None, review_columns=REVIEW_COLUMNS, chunksize=200):
+    '''
+    Takes in a CSV with one row per shop and review list columns (as in
+    seattle_coffeeshops_combine_reviews.csv) and yields (shop id, list of
+    reviews) one shop at a time, reading chunksize rows at once.
+
+    Parameters:
+    -----------
+    path: String - CSV file path
+    id_column: String - Column holding the shop id (Default: the CSV index)
+    review_columns: List of strings - Columns holding lists of reviews
+    chunksize: Int - Rows read at a time
+
+    Output:
+    -------
+    Generator of (shop id, list of strings)
+    '''
+
+    for chunk in pd.read_csv(path, index_col=0, chunksize=chunksize):
+        ids = chunk.index if id_column is None else chunk[id_column]
+        for shop_id, (_, row) in zip(ids, chunk[review_columns].iterrows()):
+            reviews = []
+            for value in row:
+                if isinstance(value, str):
+                    try:
+                        parsed = ast.literal_eval(value)
+                    except (ValueError, SyntaxError):
+                        parsed = [value]
+                    reviews.extend(parsed if isinstance(parsed, list) else [value])
+            yield shop_id, reviews
+
+_worker_preprocessor = None
+
+def _init_worker(preprocessor):
+    global _worker_preprocessor
+    _worker_preprocessor = preprocessor
+
+def _count_shop(item):
+    shop_id, reviews = item
+    counts = Counter()
+    for review in reviews:
+        counts.update(_worker_preprocessor.counts(review))
+    return shop_id, counts
+
+class TfidfWriter():
+    '''
+    Collects per-shop term counts into chunk files on disk while keeping
+    only vocabulary-sized statistics in memory. finalize turns them into a
+    Tf-Idf matrix with TfidfVectorizer's defaults (smooth idf, l2 rows).
+    Everything is written to a directory next to path, which finalize
+    renames into place, so an interrupted build leaves path untouched.
+    '''
+    def __init__(self, path, chunk_rows=2000):
+        '''
+        Parameters:
+        -----------
+        path: String - Output directory to create, or an empty directory or
+        earlier output to replace. Any other existing path raises ValueError.
+        chunk_rows: Int - Shops per chunk file
+
+        Output:
+        --------
+        None
+        '''
+
+        self.path = os.path.abspath(path)
+        if not _is_replaceable(self.path):
+            raise ValueError('{} exists and is not a Tf-Idf directory; refusing to replace it'
+                             .format(path))
+        self.chunk_rows = chunk_rows
+        parent = os.path.dirname(self.path)
+        os.makedirs(parent, exist_ok=True)
+        self.tmp_path = tempfile.mkdtemp(prefix='.tmp_tfidf_', dir=parent)
+        os.chmod(self.tmp_path, 0o755)
+        os.makedirs(os.path.join(self.tmp_path, 'chunks'))
+        self.terms = {}
+        self.term_counts = np.zeros(1024, dtype=np.int64)
+        self.doc_freq = np.zeros(1024, dtype=np.int64)
+        self.shop_ids = []
+        self._pending = []
+        self._n_chunks = 0
+
+    def add(self, shop_id, counts):
+        '''
+        Records one shop's term counts.
+        '''
+
+        columns = np.fromiter((self.terms.setdefault(t, len(self.terms)) for t in counts),
+                              dtype=np.int64, count=len(counts))
+        values = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+        if len(self.terms) > len(self.term_counts):
+            grow = max(len(self.terms), 2 * len(self.term_counts)) - len(self.term_counts)
+            self.term_counts = np.concatenate([self.term_counts, np.zeros(grow, dtype=np.int64)])
+            self.doc_freq = np.concatenate([self.doc_freq, np.zeros(grow, dtype=np.int64)])
+        self.term_counts[columns] += values
+        self.doc_freq[columns] += 1
+        self.shop_ids.append(shop_id)
+        self._pending.append((columns, values))
+        if len(self._pending) >= self.chunk_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        indptr = np.cumsum([0] + [len(c) for c, _ in self._pending])
+        np.savez(os.path.join(self.tmp_path, 'chunks', '{:06d}.npz'.format(self._n_chunks)),
+                 indices=np.concatenate([c for c, _ in self._pending]),
+                 data=np.concatenate([v for _, v in self._pending]),
+                 indptr=indptr)
+        self._n_chunks += 1
+        self._pending = []
+
+    def finalize(self, max_features=MAX_FEATURES):
+        '''
+        Selects the vocabulary and writes the Tf-Idf matrix.
+
+        Parameters:
+        -----------
+        max_features: Int - Keep this many of the most frequent terms
+
+        Output:
+        -------
+        tfidf: Scipy CSR Matrix - (shops x terms) l2 normalized Tf-Idf
+        vocabulary: List of strings - Terms in column order (alphabetical)
+        idf: Numpy Array - Inverse document frequency of each term
+        shop_ids: Numpy Array - Shop id of each row
+        '''
+
+        self._flush()
+        n_terms = len(self.terms)
+        names = np.empty(n_terms, dtype=object)
+        for term, i in self.terms.items():
+            names[i] = term
+        #Rank the alphabetical vocabulary by count exactly as TfidfVectorizer
+        #does, so ties at the cutoff are broken the same way
+        alphabetical = np.argsort(names)
+        keep = alphabetical[(-self.term_counts[alphabetical]).argsort()[:max_features]]
+        keep = keep[np.argsort(names[keep])]
+        remap = np.full(n_terms, -1, dtype=np.int64)
+        remap[keep] = np.arange(len(keep))
+        n_docs = len(self.shop_ids)
+        idf = np.log((1 + n_docs) / (1 + self.doc_freq[keep])) + 1
+
+        rows = []
+        for chunk_path in sorted(glob.glob(os.path.join(self.tmp_path, 'chunks', '*.npz'))):
+            chunk = np.load(chunk_path)
+            counts = sp.csr_matrix((chunk['data'], chunk['indices'], chunk['indptr']),
+                                   shape=(len(chunk['indptr']) - 1, n_terms))
+            #Keep the chosen columns, in vocabulary order
+            selected = counts.tocsc()[:, keep].tocsr().astype(float)
+            selected = selected.multiply(idf).tocsr()
+            norms = np.sqrt(np.asarray(selected.multiply(selected).sum(axis=1))).ravel()
+            rows.append(sp.diags(1 / np.where(norms > 0, norms, 1)).dot(selected).tocsr())
+        tfidf = sp.vstack(rows, format='csr') if rows else sp.csr_matrix((0, len(keep)))
+        tfidf.sort_indices()
+
+        vocabulary = names[keep].tolist()
+        shop_ids = np.asarray(self.shop_ids)
+        sp.save_npz(os.path.join(self.tmp_path, 'tfidf.npz'), tfidf)
+        np.save(os.path.join(self.tmp_path, 'idf.npy'), idf)
+        np.save(os.path.join(self.tmp_path, 'shop_ids.npy'), shop_ids)
+        with open(os.path.join(self.tmp_path, VOCABULARY_NAME), 'w') as f:
+            json.dump(vocabulary, f)
+        shutil.rmtree(os.path.join(self.tmp_path, 'chunks'))
+        #Checked again, in case something else was written there meanwhile
+        if not _is_replaceable(self.path):
+            raise ValueError('{} exists and is not a Tf-Idf directory; refusing to replace it'
+                             .format(self.path))
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+        return tfidf, vocabulary, idf, shop_ids
+
+    def discard(self):
+        '''
+        Deletes the partial output of a build that won't be finalized.
+        '''
+
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+def _is_replaceable(path):
+    #Only an empty directory or an earlier build's output is replaced, never
+    #whatever else the output path points at
+    if not os.path.lexists(path):
+        return True
+    if os.path.islink(path) or not os.path.isdir(path):
+        return False
+    return not os.listdir(path) or os.path.isfile(os.path.join(path, VOCABULARY_NAME))
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def build_tfidf(shops, path, max_features=MAX_FEATURES, processes=None,
+                preprocessor=None, chunksize=8, chunk_rows=2000):
+    '''
+    Takes in a stream of (shop id, list of reviews) and outputs the Tf-Idf
+    matrix, also written to path.
+
+    Parameters:
+    -----------
+    shops: Iterable of (shop id, list of strings) - e.g. iter_review_csv
+    path: String - Output directory
+    max_features: Int - Tf-Idf vocabulary size (Default: 500)
+    processes: Int - Worker processes, 1 to run in this process
+    (Default: one per CPU)
+    preprocessor: ReviewPreprocessor - Tokenization settings
+    chunksize: Int - Shops sent to a worker at a time
+    chunk_rows: Int - Shops per chunk file
+
+    Output:
+    -------
+    tfidf, vocabulary, idf, shop_ids - See TfidfWriter.finalize
+    '''
+
+    preprocessor = preprocessor or ReviewPreprocessor()
+    writer = TfidfWriter(path, chunk_rows)
+    processes = processes or os.cpu_count() or 1
+    try:
+        if processes == 1:
+            _init_worker(preprocessor)
+            for item in shops:
+                writer.add(*_count_shop(item))
+            return writer.finalize(max_features)
+
+        with Pool(processes, initializer=_init_worker, initargs=(preprocessor,)) as pool:
+            #Pool.imap reads its whole input up front, so feed it bounded batches
+            batch_size = chunksize * processes * 4
+            for batch in _batches(shops, batch_size):
+                for shop_id, counts in pool.imap(_count_shop, batch, chunksize):
+                    writer.add(shop_id, counts)
+        return writer.finalize(max_features)
+    finally:
+        #Gone already when finalize succeeded
+        writer.discard()
+
+def load_tfidf(path):
+    '''
+    Reads the output of build_tfidf.
+    '''
+
+    with open(os.path.join(path, VOCABULARY_NAME)) as f:
+        vocabulary = json.load(f)
+    return (sp.load_npz(os.path.join(path, 'tfidf.npz')), vocabulary,
+            np.load(os.path.join(path, 'idf.npy')),
+            np.load(os.path.join(path, 'shop_ids.npy'), allow_pickle=True))
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a sparse Tf-Idf matrix from shop reviews')
+    parser.add_argument('--reviews', default='data/seattle_coffeeshops_combine_reviews.csv')
+    parser.add_argument('--id-column', help='Shop id column (Default: the CSV index)')
+    parser.add_argument('--out', default='data/tfidf')
+    parser.add_argument('--max-features', type=int, default=MAX_FEATURES)
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+
+    tfidf, vocabulary, _, _ = build_tfidf(iter_review_csv(args.reviews, args.id_column),
+                                          args.out, args.max_features, args.processes)
+    print('Wrote {} shops x {} terms ({} nonzeros) to {}'.format(
+        tfidf.shape[0], len(vocabulary), tfidf.nnz, args.out))
+
+if __name__ == '__main__':
+    main()
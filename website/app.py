@@ -1,7 +1,21 @@
 from flask import Flask, render_template, request, jsonify, redirect, send_file
+from flask import send_from_directory
+from flask import Response, g
+import hmac
+import json
+import os
+import time
+import uuid
 import pandas as pd
 import yaml
 from recommender_model import RecommenderModel
+from model_artifact import load_model_inputs
+from recommendation_cache import RecommendationCache
+from neighborhood_index import load_neighborhood_index
+from model_registry import ModelRegistry
+from feedback import FeedbackLog, RateLimiter, vote_token
+from image_store import ImageStore, IMMUTABLE_MAX_AGE
+from metrics import REGISTRY, SampledProfiler
 from io import BytesIO
 from pathlib import Path
 import base64
@@ -9,14 +23,93 @@ import base64
 default_lat = 47.6130285
 default_lng = -122.3420645
 
+# Accepted ranges for the recommendation API's inputs, matching the sliders
+# on the main page
+weight_bounds = (0, 100)
+max_request_features = 20
+range_bounds = (0, 20)
+# The main page's range slider; /submit clamps to it
+form_range_bounds = (0.1, 20)
+max_recommendations = 20
+api_max_age = 300
+# Published model versions are picked up from here (see model_registry.py)
+model_registry_path = '../data/model_registry'
+model_poll_interval = 10
+# Impressions and votes on recommendations are appended here (see feedback.py)
+feedback_log_path = '../data/feedback'
+# Votes accepted per client address and minute, in each worker
+feedback_votes_per_minute = 30
+
 app = Flask(__name__)
-df = pd.read_csv('../data/df_with_features.csv', index_col=0)
-mapping_df = pd.read_csv('../data/mapping_df.csv', index_col=0)
-model = RecommenderModel(df, mapping_df)
+df, mapping_df, precomputed = load_model_inputs('../data/model_artifact',
+                                                '../data/df_with_features.csv',
+                                                '../data/mapping_df.csv')
+neighborhoods = load_neighborhood_index('../data/neighborhood_index')
+model = RecommenderModel(df, mapping_df, precomputed=precomputed, metrics=REGISTRY,
+                         neighborhoods=neighborhoods)
+recommender = RecommendationCache(model)
+#Serve the newest published version from the start, then watch for new ones
+model_versions = ModelRegistry(model, model_registry_path, poll_interval=model_poll_interval,
+                               metrics=REGISTRY)
+model_versions.check()
+model_versions.start()
+feedback = FeedbackLog(feedback_log_path, metrics=REGISTRY)
+#Signs the shops on each page so votes can be checked. Generated before
+#serve.py forks, so every worker shares it; set FEEDBACK_SECRET when several
+#servers take votes for each other's pages
+feedback_secret = os.environ.get('FEEDBACK_SECRET', '').encode() or os.urandom(32)
+vote_limiter = RateLimiter(feedback_votes_per_minute)
+image_store = ImageStore()
+app.jinja_env.globals['shop_picture'] = image_store.picture
+
+# Request timings for /metrics, and cProfile output of sampled slow requests
+# when PROFILE_SAMPLE_RATE is set
+request_seconds = REGISTRY.histogram('http_request_seconds',
+                                     'Time to handle each request',
+                                     ('endpoint', 'method', 'status'))
+REGISTRY.gauge('recommendation_cache_entries', 'Results held by the recommendation cache',
+               lambda: len(recommender))
+REGISTRY.gauge('recommendation_cache_events', 'Recommendation cache lookups by outcome',
+               lambda: {(event,): value for event, value in recommender.stats().items()
+                        if event not in ('size', 'maxsize')},
+               ('event',))
+profiler = SampledProfiler.from_environ()
+
+def request_timer(endpoint):
+    return REGISTRY.stage_timer('request_stage_seconds',
+                                'Time spent in each stage of handling a request',
+                                ('endpoint',), endpoint)
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    g.profile = profiler.start()
+
+@app.after_request
+def record_request_timing(response):
+    duration = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unmatched'
+    request_seconds.observe(duration, endpoint, request.method, str(response.status_code))
+    if g.profile is not None:
+        profiler.finish(g.profile, duration, endpoint)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
-    return render_template('main.html', features=mapping_df.columns)
+    return render_template('main.html', features=model.data.mapping_df.columns)
+
+@app.route('/shop_images/<path:filename>')
+def shop_image(filename):
+    #Built files are named by content hash, so they can be cached forever
+    response = send_from_directory(image_store.build_dir, filename,
+                                   max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/about')
 def about():
@@ -29,10 +122,11 @@ def tech():
 #This works with form input
 @app.route('/submit', methods=['GET', 'POST'])
 def submit():
+    timer = request_timer('submit')
     f1 = tuple((float(request.form['f1_weight']), request.form['feature1']))
     f2 = tuple((float(request.form['f2_weight']), request.form['feature2']))
     f3 = tuple((float(request.form['f3_weight']), request.form['feature3']))
-    r = float(request.form['range'])
+    r = min(max(float(request.form['range']), form_range_bounds[0]), form_range_bounds[1])
     if len(request.form['coord']) > 0:
         lat = request.form['coord'].split(',')[0]
         lng = request.form['coord'].split(',')[1]
@@ -40,25 +134,368 @@ def submit():
         lat = default_lat
         lng = default_lng
         r = 1
-    recs = model.recommend(f1, f2, f3, lat, lng, r).to_dict('records')
+    timer.mark('parse_form')
+    recs = recommender.recommend(f1, f2, f3, lat, lng, r)
+    timer.mark('recommend')
+    recs = recs.to_dict('records')
     for rec in recs:
         rec['split_address'] = rec['address'].replace(' ', '+') + '+seattle'
-    return render_template('recommendations.html', recs=recs)
-
-# @app.route('/submit', methods=['GET', 'POST'])
-# def submit():
-#     user_info = request.json
-#     print(user_info)
-#     f1 = tuple((float(user_info['f1_weight']), user_info['f1_name']))
-#     f2 = tuple((float(user_info['f2_weight']), user_info['f2_name']))
-#     f3 = tuple((float(user_info['f3_weight']), user_info['f3_name']))
-#     lat = user_info['coord'].split(',')[0]
-#     lng = user_info['coord'].split(',')[1]
-#     r = float(user_info['range'])
-#     recs = model.recommend(f1, f2, f3, lat, lng, r).to_dict('records')
-#     for rec in recs:
-#         rec['split_address'] = rec['address'].replace(' ', '+') + '+seattle'
-#     return render_template('recommendations.html', recs=recs)
+    timer.mark('to_dict')
+    #Votes on the page are sent back with the request's id and features
+    request_id = uuid.uuid4().hex
+    feedback.record('impression', [rec['shop_id'] for rec in recs], [f1, f2, f3], request_id)
+    for rec in recs:
+        rec['feedback_token'] = vote_token(feedback_secret, request_id, rec['shop_id'])
+    feedback_fields = {'request_id': request_id}
+    for i, (weight, name) in enumerate([f1, f2, f3], 1):
+        feedback_fields.update({'feature{}'.format(i): name, 'f{}_weight'.format(i): weight})
+    timer.mark('feedback')
+    html = render_template('recommendations.html', recs=recs, feedback_fields=feedback_fields)
+    timer.mark('render')
+    return html
+
+class InvalidRequest(ValueError):
+    '''
+    Raised when recommendation API parameters fail validation.
+    '''
+
+def _parse_number(values, name, low, high, default=None, inclusive=False):
+    '''
+    Reads a number from request values, which arrive as strings, and checks
+    that low < value <= high (low <= value <= high if inclusive).
+    '''
+
+    raw = values.get(name, default)
+    if raw is None or raw == '':
+        raise InvalidRequest('{} is required'.format(name))
+    try:
+        value = float(raw)
+    except (TypeError, ValueError):
+        raise InvalidRequest('{} must be a number'.format(name))
+    if inclusive and not low <= value <= high:
+        raise InvalidRequest('{} must be at least {} and at most {}'.format(
+            name, low, high))
+    if not inclusive and not low < value <= high:
+        raise InvalidRequest('{} must be greater than {} and at most {}'.format(
+            name, low, high))
+    return value
+
+def _parse_weight(values, name, default=None):
+    '''
+    Reads a feature or distance weight. Negative weights count against a
+    shop, so weights may lie anywhere in [-max weight, max weight].
+    '''
+
+    high = weight_bounds[1]
+    return _parse_number(values, name, -high, high, default, inclusive=True)
+
+def _parse_features(values):
+    '''
+    Reads the weighted features of a request: either a JSON list of
+    {"name": ..., "weight": ...} objects under "features", or the /submit
+    form's numbered fields (feature1, f1_weight, feature2, f2_weight, ...)
+    read until the first missing number.
+    '''
+
+    features = values.get('features')
+    fields = []
+    if features is not None:
+        if not isinstance(features, list) or not all(isinstance(f, dict) for f in features):
+            raise InvalidRequest('features must be a list of {"name": ..., "weight": ...}')
+        for i, feature in enumerate(features):
+            fields.append(('features[{}].name'.format(i), feature.get('name'),
+                           'features[{}].weight'.format(i), feature.get('weight')))
+    else:
+        i = 1
+        while values.get('feature{}'.format(i)) not in (None, ''):
+            fields.append(('feature{}'.format(i), values.get('feature{}'.format(i)),
+                           'f{}_weight'.format(i), values.get('f{}_weight'.format(i))))
+            i += 1
+    if not fields:
+        raise InvalidRequest('feature1 must be one of {}'.format(
+            list(model.data.mapping_df.columns)))
+    if len(fields) > max_request_features:
+        raise InvalidRequest('At most {} features may be weighted'.format(max_request_features))
+
+    chosen_features = []
+    for name_field, name, weight_field, weight in fields:
+        if name not in model.feature_index:
+            raise InvalidRequest('{} must be one of {}'.format(
+                name_field, list(model.data.mapping_df.columns)))
+        chosen_features.append((_parse_weight({weight_field: weight}, weight_field), name))
+    return chosen_features
+
+def _parse_flag(values, name):
+    '''
+    Reads an optional true/false parameter, given as a JSON boolean or as
+    one of true/false, 1/0, on/off or yes/no.
+    '''
+
+    raw = values.get(name)
+    if raw is None or raw == '' or isinstance(raw, bool):
+        return bool(raw)
+    text = str(raw).strip().lower()
+    if text in ('true', '1', 'on', 'yes'):
+        return True
+    if text in ('false', '0', 'off', 'no'):
+        return False
+    raise InvalidRequest('{} must be true or false'.format(name))
+
+def parse_recommendation_request(values):
+    '''
+    Validates recommendation API parameters. Accepts the same field names as
+    the /submit form (feature1-3, f1_weight-f3_weight, range, coord) with
+    lat and lng as an alternative to coord, plus an optional n. Any number of
+    features may be given, with negative weights for features to avoid, and
+    an optional distance_weight scores closeness to the user.
+    same_neighborhood and avoid_water restrict results to the user's
+    neighborhood, or to shops not across water, when the neighborhood index
+    is loaded.
+
+    Parameters:
+    -----------
+    values: Dictionary-like - Query string, form or JSON body values
+
+    Output:
+    -------
+    kwargs: Dictionary - Arguments for RecommenderModel.recommend_features
+    '''
+
+    chosen_features = _parse_features(values)
+    distance_weight = _parse_weight(values, 'distance_weight', default=0)
+    if distance_weight == 0 and not any(weight for weight, _ in chosen_features):
+        raise InvalidRequest('At least one weight must be nonzero')
+
+    coord = values.get('coord')
+    if coord:
+        parts = str(coord).split(',')
+        if len(parts) != 2:
+            raise InvalidRequest('coord must be "lat,lng"')
+        values = dict(values, lat=parts[0], lng=parts[1])
+    if values.get('lat') in (None, '') and values.get('lng') in (None, ''):
+        #Same default as the form: downtown with a one mile range
+        lat, lng, r = default_lat, default_lng, 1
+    else:
+        lat = _parse_number(values, 'lat', -90, 90)
+        lng = _parse_number(values, 'lng', -180, 180)
+        r = _parse_number(values, 'range', *range_bounds)
+    n = _parse_number(values, 'n', 0, max_recommendations, default=3)
+    if n != int(n):
+        raise InvalidRequest('n must be a whole number')
+
+    same_neighborhood = _parse_flag(values, 'same_neighborhood')
+    avoid_water = _parse_flag(values, 'avoid_water')
+    if same_neighborhood or avoid_water:
+        index = model.data.neighborhoods
+        if index is None:
+            raise InvalidRequest('Neighborhood filters are not available')
+        if index.cell(lat, lng) is None:
+            raise InvalidRequest('Neighborhood filters are only available within Seattle')
+
+    return dict(chosen_features=chosen_features, lat=lat, lng=lng, r=r, n=int(n),
+                distance_weight=distance_weight, same_neighborhood=same_neighborhood,
+                avoid_water=avoid_water)
+
+@app.route('/api/v1/recommend', methods=['GET', 'POST'])
+def api_recommend():
+    timer = request_timer('api_recommend')
+    if request.method == 'POST' and request.is_json:
+        values = request.get_json(silent=True)
+        if not isinstance(values, dict):
+            return _json_response({'error': 'Body must be a JSON object'}, 400)
+    elif request.method == 'POST':
+        values = request.form
+    else:
+        values = request.args
+    try:
+        kwargs = parse_recommendation_request(values)
+    except InvalidRequest as e:
+        return _json_response({'error': str(e)}, 400)
+    timer.mark('parse')
+
+    recs = recommender.recommend_features(**kwargs)
+    timer.mark('recommend')
+    response = _cacheable_json_response(_recommendations_body(recs))
+    timer.mark('serialize')
+    return response
+
+def parse_similar_request(values):
+    '''
+    Validates "shops like this one" API parameters: a shop_id, an optional
+    lat/lng (or coord) and range to restrict results to, and an optional n.
+
+    Parameters:
+    -----------
+    values: Dictionary-like - Query string, form or JSON body values
+
+    Output:
+    -------
+    kwargs: Dictionary - Arguments for RecommenderModel.similar_shops
+    '''
+
+    raw = values.get('shop_id')
+    try:
+        shop_id = int(raw)
+    except (TypeError, ValueError):
+        raise InvalidRequest('shop_id must be a whole number')
+    if shop_id not in model.shop_positions:
+        raise InvalidRequest('Unknown shop_id {}'.format(shop_id))
+
+    coord = values.get('coord')
+    if coord:
+        parts = str(coord).split(',')
+        if len(parts) != 2:
+            raise InvalidRequest('coord must be "lat,lng"')
+        values = dict(values, lat=parts[0], lng=parts[1])
+    lat = lng = r = None
+    if values.get('lat') not in (None, '') or values.get('lng') not in (None, ''):
+        lat = _parse_number(values, 'lat', -90, 90)
+        lng = _parse_number(values, 'lng', -180, 180)
+    if values.get('range') not in (None, ''):
+        r = _parse_number(values, 'range', *range_bounds)
+    n = _parse_number(values, 'n', 0, max_recommendations, default=3)
+    if n != int(n):
+        raise InvalidRequest('n must be a whole number')
+    return dict(shop_id=shop_id, lat=lat, lng=lng, r=r, n=int(n))
+
+@app.route('/api/v1/similar', methods=['GET', 'POST'])
+def api_similar():
+    if request.method == 'POST' and request.is_json:
+        values = request.get_json(silent=True)
+        if not isinstance(values, dict):
+            return _json_response({'error': 'Body must be a JSON object'}, 400)
+    elif request.method == 'POST':
+        values = request.form
+    else:
+        values = request.args
+    try:
+        kwargs = parse_similar_request(values)
+    except InvalidRequest as e:
+        return _json_response({'error': str(e)}, 400)
+
+    recs = model.similar_shops(**kwargs)
+    return _cacheable_json_response(_recommendations_body(recs))
+
+def parse_feedback_request(values):
+    '''
+    Validates a vote on a recommended shop: a shop_id, vote (up or down),
+    the features the recommendation was made for, in the same fields as the
+    recommendation API, and the request_id of the page it was shown on with
+    the shop's token from that page.
+
+    Parameters:
+    -----------
+    values: Dictionary-like - Form or JSON body values
+
+    Output:
+    -------
+    kwargs: Dictionary - Arguments for FeedbackLog.record
+    '''
+
+    raw = values.get('shop_id')
+    try:
+        shop_id = int(raw)
+    except (TypeError, ValueError):
+        raise InvalidRequest('shop_id must be a whole number')
+    if shop_id not in model.shop_positions:
+        raise InvalidRequest('Unknown shop_id {}'.format(shop_id))
+    vote = values.get('vote')
+    if vote not in ('up', 'down'):
+        raise InvalidRequest('vote must be up or down')
+    request_id = values.get('request_id')
+    if not isinstance(request_id, str) or not 0 < len(request_id) <= 64:
+        raise InvalidRequest('request_id must be a string of 1 to 64 characters')
+    token = values.get('token')
+    if not isinstance(token, str) or not hmac.compare_digest(
+            token, vote_token(feedback_secret, request_id, shop_id)):
+        raise InvalidRequest('token does not match a recommendation of this shop')
+    return dict(event_type=vote, shop_ids=[shop_id], chosen_features=_parse_features(values),
+                request_id=request_id)
+
+@app.route('/api/v1/feedback', methods=['POST'])
+def api_feedback():
+    if request.is_json:
+        values = request.get_json(silent=True)
+        if not isinstance(values, dict):
+            return _json_response({'error': 'Body must be a JSON object'}, 400)
+    else:
+        values = request.form
+    try:
+        kwargs = parse_feedback_request(values)
+    except InvalidRequest as e:
+        return _json_response({'error': str(e)}, 400)
+    if not vote_limiter.allow(request.remote_addr):
+        return _json_response({'error': 'Too many votes, try again later'}, 429)
+    if not feedback.record(**kwargs):
+        return _json_response({'error': 'Feedback is not being accepted right now'}, 503)
+    return _json_response({'status': 'accepted'}, 202)
+
+@app.route('/api/v1/health')
+def api_health():
+    return _json_response({'status': 'ok', 'shops': len(model.shop_locations)})
+
+def _is_admin():
+    #ADMIN_TOKEN must be set and sent as X-Admin-Token. The client address
+    #proves nothing behind a reverse proxy, so without a token admin routes
+    #are closed
+    token = os.environ.get('ADMIN_TOKEN')
+    if not token:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+@app.route('/admin/model', methods=['GET', 'POST'])
+def admin_model():
+    '''
+    Shows the active model version and its load time. POST action=reload
+    checks the registry now, action=rollback restores the previous version
+    and action=activate&version=... loads a specific version. Rollbacks and
+    activations are recorded in the registry, so every worker follows them.
+    '''
+
+    if not os.environ.get('ADMIN_TOKEN'):
+        return _json_response({'error': 'Admin endpoints are disabled; set ADMIN_TOKEN'}, 403)
+    if not _is_admin():
+        return _json_response({'error': 'Forbidden'}, 403)
+    if request.method == 'POST':
+        values = request.get_json(silent=True) if request.is_json else request.form
+        action = (values or {}).get('action')
+        if action == 'reload':
+            model_versions.check()
+        elif action == 'rollback':
+            if model_versions.rollback() is None:
+                return _json_response({'error': 'No previous version to roll back to'}, 409)
+        elif action == 'activate':
+            version = (values or {}).get('version')
+            if version not in model_versions.status()['available']:
+                return _json_response({'error': 'Unknown version {}'.format(version)}, 404)
+            if not model_versions.activate(version):
+                return _json_response(dict(model_versions.status(),
+                                           error='Version {} failed to load'.format(version)),
+                                      422)
+        else:
+            return _json_response({'error': 'action must be reload, rollback or activate'}, 400)
+    return _json_response(model_versions.status())
+
+def _recommendations_body(recs):
+    return {'recommendations': [
+        {'shop_id': shop_id, 'name': name, 'address': address, 'lat': lat,
+         'lng': lng, 'distance': round(distance, 3), 'score': round(score, 4)}
+        for shop_id, name, address, lat, lng, distance, score in zip(
+            recs.shops['shop_id'].tolist(), recs.shops['name'].tolist(),
+            recs.shops['address'].tolist(), recs.shops['lat'].tolist(),
+            recs.shops['lng'].tolist(), recs.distance_from_location.tolist(),
+            recs.combined_weights.tolist())]}
+
+def _json_response(body, status=200):
+    return Response(json.dumps(body, separators=(',', ':')), status=status,
+                    mimetype='application/json')
+
+def _cacheable_json_response(body):
+    response = _json_response(body)
+    response.cache_control.public = True
+    response.cache_control.max_age = api_max_age
+    response.add_etag()
+    return response.make_conditional(request)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', threaded=True)
@@ -0,0 +1,380 @@
+import threading
+
+import numpy as np
+from geopy.distance import great_circle, EARTH_RADIUS
+
+# Mean earth radius used by geopy's great_circle, converted to miles so the
+# vectorized kernel and the geopy reference agree
+EARTH_RADIUS_MILES = EARTH_RADIUS / 1.609344
+
+# Maximum absolute difference, in miles, between haversine_miles and geopy's
+# great_circle for any pair of points. Both use a spherical earth with the same
+# radius, so the only differences are float64 rounding in the two formulas.
+HAVERSINE_TOLERANCE_MILES = 1e-6
+
+DISTANCE_ENGINES = ('haversine', 'geopy')
+
+def haversine_miles(lat, lng, lat_rad, lng_rad, cos_lat):
+    '''
+    Computes great circle distances from a single point to an array of points
+    in one vectorized operation.
+
+    Parameters:
+    -----------
+    lat: Float or Numpy Array - Latitude of the query point in degrees. An
+    array of shape (m, 1) measures from m query points at once.
+    lng: Float or Numpy Array - Longitude of the query point in degrees
+    lat_rad, lng_rad: Numpy Arrays - Latitudes and longitudes of the points to
+    measure to, in radians
+    cos_lat: Numpy Array - Cosine of lat_rad
+
+    Output:
+    -------
+    distances: Numpy Array - Distance in miles to each point, with shape
+    (m, len(lat_rad)) for m query points
+    '''
+
+    #Always go through arrays so single and batched queries round identically
+    query_lat = np.radians(np.atleast_1d(lat))
+    query_lng = np.radians(np.atleast_1d(lng))
+    sin_dlat = np.sin((lat_rad - query_lat) / 2)
+    sin_dlng = np.sin((lng_rad - query_lng) / 2)
+    a = sin_dlat * sin_dlat + np.cos(query_lat) * cos_lat * sin_dlng * sin_dlng
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def great_circle_miles(lat, lng, lats, lngs):
+    '''
+    Reference implementation of haversine_miles using geopy, one point at a
+    time. Kept to validate the vectorized kernel.
+
+    Parameters:
+    -----------
+    lat: Float - Latitude of the query point in degrees
+    lng: Float - Longitude of the query point in degrees
+    lats, lngs: Array-like - Latitudes and longitudes of the points to measure
+    to, in degrees
+
+    Output:
+    -------
+    distances: Numpy Array - Distance in miles to each point
+    '''
+
+    current_location = (lat, lng)
+    return np.array([great_circle(current_location, (shop_lat, shop_lng)).miles
+                     for shop_lat, shop_lng in zip(lats, lngs)], dtype=float)
+
+def bounding_box(lat, lng, r):
+    '''
+    Computes the latitude and longitude half-widths, in degrees, of a box that
+    contains every point within r miles of (lat, lng).
+
+    Parameters:
+    -----------
+    lat: Float - Latitude of the query point in degrees
+    lng: Float - Longitude of the query point in degrees
+    r: Float - Radius in miles
+
+    Output:
+    -------
+    dlat, dlng: Floats - Half-widths of the box in degrees. dlng is 180 when
+    the circle reaches a pole.
+    '''
+
+    angular_r = r / EARTH_RADIUS_MILES
+    dlat = np.degrees(angular_r)
+    if abs(lat) + dlat >= 90:
+        return dlat, 180.0
+    dlng = np.degrees(np.arcsin(min(1.0, np.sin(angular_r) /
+                                    np.cos(np.radians(lat)))))
+    return dlat, dlng
+
+class ShopLocations():
+    '''
+    Contiguous arrays of shop coordinates, precomputed in radians, for
+    repeated radius queries from different user locations.
+    '''
+    def __init__(self, lats, lngs):
+        '''
+        Parameters:
+        -----------
+        lats, lngs: Array-like - Shop latitudes and longitudes in degrees
+
+        Output:
+        --------
+        None
+        '''
+
+        self.lat = np.ascontiguousarray(lats, dtype=float)
+        self.lng = np.ascontiguousarray(lngs, dtype=float)
+        self.lat_rad = np.radians(self.lat)
+        self.lng_rad = np.radians(self.lng)
+        self.cos_lat = np.cos(self.lat_rad)
+        for array in (self.lat, self.lng, self.lat_rad, self.lng_rad,
+                      self.cos_lat):
+            array.flags.writeable = False
+
+    def __len__(self):
+        return len(self.lat)
+
+    def distances(self, lat, lng, engine='haversine'):
+        '''
+        Distances in miles from (lat, lng) to every shop.
+
+        Parameters:
+        -----------
+        lat: Float - Latitude of the query point
+        lng: Float - Longitude of the query point
+        engine: String - 'haversine' (vectorized, default) or 'geopy'
+        (per-shop reference)
+
+        Output:
+        -------
+        distances: Numpy Array - Distance in miles to each shop
+        '''
+
+        lat, lng = float(lat), float(lng)
+        if engine == 'haversine':
+            return haversine_miles(lat, lng, self.lat_rad, self.lng_rad,
+                                   self.cos_lat)
+        if engine == 'geopy':
+            return great_circle_miles(lat, lng, self.lat, self.lng)
+        raise ValueError('Unknown distance engine {}, expected one of {}'
+                         .format(engine, DISTANCE_ENGINES))
+
+    def within(self, lat, lng, r, engine='haversine'):
+        '''
+        Finds the shops strictly closer than r miles to (lat, lng). A bounding
+        box cut is applied before exact distances are computed.
+
+        Parameters:
+        -----------
+        lat: Float - Latitude of the query point
+        lng: Float - Longitude of the query point
+        r: Float - Radius in miles
+        engine: String - 'haversine' (vectorized, default) or 'geopy'
+        (per-shop reference, no bounding box)
+
+        Output:
+        -------
+        indices: Numpy Array - Positions of the matching shops, ascending
+        distances: Numpy Array - Distance in miles to each matching shop
+        '''
+
+        lat, lng, r = float(lat), float(lng), float(r)
+        if engine == 'geopy':
+            distances = self.distances(lat, lng, engine)
+            indices = np.flatnonzero(distances < r)
+            return indices, distances[indices]
+        if engine != 'haversine':
+            raise ValueError('Unknown distance engine {}, expected one of {}'
+                             .format(engine, DISTANCE_ENGINES))
+
+        dlat, dlng = bounding_box(lat, lng, r)
+        in_box = np.abs(self.lat - lat) <= dlat
+        if dlng < 180:
+            #Wrap longitude differences into [-180, 180) for the dateline
+            in_box &= np.abs((self.lng - lng + 180) % 360 - 180) <= dlng
+        candidates = np.flatnonzero(in_box)
+        distances = haversine_miles(lat, lng, self.lat_rad[candidates],
+                                    self.lng_rad[candidates],
+                                    self.cos_lat[candidates])
+        keep = distances < r
+        return candidates[keep], distances[keep]
+
+class GridIndex():
+    '''
+    Spatial index bucketing shops into a fixed latitude/longitude grid.
+    Radius queries only measure distances to shops in the grid cells that
+    overlap the query's bounding box, and shops can be inserted or removed
+    without rebuilding the index. Queries and updates may run on different
+    threads.
+    '''
+    def __init__(self, cell_size=0.05):
+        '''
+        Parameters:
+        -----------
+        cell_size: Float - Width and height of a grid cell in degrees
+        (Default: 0.05, roughly 3.5 x 2.3 miles at Seattle's latitude)
+
+        Output:
+        --------
+        None
+        '''
+
+        self.cell_size = float(cell_size)
+        self.n_lng_cells = int(np.ceil(360 / self.cell_size))
+        self.cells = {}
+        self.locations = {}
+        # Per-cell (keys, lat_rad, lng_rad, cos_lat) arrays, rebuilt lazily
+        # after the cell changes, plus the same arrays over every cell for
+        # queries that cover the whole index
+        self._cell_arrays = {}
+        self._all_arrays = None
+        #Bumped on every change, so a query doesn't cache arrays built from
+        #a snapshot that was modified in the meantime
+        self._version = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_arrays(cls, lats, lngs, keys=None, cell_size=0.05):
+        '''
+        Builds an index from arrays of coordinates.
+
+        Parameters:
+        -----------
+        lats, lngs: Array-like - Shop latitudes and longitudes in degrees
+        keys: Array-like - Key for each shop (Default: row positions)
+        cell_size: Float - Width and height of a grid cell in degrees
+
+        Output:
+        -------
+        index: GridIndex
+        '''
+
+        index = cls(cell_size)
+        if keys is None:
+            keys = range(len(lats))
+        for key, lat, lng in zip(keys, lats, lngs):
+            index.insert(key, lat, lng)
+        return index
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, key):
+        return key in self.locations
+
+    @property
+    def version(self):
+        #Changes whenever a shop is inserted or removed, so callers can tell
+        #when results they kept are out of date
+        return self._version
+
+    def _cell(self, lat, lng):
+        return (int(np.floor(lat / self.cell_size)),
+                int(np.floor((lng + 180) / self.cell_size)) % self.n_lng_cells)
+
+    def insert(self, key, lat, lng):
+        '''
+        Adds a shop to the index, replacing any existing entry for key.
+
+        Parameters:
+        -----------
+        key: Hashable - Identifier returned by query, e.g. a row position
+        lat, lng: Floats - Shop latitude and longitude in degrees
+
+        Output:
+        -------
+        None
+        '''
+
+        lat, lng = float(lat), float(lng)
+        cell = self._cell(lat, lng)
+        with self._lock:
+            if key in self.locations:
+                self._remove(key)
+            self.cells.setdefault(cell, {})[key] = (lat, lng)
+            self.locations[key] = cell
+            self._cell_arrays.pop(cell, None)
+            self._all_arrays = None
+            self._version += 1
+
+    def remove(self, key):
+        '''
+        Removes a shop from the index.
+
+        Parameters:
+        -----------
+        key: Hashable - Identifier the shop was inserted with
+
+        Output:
+        -------
+        None
+        '''
+
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        cell = self.locations.pop(key)
+        del self.cells[cell][key]
+        if not self.cells[cell]:
+            del self.cells[cell]
+        self._cell_arrays.pop(cell, None)
+        self._all_arrays = None
+        self._version += 1
+
+    def _arrays(self, cell):
+        arrays = self._cell_arrays.get(cell)
+        if arrays is None:
+            members = self.cells[cell]
+            keys = np.array(list(members.keys()))
+            coords = np.array(list(members.values()), dtype=float)
+            lat_rad = np.radians(coords[:, 0])
+            arrays = (keys, lat_rad, np.radians(coords[:, 1]), np.cos(lat_rad))
+            self._cell_arrays[cell] = arrays
+        return arrays
+
+    @staticmethod
+    def _concatenate(arrays):
+        return tuple(np.concatenate([cell_arrays[i] for cell_arrays in arrays])
+                     for i in range(4))
+
+    def _query_cells(self, lat, lng, r):
+        dlat, dlng = bounding_box(lat, lng, r)
+        lat_cells = range(int(np.floor((lat - dlat) / self.cell_size)),
+                          int(np.floor((lat + dlat) / self.cell_size)) + 1)
+        if dlng >= 180:
+            lng_cells = range(self.n_lng_cells)
+        else:
+            first = int(np.floor((lng - dlng + 180) / self.cell_size))
+            last = int(np.floor((lng + dlng + 180) / self.cell_size))
+            lng_cells = range(first, min(last, first + self.n_lng_cells - 1) + 1)
+        n_box_cells = len(lat_cells) * len(lng_cells)
+        #Large radii: cheaper to walk the occupied cells than the whole box
+        if n_box_cells > len(self.cells):
+            return [cell for cell in self.cells if cell[0] in lat_cells]
+        return [(lat_cell, lng_cell % self.n_lng_cells)
+                for lat_cell in lat_cells for lng_cell in lng_cells
+                if (lat_cell, lng_cell % self.n_lng_cells) in self.cells]
+
+    def query(self, lat, lng, r):
+        '''
+        Finds the shops strictly closer than r miles to (lat, lng).
+
+        Parameters:
+        -----------
+        lat: Float - Latitude of the query point
+        lng: Float - Longitude of the query point
+        r: Float - Radius in miles
+
+        Output:
+        -------
+        keys: Numpy Array - Keys of the matching shops, sorted ascending
+        distances: Numpy Array - Distance in miles to each matching shop
+        '''
+
+        lat, lng, r = float(lat), float(lng), float(r)
+        #Only the snapshot of cell arrays is taken under the lock; they are
+        #never modified in place, so concatenating them is safe outside it
+        with self._lock:
+            cells = self._query_cells(lat, lng, r)
+            if not cells:
+                return np.array([], dtype=int), np.array([], dtype=float)
+            whole_index = len(cells) == len(self.cells)
+            all_arrays = self._all_arrays if whole_index else None
+            if all_arrays is None:
+                arrays = [self._arrays(cell) for cell in cells]
+                version = self._version
+        if all_arrays is None:
+            all_arrays = self._concatenate(arrays)
+            if whole_index:
+                with self._lock:
+                    if self._version == version:
+                        self._all_arrays = all_arrays
+        keys, lat_rad, lng_rad, cos_lat = all_arrays
+        distances = haversine_miles(lat, lng, lat_rad, lng_rad, cos_lat)
+        keep = distances < r
+        keys, distances = keys[keep], distances[keep]
+        order = np.argsort(keys, kind='stable')
+        return keys[order], distances[order]
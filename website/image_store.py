@@ -0,0 +1,231 @@
+'''
+Pre-resized, content-hashed shop photos.
+
+The build step reads the original photos in static/shop_images (named by
+shop_id) and writes WebP and JPEG copies at a few widths to
+static/shop_images_built. Each file is named after a hash of its contents,
+so a URL never changes meaning and browsers can cache it forever.
+manifest.json maps each shop_id to its variants. At request time ImageStore
+only reads the manifest and needs no imaging library.
+
+Build with (Pillow required):
+    cd website && python image_store.py
+'''
+import argparse
+import hashlib
+import io
+import json
+import os
+
+from markupsafe import Markup
+
+SOURCE_DIR = 'static/shop_images'
+BUILD_DIR = 'static/shop_images_built'
+MANIFEST_NAME = 'manifest.json'
+DEFAULT_IMAGE = 'default_shop_image'
+WIDTHS = (200, 400, 600)
+# Pillow format name, file extension and MIME type of each variant
+FORMATS = [('WEBP', 'webp', 'image/webp'), ('JPEG', 'jpg', 'image/jpeg')]
+QUALITY = {'WEBP': 75, 'JPEG': 80}
+# Content-hashed files never change, so clients may keep them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def _file_hash(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+def build_variants(source_path, key, out_dir, widths=WIDTHS):
+    '''
+    Writes resized copies of one photo.
+
+    Parameters:
+    -----------
+    source_path: String - Original photo
+    key: String - shop_id, or DEFAULT_IMAGE, used to name the files
+    out_dir: String - Directory to write the variants to
+    widths: Tuple of ints - Target widths in pixels. Widths larger than the
+    original are skipped, and the original width is always included
+
+    Output:
+    -------
+    entry: Dictionary - Manifest entry with the original's hash, its size
+    and the (width, filename) variants for each format
+    '''
+
+    from PIL import Image, ImageOps
+
+    with open(source_path, 'rb') as f:
+        source = f.read()
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(source))).convert('RGB')
+    width, height = image.size
+    targets = sorted({w for w in widths if w < width} | {width})
+
+    entry = {'source_hash': _file_hash(source), 'width': width, 'height': height}
+    for pil_format, extension, _ in FORMATS:
+        variants = []
+        for target in targets:
+            resized = image if target == width else image.resize(
+                (target, max(1, round(height * target / width))), Image.LANCZOS)
+            buffer = io.BytesIO()
+            resized.save(buffer, pil_format, quality=QUALITY[pil_format], optimize=True)
+            data = buffer.getvalue()
+            filename = '{}-{}w.{}.{}'.format(key, target, _file_hash(data), extension)
+            path = os.path.join(out_dir, filename)
+            if not os.path.exists(path):
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+            variants.append([target, filename])
+        entry[extension] = variants
+    return entry
+
+def build_image_store(source_dir=SOURCE_DIR, out_dir=BUILD_DIR, widths=WIDTHS):
+    '''
+    Builds variants for every photo in source_dir and writes the manifest.
+    Photos whose contents haven't changed since the last build are skipped,
+    and files no longer referenced by the manifest are deleted.
+
+    Parameters:
+    -----------
+    source_dir: String - Directory of original <shop_id>.jpg photos
+    out_dir: String - Directory to write the variants and manifest to
+    widths: Tuple of ints - Target widths in pixels
+
+    Output:
+    -------
+    manifest: Dictionary - Maps each shop_id (and DEFAULT_IMAGE) to its entry
+    '''
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f).get('images', {})
+
+    images = {}
+    for name in sorted(os.listdir(source_dir)):
+        key, extension = os.path.splitext(name)
+        path = os.path.join(source_dir, name)
+        if extension.lower() not in ('.jpg', '.jpeg', '.png') or os.path.getsize(path) == 0:
+            continue
+        old = previous.get(key)
+        if old is not None and old.get('widths') == list(widths):
+            with open(path, 'rb') as f:
+                unchanged = _file_hash(f.read()) == old['source_hash']
+            if unchanged and all(os.path.exists(os.path.join(out_dir, filename))
+                                 for _, ext, _ in FORMATS for _, filename in old[ext]):
+                images[key] = old
+                continue
+        try:
+            images[key] = dict(build_variants(path, key, out_dir, widths), widths=list(widths))
+        except OSError as e:
+            print('Skipping {}: {}'.format(name, e))
+
+    manifest = {'widths': list(widths), 'images': images}
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    referenced = {filename for entry in images.values()
+                  for _, ext, _ in FORMATS for _, filename in entry[ext]}
+    for name in os.listdir(out_dir):
+        if name != MANIFEST_NAME and name not in referenced:
+            os.remove(os.path.join(out_dir, name))
+    return manifest
+
+class ImageStore():
+    '''
+    Looks up built photo variants and renders responsive <picture> markup.
+    Shops missing from the manifest, or a missing manifest, fall back to the
+    original photos so the site works before the build step has run.
+    '''
+    def __init__(self, build_dir=BUILD_DIR, url_prefix='/shop_images',
+                 fallback_prefix='/static/shop_images'):
+        '''
+        Parameters:
+        -----------
+        build_dir: String - Directory holding the manifest and variants
+        url_prefix: String - URL the variants are served under
+        fallback_prefix: String - URL of the original photos
+
+        Output:
+        --------
+        None
+        '''
+
+        self.build_dir = build_dir
+        self.url_prefix = url_prefix
+        self.fallback_prefix = fallback_prefix
+        self.images = {}
+        manifest_path = os.path.join(build_dir, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.images = json.load(f)['images']
+
+    def __len__(self):
+        return len(self.images)
+
+    def srcset(self, shop_id, extension='jpg'):
+        '''
+        Returns the srcset attribute value for a shop's photo in one format,
+        or None if the shop has no built photo.
+        '''
+
+        entry = self.images.get(str(shop_id)) or self.images.get(DEFAULT_IMAGE)
+        if entry is None:
+            return None
+        return ', '.join('{}/{} {}w'.format(self.url_prefix, filename, width)
+                         for width, filename in entry[extension])
+
+    def picture(self, shop_id, alt='', sizes='(max-width: 600px) 100vw, 600px'):
+        '''
+        Renders a <picture> element offering WebP and JPEG at every built
+        width, letting the browser pick the smallest that fills the slot.
+
+        Parameters:
+        -----------
+        shop_id: Int - The shop whose photo to show
+        alt: String - Alternative text
+        sizes: String - The sizes attribute describing the rendered width
+
+        Output:
+        -------
+        html: Markup - Safe HTML for a Jinja template
+        '''
+
+        fallback = '{}/{}.jpg'.format(self.fallback_prefix, DEFAULT_IMAGE)
+        entry = self.images.get(str(shop_id)) or self.images.get(DEFAULT_IMAGE)
+        if entry is None:
+            return Markup('<img src="{}/{}.jpg" alt="{}" loading="lazy" '
+                          'onerror="this.src=\'{}\';"/>').format(
+                              self.fallback_prefix, shop_id, alt, fallback)
+        #The last format is the JPEG every browser can show, used by <img>
+        sources = Markup('').join(Markup('<source type="{}" srcset="{}" sizes="{}">').format(
+                              mime, self.srcset(shop_id, extension), sizes)
+                          for _, extension, mime in FORMATS[:-1])
+        largest = entry['jpg'][-1][1]
+        img = Markup('<img src="{}/{}" srcset="{}" sizes="{}" width="{}" height="{}" '
+                     'alt="{}" loading="lazy" onerror="this.src=\'{}\';"/>').format(
+                         self.url_prefix, largest, self.srcset(shop_id, 'jpg'), sizes,
+                         entry['width'], entry['height'], alt, fallback)
+        return Markup('<picture>') + sources + img + Markup('</picture>')
+
+def main():
+    parser = argparse.ArgumentParser(description='Build resized, content-hashed shop photos')
+    parser.add_argument('--source', default=SOURCE_DIR)
+    parser.add_argument('--out', default=BUILD_DIR)
+    parser.add_argument('--widths', type=int, nargs='+', default=list(WIDTHS))
+    args = parser.parse_args()
+
+    manifest = build_image_store(args.source, args.out, tuple(args.widths))
+    source_bytes = sum(os.path.getsize(os.path.join(args.source, name))
+                       for name in os.listdir(args.source) if name.endswith('.jpg'))
+    built = {ext: sum(os.path.getsize(os.path.join(args.out, variants[-1][1]))
+                      for entry in manifest['images'].values()
+                      for variants in [entry[ext]])
+             for _, ext, _ in FORMATS}
+    print('Built {} photos. Originals {:.1f} MB; full width webp {:.1f} MB, jpg {:.1f} MB'.format(
+        len(manifest['images']), source_bytes / 1e6, built['webp'] / 1e6, built['jpg'] / 1e6))
+
+if __name__ == '__main__':
+    main()
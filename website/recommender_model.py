@@ -1,6 +1,395 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
-from geopy.distance import great_circle
+from geo_functions import GridIndex, ShopLocations, haversine_miles
+from metrics import NULL_TIMER, StageTimer
+from similarity_index import MIN_IVF_ROWS, IVFIndex, brute_force_similar, normalize_rows
+
+logger = logging.getLogger(__name__)
+
+# Columns in the recommender dataframe that describe a shop rather than hold
+# NMF feature weights
+META_COLUMNS = ['name', 'lat', 'lng', 'address', 'shop_id']
+
+# Upper bound on user x shop entries held per block by recommend_batch
+# (each score/distance matrix block is at most 8 bytes per entry)
+MAX_BLOCK_ENTRIES = 2 ** 21
+
+# Number of compiled scoring plans each ModelData keeps
+MAX_CACHED_PLANS = 1024
+
+def weighted_scores(feature_columns, weights, shops=None):
+    '''
+    Computes each user's weighted feature score for each shop. Columns are
+    accumulated one at a time in ascending order, so a single user and a
+    block of users get bit-for-bit identical scores.
+
+    Parameters:
+    -----------
+    feature_columns: Numpy Array - (user features x shops) feature matrix
+    weights: Numpy Array - (users x user features) normalized weights
+    shops: Numpy Array - Optional shop positions to restrict scoring to
+
+    Output:
+    -------
+    scores: Numpy Array - (users x shops) combined weights
+    '''
+
+    n_shops = feature_columns.shape[1] if shops is None else len(shops)
+    scores = np.zeros((weights.shape[0], n_shops))
+    for col in np.flatnonzero(weights.any(axis=0)):
+        values = feature_columns[col] if shops is None else feature_columns[col, shops]
+        col_weights = weights[:, col]
+        contribution = col_weights[:, None] * values
+        #Unchosen features contribute exactly zero, even for NaN values
+        contribution[col_weights == 0] = 0
+        scores += contribution
+    return scores
+
+class ScoringPlan():
+    '''
+    A user's weighted features compiled into a weight vector over the mapped
+    feature matrix, plus an optional weight on proximity. Weights are
+    normalized by the sum of their absolute values, so negative weights
+    ("not bustling") count against a shop and all-positive weights behave as
+    they always have.
+    '''
+    def __init__(self, weights, distance_weight=0.0):
+        '''
+        Parameters:
+        -----------
+        weights: Numpy Array - Normalized weight for each mapped feature column
+        distance_weight: Float - Normalized weight on proximity, where a shop
+        at the user's location scores 1 and one at the edge of the range 0
+
+        Output:
+        --------
+        None
+        '''
+
+        self.weights = weights
+        self.weights.flags.writeable = False
+        self.distance_weight = distance_weight
+
+    @staticmethod
+    def signature(chosen_features, distance_weight=0.0):
+        '''
+        Normalizes a request into a hashable key. Requests whose weights only
+        differ by a common factor share a signature.
+
+        Parameters:
+        -----------
+        chosen_features: List of tuples (float, string) - The importance of a
+        specific feature for a user and the name of that feature. Weights
+        may be negative
+        distance_weight: Float - Importance of being close to the user
+
+        Output:
+        -------
+        signature: Tuple - ((name, weight), ...) sorted by name, then the
+        distance weight
+        '''
+
+        total = sum([abs(float(item[0])) for item in chosen_features]) + abs(float(distance_weight))
+        if total == 0:
+            raise ValueError('At least one weight must be nonzero')
+        features = tuple(sorted((name, float(weight) / total)
+                                for weight, name in chosen_features))
+        return features, float(distance_weight) / total
+
+    @classmethod
+    def compile(cls, signature, feature_index):
+        '''
+        Builds the plan for a signature.
+
+        Parameters:
+        -----------
+        signature: Tuple - Output of ScoringPlan.signature
+        feature_index: Dictionary - Maps feature names to matrix columns
+
+        Output:
+        -------
+        plan: ScoringPlan
+        '''
+
+        features, distance_weight = signature
+        weights = np.zeros(len(feature_index))
+        for name, weight in features:
+            weights[feature_index[name]] += weight
+        return cls(weights, distance_weight)
+
+    def score(self, data, indices, distances, r):
+        '''
+        Scores the given shops.
+
+        Parameters:
+        -----------
+        data: ModelData - The precomputed data to score against
+        indices: Numpy Array - Row positions of the shops to score
+        distances: Numpy Array - Miles from the user to each of those shops
+        r: Float - The range distances are scaled by
+
+        Output:
+        -------
+        scores: Numpy Array - Combined weight of each shop
+        '''
+
+        scores = weighted_scores(data.feature_columns, self.weights[None, :],
+                                 indices)[0]
+        if self.distance_weight:
+            scores += self.distance_weight * (1 - np.asarray(distances) / r)
+        return scores
+
+class Recommendations():
+    '''
+    Lightweight result of RecommenderModel.recommend holding the top shops'
+    metadata, distance from the user and combined weight in ranked order.
+    '''
+    columns = META_COLUMNS + ['distance_from_location', 'combined_weights']
+
+    def __init__(self, shops, distance_from_location, combined_weights):
+        '''
+        Parameters:
+        -----------
+        shops: Dictionary - Maps each of META_COLUMNS to a Numpy Array of
+        values for the recommended shops, in ranked order
+        distance_from_location: Numpy Array - Miles from the user to each shop
+        combined_weights: Numpy Array - Each shop's weighted feature score
+
+        Output:
+        --------
+        None
+        '''
+
+        self.shops = shops
+        self.distance_from_location = distance_from_location
+        self.combined_weights = combined_weights
+
+    def __len__(self):
+        return len(self.combined_weights)
+
+    @property
+    def shop_ids(self):
+        return self.shops['shop_id']
+
+    def to_dict(self, orient='records'):
+        '''
+        Converts the recommendations to a list of plain Python dictionaries,
+        one per shop, mirroring DataFrame.to_dict('records').
+
+        Parameters:
+        -----------
+        orient: String - Only 'records' is supported
+
+        Output:
+        -------
+        records: List of dictionaries keyed by Recommendations.columns
+        '''
+
+        if orient != 'records':
+            raise ValueError("Recommendations only support orient='records'")
+        values = [self.shops[col].tolist() for col in META_COLUMNS]
+        values.append(self.distance_from_location.tolist())
+        values.append(self.combined_weights.tolist())
+        return [dict(zip(self.columns, row)) for row in zip(*values)]
+
+    def to_frame(self):
+        '''
+        Converts the recommendations to a Pandas DataFrame with one row per
+        shop.
+        '''
+
+        return pd.DataFrame(dict(self.shops,
+                                 distance_from_location=self.distance_from_location,
+                                 combined_weights=self.combined_weights),
+                            columns=self.columns)
+
+class ModelData():
+    '''
+    Read-only data precomputed from the NMF output and the mapping matrix.
+    RecommenderModel swaps in a new instance on refresh, so a request that
+    holds one keeps a consistent view of every array.
+    '''
+    def __init__(self, df, mapping_df, precomputed=None, neighborhoods=None):
+        '''
+        Parameters:
+        -----------
+        df: Pandas DataFrame - The primary recommender dataframe including the W
+        matrix from NMF. May be None when precomputed is given
+        mapping_df: Pandas DataFrame - The dataframe mapping user features to
+        NMF model's latent features
+        precomputed: Dictionary - Optional read-only arrays loaded from a
+        model artifact (see model_artifact.py), used directly instead of
+        recomputing them from df and mapping_df
+        neighborhoods: NeighborhoodIndex - Optional precomputed candidate
+        lists and neighborhood data (see neighborhood_index.py). Ignored if
+        it was built for different shops.
+
+        Output:
+        --------
+        None
+        '''
+
+        if precomputed is None:
+            feature_matrix = self.build_feature_matrix(df, mapping_df)
+            feature_columns = np.ascontiguousarray(feature_matrix.T)
+            feature_columns.flags.writeable = False
+            lats, lngs = df['lat'], df['lng']
+            shop_metadata = {col: df[col].to_numpy() for col in META_COLUMNS}
+            for values in shop_metadata.values():
+                values.flags.writeable = False
+            latent = df.drop(META_COLUMNS, axis=1).to_numpy(dtype=float)
+        else:
+            feature_matrix = precomputed['feature_matrix']
+            feature_columns = precomputed['feature_columns']
+            lats, lngs = precomputed['lat'], precomputed['lng']
+            shop_metadata = {col: precomputed[col] for col in META_COLUMNS}
+            latent = precomputed['W']
+        feature_index = {name: i for i, name in enumerate(mapping_df.columns)}
+        shop_locations = ShopLocations(lats, lngs)
+        #Keyed on row position in the shop arrays; shops can be removed from or
+        #re-inserted into the index as they close or reopen
+        spatial_index = GridIndex.from_arrays(lats, lngs)
+        #Unit-length W rows, so cosine similarity is a dot product
+        latent_vectors = normalize_rows(latent)
+        latent_vectors.flags.writeable = False
+        #None for catalogs small enough that scanning every shop is faster
+        similarity_index = (IVFIndex(latent_vectors) if len(latent_vectors) >= MIN_IVF_ROWS
+                            else None)
+        shop_positions = {shop_id: i for i, shop_id
+                          in enumerate(shop_metadata['shop_id'].tolist())}
+        if neighborhoods is not None and not neighborhoods.matches(shop_metadata['shop_id']):
+            logger.warning('Neighborhood index was built for different shops, ignoring it; '
+                           'rebuild it with python neighborhood_index.py')
+            neighborhoods = None
+
+        self._df = df
+        #The artifact arrays this data uses, or None if built from dataframes
+        self.precomputed = precomputed
+        self._mapped_df = None
+        self.mapping_df = mapping_df
+        self.feature_matrix = feature_matrix
+        self.feature_columns = feature_columns
+        self.feature_index = feature_index
+        self.shop_locations = shop_locations
+        self.spatial_index = spatial_index
+        self.shop_metadata = shop_metadata
+        self.latent_vectors = latent_vectors
+        self.similarity_index = similarity_index
+        self.shop_positions = shop_positions
+        self.neighborhoods = neighborhoods
+        self._plans = OrderedDict()
+        self._plans_lock = threading.Lock()
+
+    @property
+    def df(self):
+        #Data loaded from an artifact only builds the dataframe, a copy of
+        #its arrays, for code that asks for it
+        if self._df is None:
+            from model_artifact import artifact_frame
+            self._df = artifact_frame(self.precomputed)
+        return self._df
+
+    @property
+    def mapped_df(self):
+        if self._mapped_df is None:
+            self._mapped_df = pd.concat(
+                [pd.DataFrame({col: self.shop_metadata[col] for col in META_COLUMNS}),
+                 pd.DataFrame(self.feature_matrix, columns=self.mapping_df.columns)], axis=1)
+        return self._mapped_df
+
+    def compile_plan(self, chosen_features, distance_weight=0.0):
+        '''
+        Returns the ScoringPlan for a request, reusing a cached plan when one
+        with the same normalized signature was compiled recently.
+
+        Parameters:
+        -----------
+        chosen_features: List of tuples (float, string) - The importance of a
+        specific feature for a user and the name of that feature
+        distance_weight: Float - Importance of being close to the user
+
+        Output:
+        -------
+        plan: ScoringPlan
+        '''
+
+        signature = ScoringPlan.signature(chosen_features, distance_weight)
+        with self._plans_lock:
+            plan = self._plans.get(signature)
+            if plan is not None:
+                self._plans.move_to_end(signature)
+                return plan
+        plan = ScoringPlan.compile(signature, self.feature_index)
+        with self._plans_lock:
+            self._plans[signature] = plan
+            while len(self._plans) > MAX_CACHED_PLANS:
+                self._plans.popitem(last=False)
+        return plan
+
+    def warm(self, previous=None):
+        '''
+        Prepares freshly loaded data for traffic: reads every array once, so
+        memory-mapped pages are resident, and compiles the plans previous
+        data had cached, so popular requests don't pay for compilation.
+
+        Parameters:
+        -----------
+        previous: ModelData - Data being replaced, whose cached plans are
+        recompiled against this data (Default: None)
+
+        Output:
+        --------
+        None
+        '''
+
+        for array in [self.feature_matrix, self.feature_columns] + list(self.shop_metadata.values()):
+            #Object arrays, read from CSVs, are already in memory
+            if array.dtype.kind != 'O':
+                np.frombuffer(np.ascontiguousarray(array), dtype=np.uint8).sum()
+        if previous is None:
+            return
+        with previous._plans_lock:
+            signatures = list(previous._plans)
+        for signature in signatures:
+            #Plans for features the new mapping dropped are skipped
+            if all(name in self.feature_index for name, _ in signature[0]):
+                plan = ScoringPlan.compile(signature, self.feature_index)
+                with self._plans_lock:
+                    self._plans[signature] = plan
+
+    @staticmethod
+    def build_feature_matrix(df, mapping_df):
+        '''
+        Maps the output of NMF feature data to categories available to the user
+        using the mapping_df and min-max normalizes each category.
+
+        Parameters:
+        -----------
+        df: Pandas DataFrame - The primary recommender dataframe including the W
+        matrix from NMF
+        mapping_df: Pandas DataFrame - The dataframe mapping user features to
+        NMF model's latent features
+
+        Output:
+        -------
+        feature_matrix: Numpy Array - Read-only (shops x user features) array
+        of normalized mapped values, columns ordered as in mapping_df
+        '''
+
+        W = df.drop(META_COLUMNS, axis=1).values
+        mapped_features = np.dot(W, mapping_df.values)
+        #Normalize the mapped_feature values
+        feature_min = mapped_features.min(axis=0)
+        feature_max = mapped_features.max(axis=0)
+        feature_matrix = np.ascontiguousarray((mapped_features - feature_min) /
+                                              (feature_max - feature_min))
+        feature_matrix.flags.writeable = False
+        return feature_matrix
 
 class RecommenderModel():
     '''
@@ -8,27 +397,119 @@ class RecommenderModel():
     coordinates, and the main recommendation dataframe and outputs the top
     recommended coffee shops for them.
     '''
-    def __init__(self, df, mapping_df):
+    def __init__(self, df, mapping_df, distance_engine='haversine',
+                 precomputed=None, metrics=None, neighborhoods=None):
         '''
         Parameters:
         -----------
         df: Pandas DataFrame - The primary recommender dataframe including the W
-        matrix from NMF
+        matrix from NMF. May be None when precomputed is given
         mapping_df: Pandas DataFrame - The dataframe mapping user features to
         NMF model's latent features
+        distance_engine: String - 'haversine' for the vectorized distance
+        filter or 'geopy' for the per-shop great_circle reference
+        (Default: 'haversine')
+        precomputed: Dictionary - Optional arrays loaded from a model artifact
+        (see model_artifact.py)
+        metrics: MetricsRegistry - Optional registry to record the time spent
+        in each stage to, as recommender_stage_seconds (see metrics.py)
+        neighborhoods: NeighborhoodIndex - Optional precomputed candidate
+        lists, enabling the neighborhood and water filters (see
+        neighborhood_index.py). Kept across refreshes for the same shops.
 
         Output:
         --------
         None
         '''
 
-        self.df = df
-        self.mapping_df = mapping_df
+        self.distance_engine = distance_engine
+        self.metrics = metrics
+        self.neighborhoods = neighborhoods
+        self._stage_seconds = None
+        if metrics is not None:
+            self._stage_seconds = metrics.histogram(
+                'recommender_stage_seconds', 'Time spent in each RecommenderModel stage',
+                ('stage',))
+        self.refresh(df, mapping_df, precomputed)
+
+    @classmethod
+    def from_artifact(cls, path, distance_engine='haversine', metrics=None,
+                      neighborhoods=None):
+        '''
+        Builds a model from a binary artifact written by
+        model_artifact.export_artifact, memory-mapping its arrays.
+
+        Parameters:
+        -----------
+        path: String - Artifact directory
+        distance_engine: String - See __init__
+        metrics: MetricsRegistry - See __init__
+        neighborhoods: NeighborhoodIndex - See __init__
+
+        Output:
+        -------
+        model: RecommenderModel
+        '''
+
+        from model_artifact import load_artifact
+        mapping_df, precomputed = load_artifact(path)
+        return cls(None, mapping_df, distance_engine, precomputed, metrics, neighborhoods)
+
+    def __getattr__(self, name):
+        #Precomputed arrays (feature_matrix, spatial_index, ...) live on the
+        #current ModelData
+        if name != 'data' and 'data' in self.__dict__:
+            return getattr(self.data, name)
+        raise AttributeError(name)
+
+    def refresh(self, df, mapping_df, precomputed=None):
+        '''
+        Rebuilds the precomputed shop x user-feature matrix. Call this whenever
+        the NMF output or the mapping matrix is regenerated; nothing is
+        recomputed between calls to recommend. Safe to call while other
+        threads are recommending.
+
+        Parameters:
+        -----------
+        df: Pandas DataFrame - The primary recommender dataframe including the W
+        matrix from NMF. May be None when precomputed is given
+        mapping_df: Pandas DataFrame - The dataframe mapping user features to
+        NMF model's latent features
+        precomputed: Dictionary - Optional arrays loaded from a model artifact
+
+        Output:
+        --------
+        None
+        '''
+
+        timer = self._timer()
+        #A single assignment, so concurrent requests see either the old or the
+        #new data in full
+        self.data = ModelData(df, mapping_df, precomputed, self.neighborhoods)
+        timer.mark('refresh')
+
+    def swap_data(self, data):
+        '''
+        Makes already built ModelData live, e.g. a version loaded and checked
+        in the background by ModelRegistry, and returns the data it replaced.
+        Like refresh, requests in flight keep the data they started with.
+        '''
+
+        previous = self.data
+        self.data = data
+        return previous
+
+    def _timer(self):
+        #Stage timings cost a single no-op call when metrics are off
+        if self._stage_seconds is None:
+            return NULL_TIMER
+        return StageTimer(self._stage_seconds)
 
     def recommend(self, f1, f2, f3, lat, lng, r=20, n=3):
         '''
         Takes in a user's preferences for three features, their geographic
         coordinates and outputs the top recommended coffee shops for them.
+        Nothing is stored on the model, so one instance can serve many threads.
 
         Parameters:
         -----------
@@ -41,80 +522,327 @@ class RecommenderModel():
 
         Output:
         --------
-        Recommendations: List - Top recommendations based on the user's input
+        Recommendations: Recommendations - Top recommendations based on the
+        user's input, best first
         '''
 
-        self.chosen_features = [f1, f2, f3]
-        self.mapped_df = self._map_features()
-        self.distance_filtered_df = self._filter_by_lat_lng(lat, lng, r)
-        self.sorted_df = self._sort_features()
-        top_three_df = self.sorted_df.iloc[0:n]
-        return top_three_df
+        return self.recommend_features([f1, f2, f3], lat, lng, r, n)
 
-    def _sort_features(self):
+    def recommend_features(self, chosen_features, lat, lng, r=20, n=3,
+                           distance_weight=0.0, same_neighborhood=False,
+                           avoid_water=False):
         '''
-        Takes in a user's desired feature weights and a dataframe with feature
-        columns and sorts the columns for use in the recommender.
+        Takes in any number of weighted features, including negative weights
+        for features to avoid, and the user's geographic coordinates and
+        outputs the top recommended coffee shops for them. Closeness can also
+        be scored rather than only used as a cutoff.
 
         Parameters:
         -----------
-        None
+        chosen_features: List of tuples (float, string) - The importance of a
+        specific feature for a user and the name of that feature
+        lat: Float - User's latitude
+        lng: Float - User's longitude
+        r: Float - Max distance in miles that the user will travel (Default:20)
+        n: Int - Number of recommendations to return (Default, 3)
+        distance_weight: Float - Importance of being close to the user,
+        weighed against the features (Default: 0, distance only filters)
+        same_neighborhood: Bool - Only recommend shops in the user's
+        neighborhood. Requires a neighborhood index (Default: False)
+        avoid_water: Bool - Only recommend shops the user can reach in a
+        straight line without crossing water. Requires a neighborhood index
+        (Default: False)
+
+        Output:
+        --------
+        Recommendations: Recommendations - Top recommendations based on the
+        user's input, best first
+        '''
+
+        #Distances are scaled by r when closeness is scored
+        if not float(r) > 0:
+            raise ValueError('r must be greater than 0')
+        timer = self._timer()
+        data = self.data
+        plan = data.compile_plan(chosen_features, distance_weight)
+        timer.mark('compile_plan')
+        indices, distances = self._filter_by_lat_lng(lat, lng, r, data, same_neighborhood,
+                                                     avoid_water)
+        timer.mark('filter_by_lat_lng')
+        recommendations = self._sort_features(plan, indices, distances, n, data, r)
+        timer.mark('sort_features')
+        return recommendations
+
+    def similar_shops(self, shop_id, lat=None, lng=None, r=None, n=3,
+                      exact=False):
+        '''
+        Finds the shops whose reviews read most like a given shop's, by
+        cosine similarity of their NMF latent features, using the
+        precomputed IVFIndex, or every shop when there are too few for the
+        index to pay off. The shop itself is never returned.
+
+        Parameters:
+        -----------
+        shop_id: Int - The shop to find neighbours for
+        lat, lng: Float - Optional user location. Distances, and the radius
+        filter, are measured from here (Default: the shop's own location)
+        r: Float - Optional max distance in miles
+        n: Int - Number of shops to return (Default: 3)
+        exact: Boolean - Score every candidate instead of using the index
+
+        Output:
+        --------
+        recommendations: Recommendations - The most similar shops, most
+        similar first, with their cosine similarity as combined_weights
+        '''
+
+        timer = self._timer()
+        data = self.data
+        position = data.shop_positions.get(shop_id)
+        if position is None:
+            raise KeyError('Unknown shop_id {}'.format(shop_id))
+        if lat is None or lng is None:
+            lat, lng = data.shop_metadata['lat'][position], data.shop_metadata['lng'][position]
+        if r is not None:
+            candidates, _ = self._filter_by_lat_lng(lat, lng, r, data)
+        elif len(data.spatial_index) != len(data.shop_locations):
+            #Shops removed from the spatial index are never recommended
+            candidates = np.array([i for i in range(len(data.shop_locations))
+                                   if i in data.spatial_index], dtype=int)
+        else:
+            candidates = None
+        if candidates is not None:
+            candidates = candidates[candidates != position]
+
+        query = data.latent_vectors[position]
+        if exact or data.similarity_index is None:
+            positions, similarities = brute_force_similar(data.latent_vectors, query,
+                                                          n + 1, candidates)
+        else:
+            positions, similarities = data.similarity_index.search(query, n + 1, candidates)
+        keep = positions != position
+        positions, similarities = positions[keep][:n], similarities[keep][:n]
+
+        locations = data.shop_locations
+        distances = haversine_miles(float(lat), float(lng), locations.lat_rad[positions],
+                                    locations.lng_rad[positions], locations.cos_lat[positions])
+        timer.mark('similar_shops')
+        return Recommendations({col: values[positions]
+                                for col, values in data.shop_metadata.items()},
+                               distances, similarities)
+
+    def recommend_batch(self, weights, feature_names, lats, lngs, radii, n=3,
+                        block_size=None, n_jobs=1, distance_weights=0.0):
+        '''
+        Recommends shops for many users at once. Users are processed in blocks
+        whose user x shop score and distance matrices hold at most
+        MAX_BLOCK_ENTRIES entries, and blocks can be spread over threads.
+        Each row gives the same shops, scores and distances as calling
+        recommend_features with that row's inputs.
+
+        Parameters:
+        -----------
+        weights: Array-like - (users x k) importance of each chosen feature
+        feature_names: Array-like - (users x k) names of the chosen features
+        lats, lngs: Array-like - Each user's latitude and longitude
+        radii: Array-like or Float - Max distance in miles for each user
+        n: Int - Number of recommendations per user (Default: 3)
+        block_size: Int - Users per block (Default: sized from
+        MAX_BLOCK_ENTRIES)
+        n_jobs: Int - Number of threads to process blocks on (Default: 1)
+        distance_weights: Array-like or Float - Importance of being close,
+        for each user (Default: 0)
+
+        Output:
+        -------
+        positions: Numpy Array - (users x n) row positions of the recommended
+        shops, best first, padded with -1 when fewer than n are in range
+        scores: Numpy Array - (users x n) combined weights, padded with NaN
+        distances: Numpy Array - (users x n) miles to each shop, padded with
+        NaN
+        '''
+
+        timer = self._timer()
+        data = self.data
+        lats = np.asarray(lats, dtype=float)
+        lngs = np.asarray(lngs, dtype=float)
+        radii = np.broadcast_to(np.asarray(radii, dtype=float), lats.shape)
+        if not np.all(radii > 0):
+            raise ValueError('radii must be greater than 0')
+        distance_weights = np.broadcast_to(np.asarray(distance_weights, dtype=float),
+                                           lats.shape)
+        plans = [data.compile_plan(list(zip(row_weights, row_names)), distance_weight)
+                 for row_weights, row_names, distance_weight
+                 in zip(weights, feature_names, distance_weights)]
+        user_weights = np.array([plan.weights for plan in plans])
+        user_distance_weights = np.array([plan.distance_weight for plan in plans])
+        n_users, n_shops = len(lats), len(data.shop_locations)
+        if block_size is None:
+            block_size = max(1, MAX_BLOCK_ENTRIES // max(n_shops, 1))
+
+        positions = np.full((n_users, n), -1, dtype=int)
+        scores = np.full((n_users, n), np.nan)
+        distances = np.full((n_users, n), np.nan)
+        #Shops removed from the spatial index are never recommended
+        active = np.ones(n_shops, dtype=bool)
+        if len(data.spatial_index) != n_shops:
+            active[:] = [i in data.spatial_index for i in range(n_shops)]
+
+        def recommend_block(start):
+            stop = min(start + block_size, n_users)
+            block_scores = weighted_scores(data.feature_columns,
+                                           user_weights[start:stop])
+            block_distances = haversine_miles(lats[start:stop, None],
+                                              lngs[start:stop, None],
+                                              data.shop_locations.lat_rad,
+                                              data.shop_locations.lng_rad,
+                                              data.shop_locations.cos_lat)
+            in_range = (block_distances < radii[start:stop, None]) & active
+            block_distance_weights = user_distance_weights[start:stop]
+            if block_distance_weights.any():
+                proximity = block_distance_weights[:, None] * (
+                    1 - block_distances / radii[start:stop, None])
+                block_scores += np.where(block_distance_weights[:, None] != 0, proximity, 0)
+            for row in range(stop - start):
+                indices = np.flatnonzero(in_range[row])
+                top = self._top_n(block_scores[row, indices],
+                                  data.shop_metadata['shop_id'][indices], n)
+                positions[start + row, :len(top)] = indices[top]
+                scores[start + row, :len(top)] = block_scores[row, indices[top]]
+                distances[start + row, :len(top)] = block_distances[row, indices[top]]
+
+        starts = range(0, n_users, block_size)
+        if n_jobs == 1:
+            for start in starts:
+                recommend_block(start)
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                list(executor.map(recommend_block, starts))
+        timer.mark('recommend_batch')
+        return positions, scores, distances
+
+    def _sort_features(self, plan, indices, distances, n, data, r):
+        '''
+        Scores the shops within range with the user's compiled plan and
+        selects the top n. The weighted sum is computed over whole feature
+        columns with weighted_scores, and only the top n are sorted. Equal
+        scores are ordered by shop_id so results are deterministic.
+
+        Parameters:
+        -----------
+        plan: ScoringPlan - The user's compiled feature weights
+        indices: Numpy Array - Row positions of the shops within range
+        distances: Numpy Array - Miles from the user to each of those shops
+        n: Int - Number of recommendations to return
+        data: ModelData - The precomputed data to score against
+        r: Float - The user's range
 
         Output:
         -------
-        sorted_df: Pandas Dataframe with the recommended coffeeshops sorted by
-        the user's preferences.
+        recommendations: Recommendations - The top n shops sorted by the
+        user's preferences
         '''
 
-        normalizing_weight = sum([item[0] for item in self.chosen_features])
-        self.feature_names = [item[1] for item in self.chosen_features]
-        for item in self.chosen_features:
-            self.distance_filtered_df['{}'.format(item[1])] = (self.distance_filtered_df['{}'.format(item[1])]
-                                                             * item[0]
-                                                             / normalizing_weight)
+        scores = plan.score(data, indices, distances, r)
 
-        self.distance_filtered_df['combined_weights'] = self.distance_filtered_df.apply(lambda row: (row[self.feature_names[0]]
-                                                                             + row[self.feature_names[1]]
-                                                                             + row[self.feature_names[2]]),
-                                                                  axis=1)
+        top = self._top_n(scores, data.shop_metadata['shop_id'][indices], n)
+        indices = indices[top]
+        return Recommendations({col: values[indices]
+                                for col, values in data.shop_metadata.items()},
+                               distances[top], scores[top])
 
-        sorted_df = self.distance_filtered_df[['name', 'lat', 'lng', 'address',
-                                               'shop_id',
-                                               'distance_from_location',
-                                               'combined_weights']]
-        sorted_df = sorted_df.sort_values('combined_weights', ascending=False)
-        return sorted_df
+    @staticmethod
+    def _top_n(scores, shop_ids, n):
+        '''
+        Finds the positions of the n highest scores using a partial selection,
+        breaking ties by ascending shop_id. NaN scores rank last.
+
+        Parameters:
+        -----------
+        scores: Numpy Array - Score for each candidate shop
+        shop_ids: Numpy Array - shop_id for each candidate shop
+        n: Int - Number of positions to return
+
+        Output:
+        -------
+        top: Numpy Array - Positions into scores, best first
+        '''
+
+        n = max(0, min(int(n), len(scores)))
+        if n == 0:
+            return np.array([], dtype=int)
+        ranked = np.where(np.isnan(scores), -np.inf, scores)
+        if n < len(ranked):
+            #Keep everything tied with the nth best so ties break on shop_id
+            threshold = np.partition(ranked, len(ranked) - n)[len(ranked) - n]
+            candidates = np.flatnonzero(ranked >= threshold)
+        else:
+            candidates = np.arange(len(ranked))
+        order = np.lexsort((shop_ids[candidates], -ranked[candidates]))
+        return candidates[order[:n]]
 
-    def _filter_by_lat_lng(self, lat, lng, r):
+    def _filter_by_lat_lng(self, lat, lng, r, data, same_neighborhood=False,
+                           avoid_water=False):
         '''
         Takes in a user's latitude and longitude and a dataframe including
         coffeeshop latitudes and longitudes and filters out coffeeshops that are
-        not within a particular distance
+        not within a particular distance. With a neighborhood index, common
+        radii only measure distances to the precomputed candidates of the
+        user's grid cell.
 
         Paramters:
         ----------
         lat: Float - User's latitude
         lng: Float - User's longitude
         r: Range, in miles, to restrict recommendations to
+        data: ModelData - The precomputed data to filter
+        same_neighborhood: Bool - Also drop shops outside the user's
+        neighborhood
+        avoid_water: Bool - Also drop shops across water from the user
 
         Output:
         -------
-        distance_filtered_df: Pandas DataFrame - Pandas Dataframe only including
-        coffeeshops that are within the specified range of the input latitude
-        and longitude
-        '''
-        current_location = (lat, lng)
-        self.mapped_df['distance_from_location'] = self.mapped_df.apply(lambda row: great_circle(current_location,
-                                                                     (row['lat'],
-                                                                      row['lng'])).miles,
-                                                          axis=1)
-        distance_filtered_df = self.mapped_df[self.mapped_df['distance_from_location'] < r]
-        return distance_filtered_df
+        indices: Numpy Array - Row positions of the coffeeshops that are within
+        the specified range of the input latitude and longitude
+        distances: Numpy Array - Miles from the input location to each of them
+        '''
+        neighborhoods = data.neighborhoods
+        if (same_neighborhood or avoid_water) and neighborhoods is None:
+            raise ValueError('Neighborhood filters require a neighborhood index')
+        cell = neighborhoods.cell(lat, lng) if neighborhoods is not None else None
+        candidates = None
+        if cell is not None and self.distance_engine == 'haversine':
+            candidates = neighborhoods.candidates(cell, float(r))
+        if candidates is not None:
+            locations = data.shop_locations
+            distances = haversine_miles(float(lat), float(lng), locations.lat_rad[candidates],
+                                        locations.lng_rad[candidates],
+                                        locations.cos_lat[candidates])
+            indices, distances = self._active(data, candidates[distances < float(r)],
+                                              distances[distances < float(r)])
+        elif self.distance_engine == 'haversine':
+            indices, distances = data.spatial_index.query(lat, lng, r)
+        else:
+            indices, distances = data.shop_locations.within(lat, lng, r,
+                                                            self.distance_engine)
+            indices, distances = self._active(data, indices, distances)
+        if same_neighborhood or avoid_water:
+            keep = neighborhoods.filter(lat, lng, indices, same_neighborhood, avoid_water)
+            indices, distances = indices[keep], distances[keep]
+        return indices, distances
+
+    @staticmethod
+    def _active(data, indices, distances):
+        #Shops removed from the spatial index are never recommended
+        if len(data.spatial_index) == len(data.shop_locations):
+            return indices, distances
+        keep = np.array([i in data.spatial_index for i in indices], dtype=bool)
+        return indices[keep], distances[keep]
 
     def _map_features(self):
         '''
-        Maps the output of NMF feature data to categories available to the user
-        using the mapping_df.
+        Returns the precomputed dataframe of NMF feature data mapped to the
+        categories available to the user.
 
         Parameters:
         -----------
@@ -127,15 +855,4 @@ class RecommenderModel():
         values
         '''
 
-        W = self.df.drop(['name', 'lat', 'lng', 'address', 'shop_id'], axis=1)
-        mapping_df_columns = self.mapping_df.columns
-        mapped_features = pd.DataFrame(np.dot(W,self.mapping_df),
-                                       columns = mapping_df_columns)
-        #Normalize the mapped_feature values
-        normalized_df=((mapped_features - mapped_features.min()) /
-                       (mapped_features.max() - mapped_features.min()))
-
-        feature_mapped_df = pd.concat([self.df[['name', 'lat', 'lng', 'address',
-                                      'shop_id']].reset_index(drop=True),
-                                      normalized_df], axis=1)
-        return feature_mapped_df
+        return self.data.mapped_df
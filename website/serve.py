@@ -0,0 +1,378 @@
+'''
+Production entry point for the web app. The parent process imports app.py
+once, so the recommender is loaded a single time, then forks worker
+processes that each serve requests on the shared listening socket. Python
+runs one thread at a time per process, so workers are what let an instance
+use more than one core.
+
+Workers share the parent's memory copy-on-write. The model's arrays are
+memory-mapped from an artifact, so reference count updates on pandas and
+Python objects never touch (and copy) those pages. When the app was loaded
+from CSVs, the arrays are first moved into an artifact in /dev/shm.
+
+Each worker watches the model registry itself and follows its state.json,
+so admin actions handled by one worker reach all of them, and restarted
+workers load the registry's active version. Workers also write a snapshot
+of their metrics with every heartbeat, and /metrics on any worker adds up
+all of them. A restarted worker's counts start again from zero.
+
+Usage:
+    cd website && python serve.py [--workers 4] [--bind 0.0.0.0:5000]
+
+Send the parent SIGTERM or SIGINT to stop after in-flight requests finish,
+and SIGHUP to restart the workers one at a time. GET /_workers on any worker
+reports the health of every worker.
+'''
+import argparse
+import gc
+import glob
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import RawArray
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+# Per-worker fields in the shared health table
+FIELDS = ('pid', 'started', 'heartbeat', 'requests', 'in_flight', 'restarts', 'healthy')
+HEARTBEAT_INTERVAL = 2.0
+
+class WorkerTable():
+    '''
+    Worker health in anonymous shared memory, created before forking so the
+    parent and every worker see the same table. Each field is written by a
+    single process: the parent sets pid, started and restarts, and the
+    worker in a slot sets the rest.
+    '''
+    def __init__(self, n_workers):
+        self.n_workers = n_workers
+        self.values = RawArray('d', n_workers * len(FIELDS))
+
+    def get(self, slot, field):
+        return self.values[slot * len(FIELDS) + FIELDS.index(field)]
+
+    def set(self, slot, field, value):
+        self.values[slot * len(FIELDS) + FIELDS.index(field)] = value
+
+    def describe(self, heartbeat_timeout):
+        now = time.time()
+        workers = []
+        for slot in range(self.n_workers):
+            row = {field: self.get(slot, field) for field in FIELDS}
+            age = now - row['heartbeat'] if row['heartbeat'] else None
+            workers.append({'slot': slot, 'pid': int(row['pid']),
+                            'uptime_seconds': round(now - row['started'], 1) if row['started'] else None,
+                            'heartbeat_age_seconds': round(age, 1) if age is not None else None,
+                            'requests': int(row['requests']),
+                            'in_flight': int(row['in_flight']),
+                            'restarts': int(row['restarts']),
+                            'healthy': bool(row['healthy']) and age is not None
+                                       and age < heartbeat_timeout})
+        return workers
+
+def write_metrics(metrics_dir, slot):
+    '''
+    Writes this worker's metrics snapshot for the other workers to merge.
+    '''
+
+    from metrics import REGISTRY
+    path = os.path.join(metrics_dir, 'slot-{}.json'.format(slot))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(REGISTRY.snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+def read_metrics(metrics_dir):
+    '''
+    Returns the metrics of every worker in the Prometheus text format.
+    '''
+
+    from metrics import merge_snapshots
+    snapshots = []
+    for path in sorted(glob.glob(os.path.join(metrics_dir, 'slot-*.json'))):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return merge_snapshots(snapshots)
+
+class WorkerApp():
+    '''
+    WSGI middleware counting a worker's requests into the health table and
+    answering /_workers and /metrics for every worker.
+    '''
+    def __init__(self, app, table, slot, heartbeat_timeout, metrics_dir):
+        self.app = app
+        self.table = table
+        self.slot = slot
+        self.heartbeat_timeout = heartbeat_timeout
+        self.metrics_dir = metrics_dir
+        self.requests = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def _count(self, requests, in_flight):
+        with self._lock:
+            self.requests += requests
+            self.in_flight += in_flight
+            self.table.set(self.slot, 'requests', self.requests)
+            self.table.set(self.slot, 'in_flight', self.in_flight)
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == '/_workers':
+            body = json.dumps({'workers': self.table.describe(self.heartbeat_timeout),
+                               'served_by': os.getpid()}).encode()
+            start_response('200 OK', [('Content-Type', 'application/json'),
+                                      ('Content-Length', str(len(body)))])
+            return [body]
+        if environ.get('PATH_INFO') == '/metrics':
+            write_metrics(self.metrics_dir, self.slot)
+            body = read_metrics(self.metrics_dir).encode()
+            start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'),
+                                      ('Content-Length', str(len(body)))])
+            return [body]
+        self._count(1, 1)
+        try:
+            #Responses here are fully buffered, so the request is done when
+            #the app returns
+            return self.app(environ, start_response)
+        finally:
+            self._count(0, -1)
+
+class QuietRequestHandler(WSGIRequestHandler):
+    #Per-request access logs cost more than the recommendations themselves
+    def log_request(self, *args, **kwargs):
+        pass
+
+def share_model_memory(app):
+    '''
+    Moves the served model's arrays into shared memory when they were built
+    from CSVs, by exporting an artifact to /dev/shm and memory-mapping it
+    back. The files are deleted straight away; the mapping keeps them alive
+    until every process has exited.
+    '''
+
+    #The registry may have swapped in a newer version than the app loaded,
+    #so export whatever is being served
+    data = app.model.data
+    if data.precomputed is not None:
+        return
+    from model_artifact import export_artifact, load_artifact
+    parent = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    path = tempfile.mkdtemp(prefix='coffee_filter_', dir=parent)
+    try:
+        export_artifact(data.df, data.mapping_df, path)
+        mapping_df, precomputed = load_artifact(path)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    app.model.refresh(None, mapping_df, precomputed)
+    app.model_versions.active.data = app.model.data
+
+def worker_main(app, listener, table, slot, args, metrics_dir):
+    '''
+    Runs in a forked worker: serves requests until SIGTERM, then waits up to
+    the graceful timeout for in-flight requests before exiting.
+    '''
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    #Threads don't survive fork, so each worker watches the registry itself
+    app.model_versions.start()
+
+    wrapped = WorkerApp(app.app, table, slot, args.heartbeat_timeout, metrics_dir)
+    handler = WSGIRequestHandler if args.access_log else QuietRequestHandler
+    server = make_server(listener.getsockname()[0], listener.getsockname()[1], wrapped,
+                         threaded=True, request_handler=handler, fd=listener.fileno())
+    stopping = threading.Event()
+
+    def heartbeat():
+        #Health means the whole app answers, not just that the process is up
+        client = app.app.test_client()
+        while not stopping.is_set():
+            try:
+                healthy = client.get('/api/v1/health').status_code == 200
+            except Exception:
+                healthy = False
+            table.set(slot, 'healthy', 1.0 if healthy else 0.0)
+            if healthy:
+                table.set(slot, 'heartbeat', time.time())
+            try:
+                write_metrics(metrics_dir, slot)
+            except OSError:
+                pass
+            stopping.wait(HEARTBEAT_INTERVAL)
+
+    def stop(signum, frame):
+        stopping.set()
+        #shutdown blocks until serve_forever returns, so not from its thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    threading.Thread(target=heartbeat, daemon=True).start()
+    server.serve_forever()
+
+    deadline = time.time() + args.graceful_timeout
+    while wrapped.in_flight and time.time() < deadline:
+        time.sleep(0.05)
+    #Workers leave with os._exit, which skips atexit handlers
+    app.feedback.close()
+    table.set(slot, 'healthy', 0.0)
+
+class Arbiter():
+    '''
+    Parent process: forks and supervises the workers. Workers that exit or
+    stop sending heartbeats are replaced.
+    '''
+    def __init__(self, app, listener, args):
+        self.app = app
+        self.listener = listener
+        self.args = args
+        self.table = WorkerTable(args.workers)
+        parent = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.metrics_dir = tempfile.mkdtemp(prefix='coffee_filter_metrics_', dir=parent)
+        self.pids = {}
+        self.stopping = False
+        self.restart_queue = []
+        self.restarting = None
+
+    def spawn(self, slot):
+        for field in ('healthy', 'heartbeat', 'requests', 'in_flight'):
+            self.table.set(slot, field, 0.0)
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                worker_main(self.app, self.listener, self.table, slot, self.args,
+                            self.metrics_dir)
+            except BaseException as e:
+                print('Worker {} failed: {!r}'.format(os.getpid(), e), file=sys.stderr)
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        self.pids[pid] = slot
+        self.table.set(slot, 'pid', pid)
+        self.table.set(slot, 'started', time.time())
+        return pid
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot = self.pids.pop(pid, None)
+            if slot is None or self.stopping:
+                continue
+            if slot != self.restarting and time.time() - self.table.get(slot, 'started') < 1:
+                #Crashing on start, e.g. a bad model version; don't spin
+                time.sleep(1)
+            self.table.set(slot, 'restarts', self.table.get(slot, 'restarts') + 1)
+            self.spawn(slot)
+
+    def check_heartbeats(self):
+        now = time.time()
+        for pid, slot in list(self.pids.items()):
+            started = self.table.get(slot, 'started')
+            last = self.table.get(slot, 'heartbeat') or started
+            if now - started > self.args.heartbeat_timeout and now - last > self.args.heartbeat_timeout:
+                print('Worker {} missed heartbeats for {:.0f} s, killing it'.format(pid, now - last),
+                      file=sys.stderr)
+                os.kill(pid, signal.SIGKILL)
+
+    def continue_restart(self):
+        #One worker at a time: the next is stopped once the last replacement
+        #is healthy, so capacity only ever drops by one worker
+        if self.restarting is not None:
+            slot = self.restarting
+            replaced = slot in self.pids.values() and self.table.get(slot, 'heartbeat') > \
+                self.table.get(slot, 'started')
+            if not replaced:
+                return
+            self.restarting = None
+        if self.restart_queue:
+            slot = self.restart_queue.pop(0)
+            pid = [pid for pid, s in self.pids.items() if s == slot]
+            self.restarting = slot
+            if pid:
+                os.kill(pid[0], signal.SIGTERM)
+
+    def run(self):
+        signals = []
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, lambda signum, frame: signals.append(signum))
+        for slot in range(self.args.workers):
+            self.spawn(slot)
+        print('Serving on http://{}:{} with {} workers (parent {})'.format(
+            *self.listener.getsockname()[:2], self.args.workers, os.getpid()), flush=True)
+        while not self.stopping:
+            while signals:
+                signum = signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stopping = True
+                elif signum == signal.SIGHUP and not self.restart_queue and self.restarting is None:
+                    print('Restarting workers', file=sys.stderr)
+                    self.restart_queue = list(range(self.args.workers))
+            if self.stopping:
+                break
+            self.reap()
+            self.check_heartbeats()
+            self.continue_restart()
+            time.sleep(0.2)
+        self.shutdown()
+
+    def shutdown(self):
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.args.graceful_timeout + 5
+        while self.pids and time.time() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                self.pids.pop(pid, None)
+            else:
+                time.sleep(0.05)
+        for pid in self.pids:
+            os.kill(pid, signal.SIGKILL)
+        self.listener.close()
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the web app from pre-forked workers')
+    parser.add_argument('--bind', default='0.0.0.0:5000', help='host:port (Default: 0.0.0.0:5000)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes (Default: one per core)')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='Seconds a stopping worker waits for in-flight requests')
+    parser.add_argument('--heartbeat-timeout', type=float, default=30,
+                        help='Seconds without a passing health check before a worker is killed')
+    parser.add_argument('--access-log', action='store_true')
+    args = parser.parse_args()
+
+    host, _, port = args.bind.rpartition(':')
+    listener = socket.create_server((host or '0.0.0.0', int(port)), backlog=2048, reuse_port=False)
+    listener.set_inheritable(True)
+
+    import app
+    #No threads may be running when the workers are forked
+    app.model_versions.stop()
+    share_model_memory(app)
+    #Keep the garbage collector from writing to (and so copying) every
+    #object loaded so far in each worker
+    gc.collect()
+    gc.freeze()
+    Arbiter(app, listener, args).run()
+
+if __name__ == '__main__':
+    main()